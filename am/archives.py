@@ -0,0 +1,430 @@
+"""
+Bulk upload and download of files as tar and zip archives.
+
+Archives are streamed both ways, one chunk at a time, so memory use does not
+depend on the number or size of the files:
+
+- A tar, optionally compressed, is parsed as it is received, on the event
+  loop, and each entry is written with open_write as it arrives.
+- A tar or zip of a listing is built as the files are read with open_read.
+
+Zip uploads are not supported, as a zip can only be read from its end.
+"""
+
+import bz2
+import contextlib
+import lzma
+import tarfile
+import time
+import zipfile
+import zlib
+from typing import AsyncIterator, Generator, Iterable, Iterator
+
+from am import metrics
+from am.executors import get_executor
+from am.storage.types import FileData, Storage, is_reserved_key
+
+CHUNK_SIZE = 256 * 1024
+ENCODING = "utf-8"
+
+GZIP_MAGIC = b"\x1f\x8b"
+BZ2_MAGIC = b"BZh"
+XZ_MAGIC = b"\xfd7zXZ\x00"
+MAGIC_SIZE = len(XZ_MAGIC)
+# skipped entries listed at the result of an upload, the rest are only counted
+MAX_REPORTED_SKIPPED = 100
+
+ARCHIVE_MEDIA_TYPES = {
+    "tar": "application/x-tar",
+    "zip": "application/zip",
+}
+
+
+class ArchiveError(Exception):
+    """
+    ArchiveError is raised when an uploaded archive cannot be read.
+    """
+
+    def __init__(self, message: str, result: dict):
+        super().__init__(message)
+        self.result = result
+
+
+class Decompressor:
+    """
+    Push decompressor of a gzip, bzip2 or xz stream, detected by its first
+    bytes, or a pass through for plain data. The output is given in chunks of
+    at most CHUNK_SIZE, so a small input never expands at once.
+    """
+
+    def __init__(self, head: bytes):
+        self.zlib = False
+        if head.startswith(GZIP_MAGIC):
+            self.decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+            self.zlib = True
+        elif head.startswith(BZ2_MAGIC):
+            self.decompressor = bz2.BZ2Decompressor()
+        elif head.startswith(XZ_MAGIC):
+            self.decompressor = lzma.LZMADecompressor()
+        else:
+            self.decompressor = None
+
+    @property
+    def eof(self) -> bool:
+        return self.decompressor is None or self.decompressor.eof
+
+    def feed(self, data: bytes) -> Generator[bytes, None, None]:
+        if self.decompressor is None:
+            yield data
+        elif self.zlib:
+            while data and not self.decompressor.eof:
+                yield self.decompressor.decompress(data, CHUNK_SIZE)
+                data = self.decompressor.unconsumed_tail
+        elif not self.decompressor.eof:
+            yield self.decompressor.decompress(data, CHUNK_SIZE)
+            while not self.decompressor.eof and not self.decompressor.needs_input:
+                yield self.decompressor.decompress(b"", CHUNK_SIZE)
+
+
+class TarStream:
+    """
+    Reader of a tar from an async stream of chunks, as a request body,
+    optionally compressed. It is parsed as the chunks arrive, so no thread
+    waits on the client.
+
+    Supports ustar, GNU long names and pax headers. Like tarfile, a missing
+    end of archive marker is not an error.
+    """
+
+    def __init__(self, chunks: AsyncIterator[bytes]):
+        self.chunks = aiter(chunks)
+        self.head = b""
+        self.decompressor: Decompressor | None = None
+        # decompressed output of the last chunk, not buffered yet
+        self.output: Iterator[bytes] = iter(())
+        self.buffer = bytearray()
+        self.eof = False
+        # data of the current member not read yet, and its padding
+        self.remaining = 0
+        self.padding = 0
+
+    async def fill(self, size: int) -> None:
+        """
+        Buffer at least size bytes, unless the stream ends before.
+        """
+        while len(self.buffer) < size and not self.eof:
+            try:
+                data = next(self.output, None)
+            except (zlib.error, lzma.LZMAError, OSError, EOFError) as e:
+                raise tarfile.CompressionError(f"invalid compressed data: {e}") from e
+            if data is not None:
+                self.buffer += data
+                continue
+            chunk = await anext(self.chunks, None)
+            if self.decompressor is None:
+                # enough bytes to tell the compression
+                self.head += chunk or b""
+                if chunk is not None and len(self.head) < MAGIC_SIZE:
+                    continue
+                self.decompressor = Decompressor(self.head)
+                chunk, self.head = self.head, b""
+            if chunk is None:
+                if not self.decompressor.eof:
+                    raise tarfile.ReadError("unexpected end of compressed data")
+                self.eof = True
+            else:
+                self.output = self.decompressor.feed(chunk)
+
+    async def take(self, size: int) -> bytes:
+        """
+        Read size bytes, failing if the stream ends before.
+        """
+        await self.fill(size)
+        if len(self.buffer) < size:
+            raise tarfile.ReadError("unexpected end of data")
+        data = bytes(self.buffer[:size])
+        del self.buffer[:size]
+        return data
+
+    async def skip(self, size: int) -> None:
+        while size > 0:
+            data = await self.take(min(size, CHUNK_SIZE))
+            size -= len(data)
+
+    async def read(self, size: int = CHUNK_SIZE) -> bytes:
+        """
+        Read the data of the current member, b"" once it is all read.
+        """
+        size = min(size, self.remaining)
+        if size <= 0:
+            return b""
+        data = await self.take(size)
+        self.remaining -= len(data)
+        return data
+
+    async def next_member(self) -> tarfile.TarInfo | None:
+        """
+        Get the next member, skipping the unread data of the current one, or
+        None at the end of the archive.
+        """
+        await self.skip(self.remaining + self.padding)
+        self.remaining = self.padding = 0
+        pax: dict[str, str] = {}
+        long_name = None
+        while True:
+            await self.fill(tarfile.BLOCKSIZE)
+            if not self.buffer and self.eof:
+                return None
+            block = await self.take(tarfile.BLOCKSIZE)
+            if block == tarfile.NUL * tarfile.BLOCKSIZE:
+                return None
+            info = tarfile.TarInfo.frombuf(block, ENCODING, "surrogateescape")
+            padding = -info.size % tarfile.BLOCKSIZE
+            if info.type in (tarfile.XHDTYPE, tarfile.SOLARIS_XHDTYPE):
+                pax.update(parse_pax(await self.take(info.size)))
+                await self.skip(padding)
+                continue
+            if info.type == tarfile.GNUTYPE_LONGNAME:
+                long_name = tarfile.nts(
+                    await self.take(info.size), ENCODING, "surrogateescape"
+                )
+                await self.skip(padding)
+                continue
+            if info.type in (tarfile.XGLTYPE, tarfile.GNUTYPE_LONGLINK):
+                await self.skip(info.size + padding)
+                continue
+            if info.type == tarfile.GNUTYPE_SPARSE or any(
+                key.startswith("GNU.sparse.") for key in pax
+            ):
+                raise tarfile.ReadError("sparse files are not supported")
+
+            if long_name is not None:
+                info.name = long_name
+            if "path" in pax:
+                info.name = pax["path"]
+            if "size" in pax:
+                info.size = int(pax["size"])
+            # as tarfile, only regular and unknown members have data
+            if info.isreg() or info.type not in tarfile.SUPPORTED_TYPES:
+                self.remaining = info.size
+                self.padding = -info.size % tarfile.BLOCKSIZE
+            return info
+
+
+def parse_pax(data: bytes) -> dict[str, str]:
+    """
+    Parse the records of a pax header, as `<length> <key>=<value>\n`.
+    """
+    records = {}
+    position = 0
+    while position < len(data) and data[position] != 0:
+        space = data.find(b" ", position)
+        if space < 0:
+            raise tarfile.ReadError("invalid pax header")
+        try:
+            length = int(data[position:space])
+        except ValueError as e:
+            raise tarfile.ReadError("invalid pax header") from e
+        if length <= 0:
+            raise tarfile.ReadError("invalid pax header")
+        key, _, value = data[space + 1 : position + length - 1].partition(b"=")
+        records[key.decode(ENCODING, "surrogateescape")] = value.decode(
+            ENCODING, "surrogateescape"
+        )
+        position += length
+    return records
+
+
+def entry_key(prefix: str, name: str) -> str | None:
+    """
+    The key of an archive entry, or None if the name is not a safe key, as
+    absolute, going up with .., or internal.
+    """
+    name = name.replace("\\", "/")
+    if name.startswith("/"):
+        return None
+    parts = [part for part in name.split("/") if part not in ("", ".")]
+    if not parts or ".." in parts:
+        return None
+    key = prefix + "/".join(parts)
+    if is_reserved_key(key):
+        return None
+    return key
+
+
+async def ingest_tar(
+    storage: Storage,
+    bucket: str,
+    chunks: AsyncIterator[bytes],
+    prefix: str = "",
+    max_size: int | None = None,
+) -> dict:
+    """
+    Write the files of a streamed tar, compressed or not, to the bucket, each
+    as it is read. Returns the count and size of the written files and the
+    skipped entries.
+
+    The archive is read on the event loop, and each open, write and commit of
+    a file is a job of the io executor, so no thread waits on the client.
+    Only the first open can be rejected when the executor is busy.
+
+    Entries that are not regular files, have unsafe names, are over max_size
+    or can not be written, as `a/b` after a file `a`, are skipped. Raises
+    ArchiveError if the archive is malformed, the files written until then
+    are kept.
+    """
+    result = {"files": 0, "size": 0, "skipped": [], "skipped_count": 0}
+
+    def skip(name: str, reason: str) -> None:
+        result["skipped_count"] += 1
+        if len(result["skipped"]) < MAX_REPORTED_SKIPPED:
+            result["skipped"].append({"name": name, "reason": reason})
+
+    tar = TarStream(chunks)
+    admitted = False
+    try:
+        while (member := await tar.next_member()) is not None:
+            if member.isdir():
+                continue
+            if not member.isfile():
+                skip(member.name, "not a regular file")
+                continue
+            key = entry_key(prefix, member.name)
+            if key is None:
+                skip(member.name, "invalid name")
+                continue
+            if max_size is not None and member.size > max_size:
+                skip(member.name, f"larger than {max_size} bytes")
+                continue
+
+            try:
+                await write_entry(tar, storage, bucket, key, admitted)
+            except OSError as e:
+                skip(member.name, f"could not be written: {e.strerror or e}")
+                continue
+            finally:
+                admitted = True
+            result["files"] += 1
+            result["size"] += member.size
+    except tarfile.TarError as e:
+        raise ArchiveError(f"Invalid tar archive: {e}", result) from e
+    return result
+
+
+async def write_entry(
+    tar: TarStream, storage: Storage, bucket: str, key: str, admitted: bool
+) -> None:
+    """
+    Write the data of the current tar member to the key, as io jobs.
+    """
+    io_executor = get_executor("io")
+    writer = contextlib.ExitStack()
+    f = await io_executor.run(
+        writer.enter_context,
+        storage.open_write(bucket, key),
+        admitted=admitted,
+    )
+    write = metrics.timed("storage.write", f.write)
+    try:
+        while chunk := await tar.read():
+            await io_executor.run(write, chunk, admitted=True)
+    except BaseException as e:
+        # aborts the write, the previous file is kept
+        await io_executor.run(
+            writer.__exit__, type(e), e, e.__traceback__, admitted=True
+        )
+        raise
+    await io_executor.run(metrics.timed("storage.commit", writer.close), admitted=True)
+
+
+def read_exactly(
+    storage: Storage, bucket: str, file: FileData
+) -> Generator[bytes, None, None]:
+    """
+    Read a listed file in chunks, failing if it got shorter since listed, as
+    its size is already sent in the archive.
+    """
+    remaining = file.size
+    with storage.open_read(bucket, file.key) as f:
+        while remaining > 0:
+            chunk = f.read(min(CHUNK_SIZE, remaining))
+            if not chunk:
+                raise IOError(f"File {file.key} changed while archiving")
+            remaining -= len(chunk)
+            yield chunk
+
+
+def iter_tar(
+    storage: Storage, bucket: str, files: Iterable[FileData]
+) -> Generator[bytes, None, None]:
+    """
+    Stream a tar of the files, read one by one.
+    """
+    for file in files:
+        info = tarfile.TarInfo(file.key)
+        info.size = file.size
+        info.mtime = int(file.last_modified.timestamp())
+        info.mode = 0o644
+        yield info.tobuf(format=tarfile.PAX_FORMAT)
+        yield from read_exactly(storage, bucket, file)
+        padding = -file.size % tarfile.BLOCKSIZE
+        if padding:
+            yield tarfile.NUL * padding
+    # end of archive
+    yield tarfile.NUL * (tarfile.BLOCKSIZE * 2)
+
+
+class ChunkSink:
+    """
+    Write only file object keeping what is written until drained.
+    """
+
+    def __init__(self):
+        self.chunks: list[bytes] = []
+
+    def write(self, data: bytes) -> int:
+        self.chunks.append(bytes(data))
+        return len(data)
+
+    def flush(self) -> None:
+        pass
+
+    def drain(self) -> Generator[bytes, None, None]:
+        chunks, self.chunks = self.chunks, []
+        yield from chunks
+
+
+def iter_zip(
+    storage: Storage, bucket: str, files: Iterable[FileData]
+) -> Generator[bytes, None, None]:
+    """
+    Stream a zip of the files, read one by one. Files are stored, not
+    compressed, as most assets already are.
+    """
+    sink = ChunkSink()
+    with zipfile.ZipFile(sink, mode="w", compression=zipfile.ZIP_STORED) as archive:
+        for file in files:
+            date_time = time.gmtime(file.last_modified.timestamp())[:6]
+            info = zipfile.ZipInfo(file.key, date_time=max(date_time, (1980, 1, 1)))
+            info.file_size = file.size
+            with archive.open(info, mode="w", force_zip64=True) as dest:
+                for chunk in read_exactly(storage, bucket, file):
+                    dest.write(chunk)
+                    yield from sink.drain()
+            yield from sink.drain()
+    yield from sink.drain()
+
+
+def archive_files(
+    listing: Iterable[FileData | str],
+) -> Generator[FileData, None, None]:
+    """
+    The files of a listing, without common prefixes.
+    """
+    return (entry for entry in listing if isinstance(entry, FileData))
+
+
+ARCHIVE_WRITERS = {
+    "tar": iter_tar,
+    "zip": iter_zip,
+}
@@ -0,0 +1,109 @@
+"""
+Conditional request helpers: ETags, HTTP dates and the RFC 7232 checks.
+
+All of them work only with the FileData from Storage.stat, so the decision to
+answer 304 can be made before opening or transforming the file.
+"""
+
+import hashlib
+from datetime import datetime
+from email.utils import format_datetime, parsedate_to_datetime
+from typing import Mapping
+
+from am.storage.types import FileData
+
+
+def http_date(date: datetime) -> str:
+    """
+    Format a date as an RFC 7231 HTTP-date, as `Sun, 06 Nov 1994 08:49:37 GMT`.
+    """
+    return format_datetime(date, usegmt=True)
+
+
+def parse_http_date(value: str) -> datetime | None:
+    """
+    Parse an HTTP-date, returning None if it is not valid.
+    """
+    try:
+        date = parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return None
+    if date.tzinfo is None:
+        return None
+    return date
+
+
+def make_etag(stat: FileData, variant: str | None = None) -> str:
+    """
+    Get the ETag of a file, or of a variant of it, as a transform.
+
+    If the storage knows the content hash, it is a strong ETag. Otherwise it is
+    a weak ETag from the size and modification time. Variants are always weak,
+    as the same transform may encode to different bytes across versions.
+    """
+    if stat.etag:
+        tag = stat.etag
+        weak = False
+    else:
+        mtime = int(stat.last_modified.timestamp() * 1_000_000)
+        tag = f"{stat.size:x}-{mtime:x}"
+        weak = True
+    if variant:
+        tag += "-" + hashlib.sha256(variant.encode("utf-8")).hexdigest()[:16]
+        weak = True
+    return f'W/"{tag}"' if weak else f'"{tag}"'
+
+
+def parse_etags(value: str) -> list[str]:
+    """
+    Parse an If-Match / If-None-Match list of entity tags.
+    """
+    return [etag.strip() for etag in value.split(",") if etag.strip()]
+
+
+def weak_match(a: str, b: str) -> bool:
+    return a.removeprefix("W/") == b.removeprefix("W/")
+
+
+def is_not_modified(
+    headers: Mapping[str, str], etag: str, last_modified: datetime
+) -> bool:
+    """
+    Check If-None-Match and If-Modified-Since, returning True if a 304 should be
+    sent.
+
+    If-None-Match uses weak comparison and, when present, If-Modified-Since is
+    ignored, as per RFC 7232 section 6.
+    """
+    if_none_match = headers.get("if-none-match")
+    if if_none_match is not None:
+        etags = parse_etags(if_none_match)
+        return "*" in etags or any(weak_match(etag, other) for other in etags)
+
+    if_modified_since = headers.get("if-modified-since")
+    if if_modified_since is not None:
+        since = parse_http_date(if_modified_since)
+        if since is None:
+            return False
+        # HTTP dates have second precision
+        return last_modified.replace(microsecond=0) <= since
+    return False
+
+
+def if_range_matches(
+    headers: Mapping[str, str], etag: str, last_modified: datetime
+) -> bool:
+    """
+    Check If-Range, returning True if the Range header should be honoured.
+
+    ETags must match strongly, so weak ETags never match. Dates must match
+    exactly.
+    """
+    if_range = headers.get("if-range")
+    if if_range is None:
+        return True
+    if_range = if_range.strip()
+    if if_range.startswith('"') or if_range.startswith("W/"):
+        return not etag.startswith("W/") and if_range == etag
+    date = parse_http_date(if_range)
+    return date is not None and date == last_modified.replace(microsecond=0)
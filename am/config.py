@@ -17,6 +17,94 @@ class StorageConfig:
         )
 
 
+@dataclass
+class BucketConfig:
+    name: str
+    storage: str = "default"
+    cache_control: str | None = None
+    # preset name -> transform spec, as "resize width=200 height=200"
+    renditions: dict[str, str | dict] = field(default_factory=dict)
+
+    @classmethod
+    def from_dict(cls, config: dict):
+        return cls(
+            name=config["name"],
+            storage=config.get("storage", "default"),
+            cache_control=config.get("cache_control"),
+            renditions=config.get("renditions", {}),
+        )
+
+
+@dataclass
+class ExecutorConfig:
+    type: str = "thread"
+    # 0 means one per CPU
+    workers: int = 0
+    max_pending: int = 64
+    # seconds, sent as Retry-After when the executor is busy
+    retry_after: int = 1
+
+    def update_from_dict(self, config: dict):
+        if "type" in config:
+            self.type = config["type"]
+        if "workers" in config:
+            self.workers = config["workers"]
+        if "max_pending" in config:
+            self.max_pending = config["max_pending"]
+        if "retry_after" in config:
+            self.retry_after = config["retry_after"]
+
+
+def default_executors() -> dict[str, ExecutorConfig]:
+    return {
+        "io": ExecutorConfig(type="thread", workers=32, max_pending=256),
+        "transform": ExecutorConfig(type="process", workers=0, max_pending=64),
+    }
+
+
+@dataclass
+class DatabaseConfig:
+    url: str = "sqlite://data/database.db"
+
+    def update_from_dict(self, config: dict):
+        if "url" in config:
+            self.url = config["url"]
+
+
+@dataclass
+class HotCacheConfig:
+    # bytes, 0 to disable
+    max_size: int = 64 * 1024 * 1024
+    # files up to this size are cached
+    max_object_size: int = 64 * 1024
+    # seconds before checking a cached file against the storage again
+    ttl: float = 1.0
+
+    def update_from_dict(self, config: dict):
+        if "max_size" in config:
+            self.max_size = config["max_size"]
+        if "max_object_size" in config:
+            self.max_object_size = config["max_object_size"]
+        if "ttl" in config:
+            self.ttl = config["ttl"]
+
+
+@dataclass
+class MetricsConfig:
+    enabled: bool = True
+    path: str = "/metrics"
+    # seconds, requests slower than this are logged with their stages
+    slow_request: float | None = 1.0
+
+    def update_from_dict(self, config: dict):
+        if "enabled" in config:
+            self.enabled = config["enabled"]
+        if "path" in config:
+            self.path = config["path"]
+        if "slow_request" in config:
+            self.slow_request = config["slow_request"]
+
+
 @dataclass
 class ServerConfig:
     host: str = "0.0.0.0"
@@ -24,6 +112,28 @@ class ServerConfig:
     reload: bool = False
     allow_origins: list[str] = field(default_factory=lambda: ["*"])
     enable_web_ui: bool = True
+    # seconds between checks for config changes, 0 to disable
+    config_reload_interval: float = 0
+    # bytes, None for no limit
+    max_upload_size: int | None = None
+    # threads generating renditions after uploads
+    rendition_workers: int = 2
+    # seconds to wait for a transform, shared by identical concurrent requests
+    transform_timeout: float = 30
+    # output formats chosen by Accept for transforms without one, preferred first
+    negotiated_formats: list[str] = field(default_factory=lambda: ["avif", "webp"])
+    # server processes, 0 for one per CPU
+    workers: int = 1
+    # each worker binds its own socket with SO_REUSEPORT
+    reuse_port: bool = False
+    # requests after which a worker is recycled, 0 for no limit
+    max_requests: int = 0
+    # random extra requests, so workers are not all recycled at once
+    max_requests_jitter: int = 0
+    # bytes of RSS over which a worker is recycled, 0 for no limit
+    max_worker_rss: int = 0
+    # seconds to finish the requests in progress on shutdown
+    graceful_timeout: float = 30
 
     def update_from_dict(self, config: dict):
         if "host" in config:
@@ -36,12 +146,39 @@ class ServerConfig:
             self.allow_origins = config["allow_origins"]
         if "enable_web_ui" in config:
             self.enable_web_ui = config["enable_web_ui"]
+        if "config_reload_interval" in config:
+            self.config_reload_interval = config["config_reload_interval"]
+        if "max_upload_size" in config:
+            self.max_upload_size = config["max_upload_size"]
+        if "rendition_workers" in config:
+            self.rendition_workers = config["rendition_workers"]
+        if "transform_timeout" in config:
+            self.transform_timeout = config["transform_timeout"]
+        if "negotiated_formats" in config:
+            self.negotiated_formats = config["negotiated_formats"]
+        if "workers" in config:
+            self.workers = config["workers"]
+        if "reuse_port" in config:
+            self.reuse_port = config["reuse_port"]
+        if "max_requests" in config:
+            self.max_requests = config["max_requests"]
+        if "max_requests_jitter" in config:
+            self.max_requests_jitter = config["max_requests_jitter"]
+        if "max_worker_rss" in config:
+            self.max_worker_rss = config["max_worker_rss"]
+        if "graceful_timeout" in config:
+            self.graceful_timeout = config["graceful_timeout"]
 
 
 @dataclass
 class Config:
     server: ServerConfig = field(default_factory=ServerConfig)
     storage: dict[str, StorageConfig] = field(default_factory=dict)
+    buckets: dict[str, BucketConfig] = field(default_factory=dict)
+    executors: dict[str, ExecutorConfig] = field(default_factory=default_executors)
+    database: DatabaseConfig = field(default_factory=DatabaseConfig)
+    hot_cache: HotCacheConfig = field(default_factory=HotCacheConfig)
+    metrics: MetricsConfig = field(default_factory=MetricsConfig)
 
     def update_from_dict(self, update: dict):
         if "server" in update:
@@ -49,6 +186,30 @@ class Config:
         if "storage" in update:
             for config in update["storage"]:
                 self.storage[config["name"]] = StorageConfig.from_dict(config)
+        if "buckets" in update:
+            for config in update["buckets"]:
+                self.buckets[config["name"]] = BucketConfig.from_dict(config)
+        if "database" in update:
+            self.database.update_from_dict(update["database"])
+        if "hot_cache" in update:
+            self.hot_cache.update_from_dict(update["hot_cache"])
+        if "metrics" in update:
+            self.metrics.update_from_dict(update["metrics"])
+        if "executors" in update:
+            for name, config in update["executors"].items():
+                self.executors.setdefault(name, ExecutorConfig())
+                self.executors[name].update_from_dict(config)
+
+    def bucket(self, name: str) -> BucketConfig:
+        """
+        Get the config of a bucket. Buckets not in the config use the one named
+        "*", if any.
+        """
+        if name in self.buckets:
+            return self.buckets[name]
+        if "*" in self.buckets:
+            return self.buckets["*"]
+        return BucketConfig(name=name)
 
 
 config = Config()
@@ -61,3 +222,16 @@ def load_config(path: str) -> dict:
     with open(path, "r", encoding="utf-8") as f:
         update = yaml.safe_load(f)
     config.update_from_dict(update)
+
+
+def reload_config(path: str) -> None:
+    """
+    Reload the storage and buckets config from the given path.
+
+    Server and executor settings only apply on restart.
+    """
+    new_config = Config()
+    with open(path, "r", encoding="utf-8") as f:
+        new_config.update_from_dict(yaml.safe_load(f))
+    config.storage = new_config.storage
+    config.buckets = new_config.buckets
@@ -0,0 +1,213 @@
+"""
+Bounded executors to run blocking work out of the event loop.
+
+There are two by default:
+
+- io: a thread pool for storage calls.
+- transform: a process pool for Transform.apply, so image work runs in
+  parallel on several cores and never competes with plain file serving.
+
+Each executor has a limit of pending jobs (running plus queued). Once reached
+new requests are rejected with ExecutorBusyError, which the server turns into
+a 503 with Retry-After, instead of queueing without bound.
+"""
+
+import asyncio
+import contextvars
+import logging
+import os
+import threading
+from concurrent.futures import Executor, Future, ProcessPoolExecutor, ThreadPoolExecutor
+from typing import AsyncGenerator, Callable, Iterable
+
+from am import metrics
+from am.config import ExecutorConfig, config
+
+logger = logging.getLogger(__name__)
+
+
+class ExecutorBusyError(Exception):
+    """
+    ExecutorBusyError is raised when an executor has too many pending jobs.
+    """
+
+    def __init__(self, name: str, retry_after: int):
+        super().__init__(f"Executor {name} is busy")
+        self.name = name
+        self.retry_after = retry_after
+
+
+class BoundedExecutor:
+    """
+    Executor wrapper with a limit on the pending jobs.
+    """
+
+    def __init__(
+        self, name: str, executor: Executor, max_pending: int, retry_after: int
+    ):
+        self.name = name
+        self.executor = executor
+        self.max_pending = max_pending
+        self.retry_after = retry_after
+        self.pending = 0
+        self.lock = threading.Lock()
+
+    def submit(self, fn: Callable, *args, admitted: bool = False, **kwargs) -> Future:
+        """
+        Submit a job, raising ExecutorBusyError if there are too many pending.
+
+        Follow up jobs of an already admitted request, as the writes of an
+        upload, pass admitted=True so they are never rejected halfway.
+        """
+        with self.lock:
+            if not admitted and self.pending >= self.max_pending:
+                REJECTED.inc(executor=self.name)
+                raise ExecutorBusyError(self.name, self.retry_after)
+            self.pending += 1
+        try:
+            if isinstance(self.executor, ThreadPoolExecutor):
+                # keep the context, as the trace_id, in the worker thread
+                context = contextvars.copy_context()
+                future = self.executor.submit(context.run, fn, *args, **kwargs)
+            else:
+                future = self.executor.submit(fn, *args, **kwargs)
+        except BaseException:
+            self.done()
+            raise
+        future.add_done_callback(lambda _: self.done())
+        return future
+
+    def done(self) -> None:
+        with self.lock:
+            self.pending -= 1
+
+    async def run(self, fn: Callable, *args, admitted: bool = False, **kwargs):
+        """
+        Run a job and wait for its result without blocking the event loop.
+        """
+        future = self.submit(fn, *args, admitted=admitted, **kwargs)
+        return await asyncio.wrap_future(future)
+
+    async def iterate(self, iterable: Iterable) -> AsyncGenerator:
+        """
+        Iterate a blocking iterable, as the chunks of a file, running each step
+        as an admitted job, so streamed responses read in the bounded executor
+        and not in the default threadpool. Only for thread executors.
+
+        If the iteration is cancelled, a generator is closed once its running
+        step is done, so its files are closed in the executor.
+        """
+        iterator = iter(iterable)
+        end = object()
+        future = None
+        finished = False
+        try:
+            while True:
+                future = self.submit(next, iterator, end, admitted=True)
+                try:
+                    item = await asyncio.wrap_future(future)
+                except Exception:
+                    # raised by the iterator, which is done
+                    finished = True
+                    raise
+                if item is end:
+                    finished = True
+                    return
+                yield item
+        finally:
+            close = getattr(iterator, "close", None)
+            if not finished and close is not None and future is not None:
+                future.add_done_callback(lambda _: self.close_later(close))
+
+    def close_later(self, close: Callable[[], None]) -> None:
+        try:
+            self.submit(close, admitted=True)
+        except RuntimeError:
+            # shutting down, close it here
+            close()
+
+    def shutdown(self) -> None:
+        self.executor.shutdown(wait=True, cancel_futures=True)
+
+
+def create_executor(name: str, executor_config: ExecutorConfig) -> BoundedExecutor:
+    """
+    Create an executor from the config.
+    """
+    workers = executor_config.workers or os.cpu_count() or 1
+    logger.debug(
+        "Creating executor=%s type=%s workers=%s max_pending=%s",
+        name,
+        executor_config.type,
+        workers,
+        executor_config.max_pending,
+    )
+    if executor_config.type == "thread":
+        executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix=name)
+    elif executor_config.type == "process":
+        executor = ProcessPoolExecutor(max_workers=workers)
+    else:
+        raise ValueError(f"Unknown executor type: {executor_config.type}")
+    return BoundedExecutor(
+        name,
+        executor,
+        max_pending=executor_config.max_pending,
+        retry_after=executor_config.retry_after,
+    )
+
+
+_executors: dict[str, BoundedExecutor] = {}
+_executors_lock = threading.Lock()
+
+REJECTED = metrics.registry.register(
+    metrics.Counter(
+        "am_executor_rejected_total",
+        "Jobs rejected because the executor was busy.",
+        ["executor"],
+    )
+)
+metrics.registry.register(
+    metrics.CallbackMetric(
+        "am_executor_pending",
+        "Pending jobs of the executor, running plus queued.",
+        "gauge",
+        lambda: (
+            ({"executor": name}, executor.pending)
+            for name, executor in list(_executors.items())
+        ),
+    )
+)
+metrics.registry.register(
+    metrics.CallbackMetric(
+        "am_executor_max_pending",
+        "Pending jobs above which the executor rejects new ones.",
+        "gauge",
+        lambda: (
+            ({"executor": name}, executor.max_pending)
+            for name, executor in list(_executors.items())
+        ),
+    )
+)
+
+
+def get_executor(name: str) -> BoundedExecutor:
+    """
+    Get an executor by name, creating it on first use.
+    """
+    with _executors_lock:
+        if name not in _executors:
+            executor_config = config.executors.get(name)
+            if executor_config is None:
+                raise ValueError(f"Executor {name} not found")
+            _executors[name] = create_executor(name, executor_config)
+        return _executors[name]
+
+
+def shutdown_executors() -> None:
+    """
+    Shutdown all the executors, waiting for the running jobs.
+    """
+    with _executors_lock:
+        for executor in _executors.values():
+            executor.shutdown()
+        _executors.clear()
@@ -0,0 +1,112 @@
+"""
+In-process cache of small, frequently requested files.
+
+Small assets, as CSS, JS and icons, are most of the requests. Their content,
+stat and response headers are kept in memory, so serving them needs no
+storage call at all. Entries are checked against the storage stat once their
+ttl expires, and dropped on the change events of their file.
+
+It is configured at the `hot_cache` section of the config, and disabled with
+`max_size: 0`.
+"""
+
+import threading
+import time
+from dataclasses import dataclass
+
+from am import metrics
+from am.config import config
+from am.lru import SizedLRU
+from am.storage import events
+from am.storage.types import FileData
+
+
+@dataclass
+class HotObject:
+    """
+    HotObject is a cached file, ready to be sent.
+    """
+
+    stat: FileData
+    content: bytes
+    headers: dict[str, str]
+    # monotonic time it was last checked against the storage
+    checked: float
+
+
+class HotObjectCache:
+    """
+    Size bounded LRU of small files, by storage, bucket and key.
+    """
+
+    def __init__(self, max_size: int, max_object_size: int, ttl: float):
+        self.max_object_size = max_object_size
+        self.ttl = ttl
+        self.objects = SizedLRU(max_size, size=lambda hot: len(hot.content))
+
+    def get(self, storage: str, bucket: str, key: str) -> HotObject | None:
+        return self.objects.get((storage, bucket, key))
+
+    def is_fresh(self, hot: HotObject) -> bool:
+        return time.monotonic() - hot.checked < self.ttl
+
+    def accepts(self, stat: FileData) -> bool:
+        return stat.size <= self.max_object_size
+
+    def put(
+        self,
+        storage: str,
+        bucket: str,
+        stat: FileData,
+        content: bytes,
+        headers: dict[str, str],
+    ) -> None:
+        self.objects.put(
+            (storage, bucket, stat.key),
+            HotObject(stat, content, headers, time.monotonic()),
+        )
+
+    def refresh(self, hot: HotObject, headers: dict[str, str]) -> None:
+        """
+        Mark an object as checked now, updating its headers.
+        """
+        hot.headers = headers
+        hot.checked = time.monotonic()
+
+    def invalidate(self, storage: str, bucket: str, key: str | None = None) -> None:
+        if key is not None:
+            self.objects.pop((storage, bucket, key))
+        else:
+            self.objects.pop_matching(lambda k: k[0] == storage and k[1] == bucket)
+
+
+_cache: HotObjectCache | None = None
+_cache_lock = threading.Lock()
+
+
+def get_hot_cache() -> HotObjectCache | None:
+    """
+    Get the hot object cache, or None if it is disabled.
+    """
+    global _cache
+    if config.hot_cache.max_size <= 0:
+        return None
+    with _cache_lock:
+        if _cache is None:
+            _cache = HotObjectCache(
+                max_size=config.hot_cache.max_size,
+                max_object_size=config.hot_cache.max_object_size,
+                ttl=config.hot_cache.ttl,
+            )
+        return _cache
+
+
+@events.on_change
+def _invalidate_on_change(storage_name: str, bucket: str, key: str | None) -> None:
+    if _cache is not None:
+        _cache.invalidate(storage_name, bucket, key)
+
+
+metrics.cache_metrics(
+    "hot_cache", lambda: [("hot", _cache.objects)] if _cache is not None else []
+)
@@ -0,0 +1,74 @@
+"""
+Size bounded in-memory LRU cache.
+"""
+
+import threading
+from collections import OrderedDict
+from typing import Any, Callable, Hashable
+
+
+class SizedLRU:
+    """
+    Thread safe LRU cache bounded by the total size of its values, as given by
+    the size function, len by default.
+    """
+
+    def __init__(self, max_size: int, size: Callable[[Any], int] = len):
+        self.max_size = max_size
+        self.sizeof = size
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.entries: OrderedDict[Hashable, tuple[Any, int]] = OrderedDict()
+        self.lock = threading.Lock()
+
+    def __len__(self) -> int:
+        return len(self.entries)
+
+    def get(self, key: Hashable) -> Any | None:
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return entry[0]
+
+    def put(self, key: Hashable, value: Any) -> None:
+        """
+        Store a value, evicting the least recently used ones to make room.
+        Values larger than the whole cache are not stored.
+        """
+        size = self.sizeof(value)
+        with self.lock:
+            self.remove(key)
+            if size > self.max_size:
+                return
+            self.entries[key] = (value, size)
+            self.size += size
+            while self.size > self.max_size:
+                _, (_, evicted) = self.entries.popitem(last=False)
+                self.size -= evicted
+
+    def pop(self, key: Hashable) -> None:
+        with self.lock:
+            self.remove(key)
+
+    def pop_matching(self, match: Callable[[Hashable], bool]) -> None:
+        """
+        Remove all the entries whose key matches.
+        """
+        with self.lock:
+            for key in [key for key in self.entries if match(key)]:
+                self.remove(key)
+
+    def clear(self) -> None:
+        with self.lock:
+            self.entries.clear()
+            self.size = 0
+
+    def remove(self, key: Hashable) -> None:
+        entry = self.entries.pop(key, None)
+        if entry is not None:
+            self.size -= entry[1]
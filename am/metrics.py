@@ -0,0 +1,455 @@
+"""
+Prometheus style metrics and per-stage timing of requests.
+
+Metrics are kept in process and exposed in the Prometheus text format at
+`/metrics`. With several server processes each one has its own.
+
+Besides the request metrics, the work of a request is timed by stages, as
+the storage stat and read or the decode, transform and encode of an image:
+
+    with metrics.stage("storage.stat"):
+        stat = storage.stat(bucket, key)
+
+Each stage is observed at the `am_stage_duration_seconds` histogram and
+added to the spans of the current request, which are logged with its
+trace_id once it ends, so a slow request can be broken down stage by stage.
+"""
+
+import bisect
+import contextlib
+import contextvars
+import logging
+import math
+import threading
+import time
+from typing import Callable, Iterable
+
+from starlette.types import ASGIApp, Message, Receive, Scope, Send
+
+from am.config import config
+
+logger = logging.getLogger(__name__)
+
+# seconds
+DEFAULT_BUCKETS = (
+    0.001,
+    0.0025,
+    0.005,
+    0.01,
+    0.025,
+    0.05,
+    0.1,
+    0.25,
+    0.5,
+    1,
+    2.5,
+    5,
+    10,
+)
+
+type Labels = tuple[str, ...]
+type Sample = tuple[str, dict[str, str], float]
+
+
+def format_value(value: float) -> str:
+    if value == math.inf:
+        return "+Inf"
+    if float(value).is_integer():
+        return str(int(value))
+    return repr(float(value))
+
+
+def escape(value: str) -> str:
+    return value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def format_labels(labels: dict[str, str]) -> str:
+    if not labels:
+        return ""
+    pairs = (f'{name}="{escape(str(value))}"' for name, value in labels.items())
+    return "{" + ",".join(pairs) + "}"
+
+
+class Metric:
+    """
+    Metric is the base class of all metrics, a family of samples by labels.
+    """
+
+    type = "untyped"
+
+    def __init__(self, name: str, help: str, labels: Iterable[str] = ()):
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        self.lock = threading.Lock()
+
+    def label_values(self, labels: dict[str, str]) -> Labels:
+        if set(labels) != set(self.labels):
+            raise ValueError(f"Metric {self.name} has labels {self.labels}")
+        return tuple(str(labels[name]) for name in self.labels)
+
+    def samples(self) -> Iterable[Sample]:
+        return []
+
+    def render(self) -> str:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.type}"]
+        for name, labels, value in self.samples():
+            lines.append(f"{name}{format_labels(labels)} {format_value(value)}")
+        return "\n".join(lines)
+
+
+class Counter(Metric):
+    """
+    Counter is a value that only goes up.
+    """
+
+    type = "counter"
+
+    def __init__(self, name: str, help: str, labels: Iterable[str] = ()):
+        super().__init__(name, help, labels)
+        self.values: dict[Labels, float] = {}
+
+    def inc(self, amount: float = 1, **labels: str) -> None:
+        key = self.label_values(labels)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+    def get(self, **labels: str) -> float:
+        return self.values.get(self.label_values(labels), 0)
+
+    def samples(self) -> Iterable[Sample]:
+        with self.lock:
+            values = list(self.values.items())
+        for key, value in values:
+            yield self.name, dict(zip(self.labels, key)), value
+
+
+class Histogram(Metric):
+    """
+    Histogram counts observations by buckets of their value.
+    """
+
+    type = "histogram"
+
+    def __init__(
+        self,
+        name: str,
+        help: str,
+        labels: Iterable[str] = (),
+        buckets: Iterable[float] = DEFAULT_BUCKETS,
+    ):
+        super().__init__(name, help, labels)
+        self.buckets = sorted(buckets)
+        # labels -> (counts by bucket, plus the +Inf one, sum)
+        self.values: dict[Labels, tuple[list[int], float]] = {}
+
+    def observe(self, value: float, **labels: str) -> None:
+        key = self.label_values(labels)
+        index = bisect.bisect_left(self.buckets, value)
+        with self.lock:
+            counts, total = self.values.get(key) or ([0] * (len(self.buckets) + 1), 0)
+            counts[index] += 1
+            self.values[key] = (counts, total + value)
+
+    def count(self, **labels: str) -> int:
+        counts, _ = self.values.get(self.label_values(labels), ([], 0))
+        return sum(counts)
+
+    def samples(self) -> Iterable[Sample]:
+        with self.lock:
+            values = [
+                (key, list(counts), total)
+                for key, (counts, total) in self.values.items()
+            ]
+        for key, counts, total in values:
+            labels = dict(zip(self.labels, key))
+            cumulative = 0
+            for bound, count in zip([*self.buckets, math.inf], counts):
+                cumulative += count
+                yield (
+                    f"{self.name}_bucket",
+                    {**labels, "le": format_value(bound)},
+                    cumulative,
+                )
+            yield f"{self.name}_sum", labels, total
+            yield f"{self.name}_count", labels, cumulative
+
+
+class CallbackMetric(Metric):
+    """
+    CallbackMetric is read from the state of the application on collect, as
+    the pending jobs of an executor or the hits of a cache. The callback
+    yields (labels, value) pairs.
+    """
+
+    def __init__(
+        self,
+        name: str,
+        help: str,
+        type: str,
+        callback: Callable[[], Iterable[tuple[dict[str, str], float]]],
+    ):
+        super().__init__(name, help)
+        self.type = type
+        self.callback = callback
+
+    def samples(self) -> Iterable[Sample]:
+        for labels, value in self.callback():
+            yield self.name, labels, value
+
+
+class Registry:
+    """
+    Registry keeps the metrics to expose.
+    """
+
+    def __init__(self):
+        self.metrics: dict[str, Metric] = {}
+        self.lock = threading.Lock()
+
+    def register(self, metric: Metric) -> Metric:
+        with self.lock:
+            if metric.name in self.metrics:
+                raise ValueError(f"Metric {metric.name} already registered")
+            self.metrics[metric.name] = metric
+        return metric
+
+    def render(self) -> str:
+        with self.lock:
+            metrics = list(self.metrics.values())
+        parts = []
+        for metric in metrics:
+            try:
+                parts.append(metric.render())
+            except Exception:
+                logger.exception("Error collecting metric=%s", metric.name)
+        return "\n".join(parts) + "\n"
+
+
+registry = Registry()
+
+REQUESTS = registry.register(
+    Counter(
+        "am_http_requests_total",
+        "HTTP requests by route and status.",
+        ["method", "route", "status"],
+    )
+)
+REQUEST_SECONDS = registry.register(
+    Histogram(
+        "am_http_request_duration_seconds",
+        "HTTP request latency by route, until the last byte is sent.",
+        ["method", "route"],
+    )
+)
+RECEIVED_BYTES = registry.register(
+    Counter(
+        "am_http_received_bytes_total",
+        "Bytes of request bodies by route.",
+        ["method", "route"],
+    )
+)
+SENT_BYTES = registry.register(
+    Counter(
+        "am_http_sent_bytes_total",
+        "Bytes of response bodies by route.",
+        ["method", "route"],
+    )
+)
+STAGE_SECONDS = registry.register(
+    Histogram(
+        "am_stage_duration_seconds",
+        "Time spent at each stage of the requests, as storage calls and "
+        "image decode, transform and encode.",
+        ["stage"],
+    )
+)
+
+
+def cache_metrics(cache: str, collect: Callable[[], Iterable[tuple[str, object]]]):
+    """
+    Register the hit and miss counters of a kind of cache. collect yields
+    (name, cache) pairs, the caches having hits and misses attributes.
+    """
+    registry.register(
+        CallbackMetric(
+            f"am_{cache}_hits_total",
+            f"Hits of the {cache.replace('_', ' ')}.",
+            "counter",
+            lambda: (({"name": name}, cache.hits) for name, cache in collect()),
+        )
+    )
+    registry.register(
+        CallbackMetric(
+            f"am_{cache}_misses_total",
+            f"Misses of the {cache.replace('_', ' ')}.",
+            "counter",
+            lambda: (({"name": name}, cache.misses) for name, cache in collect()),
+        )
+    )
+
+
+class Trace:
+    """
+    Trace keeps the stages, (name, seconds), of a request.
+
+    When deferred the stages are only kept, not observed, as for the work
+    done in another process, where observed metrics would be lost.
+    """
+
+    def __init__(self, deferred: bool = False):
+        self.spans: list[tuple[str, float]] = []
+        self.deferred = deferred
+
+    def summary(self) -> str:
+        """
+        Total time by stage, in the order they started, as
+        `storage.stat=0.2ms storage.write=12.5ms(x8)`.
+        """
+        totals: dict[str, list] = {}
+        for name, seconds in list(self.spans):
+            total = totals.setdefault(name, [0.0, 0])
+            total[0] += seconds
+            total[1] += 1
+        return " ".join(
+            f"{name}={seconds * 1000:.1f}ms" + (f"(x{count})" if count > 1 else "")
+            for name, (seconds, count) in totals.items()
+        )
+
+
+trace_var: contextvars.ContextVar[Trace | None] = contextvars.ContextVar(
+    "trace", default=None
+)
+
+
+def record_stage(name: str, seconds: float) -> None:
+    """
+    Record a stage of the current request, if any.
+    """
+    trace = trace_var.get()
+    if trace is None or not trace.deferred:
+        STAGE_SECONDS.observe(seconds, stage=name)
+    if trace is not None:
+        trace.spans.append((name, seconds))
+
+
+@contextlib.contextmanager
+def stage(name: str):
+    """
+    Time the block as a stage of the current request.
+    """
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        record_stage(name, time.perf_counter() - start)
+
+
+def timed(name: str, fn: Callable) -> Callable:
+    """
+    Wrap fn to time its calls as a stage, as for the jobs of an executor.
+    """
+
+    def wrapper(*args, **kwargs):
+        with stage(name):
+            return fn(*args, **kwargs)
+
+    return wrapper
+
+
+def collect_stages(fn: Callable, *args, **kwargs) -> tuple[object, list]:
+    """
+    Call fn and return its result with the stages it recorded, so work done in
+    another process can be recorded back with record_stages.
+
+    It is a plain function, so it can run in a process pool.
+    """
+    trace = Trace(deferred=True)
+    context = contextvars.copy_context()
+    context.run(trace_var.set, trace)
+    result = context.run(fn, *args, **kwargs)
+    return result, trace.spans
+
+
+def record_stages(spans: list[tuple[str, float]]) -> None:
+    for name, seconds in spans:
+        record_stage(name, seconds)
+
+
+class MetricsMiddleware:
+    """
+    ASGI middleware timing the requests until their last byte is sent and
+    counting their bytes. Requests slower than `metrics.slow_request` are
+    logged with their stages.
+    """
+
+    def __init__(self, app: ASGIApp):
+        self.app = app
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        start = time.perf_counter()
+        trace = Trace()
+        trace_var.set(trace)
+        received = 0
+        sent = 0
+        status = 500
+        # with pathsend the server sends the file itself, content-length bytes
+        content_length = 0
+
+        async def receive_counted() -> Message:
+            nonlocal received
+            message = await receive()
+            if message["type"] == "http.request":
+                received += len(message.get("body", b""))
+            return message
+
+        async def send_counted(message: Message) -> None:
+            nonlocal sent, status, content_length
+            if message["type"] == "http.response.start":
+                status = message["status"]
+                for name, value in message.get("headers", []):
+                    if name.lower() == b"content-length":
+                        content_length = int(value)
+            elif message["type"] == "http.response.body":
+                sent += len(message.get("body", b""))
+            elif message["type"] == "http.response.pathsend":
+                sent += content_length
+            await send(message)
+
+        try:
+            await self.app(scope, receive_counted, send_counted)
+        finally:
+            seconds = time.perf_counter() - start
+            route = scope.get("route")
+            labels = {
+                "method": scope["method"],
+                "route": getattr(route, "path", "unmatched"),
+            }
+            REQUESTS.inc(**labels, status=str(status))
+            REQUEST_SECONDS.observe(seconds, **labels)
+            RECEIVED_BYTES.inc(received, **labels)
+            SENT_BYTES.inc(sent, **labels)
+            slow_request = config.metrics.slow_request
+            if slow_request is not None and seconds >= slow_request:
+                logger.warning(
+                    "Slow request: method=%s path=%s status=%s duration=%.1fms %s",
+                    scope["method"],
+                    scope["path"],
+                    status,
+                    seconds * 1000,
+                    trace.summary(),
+                )
+            else:
+                logger.debug(
+                    "Request done: method=%s path=%s status=%s duration=%.1fms %s",
+                    scope["method"],
+                    scope["path"],
+                    status,
+                    seconds * 1000,
+                    trace.summary(),
+                )
+            trace_var.set(None)
@@ -0,0 +1,82 @@
+"""
+Content negotiation of the output image format from the Accept header.
+
+Transforms without an explicit format, or with format=auto, are encoded in the
+best format the client lists in Accept, as AVIF or WebP, and otherwise in a
+format close to the source. Responses that depend on it carry Vary: Accept.
+"""
+
+from PIL import features
+
+FORMAT_MEDIA_TYPES = {
+    "avif": "image/avif",
+    "webp": "image/webp",
+    "jpeg": "image/jpeg",
+    "jpg": "image/jpeg",
+    "png": "image/png",
+    "gif": "image/gif",
+}
+
+# formats kept as they are when the client does not accept a better one
+SOURCE_FORMATS = {"image/jpeg": "jpeg", "image/png": "png"}
+
+
+def parse_accept(header: str | None) -> dict[str, float]:
+    """
+    Parse an Accept header into media ranges and their q values.
+    """
+    accepted = {}
+    if not header:
+        return accepted
+    for item in header.split(","):
+        media_range, *params = item.split(";")
+        media_range = media_range.strip().lower()
+        if not media_range:
+            continue
+        q = 1.0
+        for param in params:
+            name, _, value = param.strip().partition("=")
+            if name.strip().lower() == "q":
+                try:
+                    q = float(value)
+                except ValueError:
+                    q = 0.0
+        accepted[media_range] = q
+    return accepted
+
+
+def supported_formats(formats: list[str]) -> list[str]:
+    """
+    Filter the formats to the ones this Pillow build can encode.
+    """
+    return [
+        format
+        for format in formats
+        if format in FORMAT_MEDIA_TYPES
+        and (format not in ("avif", "webp") or features.check(format))
+    ]
+
+
+def negotiate_format(
+    accept: str | None, source_media_type: str, formats: list[str]
+) -> str:
+    """
+    Choose the output format among formats, in order of preference.
+
+    Only formats listed explicitly in Accept are chosen, as browsers send
+    */* for any image request. Otherwise JPEG and PNG sources keep their
+    format, and anything else becomes PNG.
+    """
+    accepted = parse_accept(accept)
+    for format in supported_formats(formats):
+        if accepted.get(FORMAT_MEDIA_TYPES[format], 0) > 0:
+            return format
+    return SOURCE_FORMATS.get(source_media_type, "png")
+
+
+def output_media_type(encode_options: dict, source_media_type: str) -> str:
+    """
+    Get the media type of a transform output from its encode options.
+    """
+    format = (encode_options.get("format") or "auto").lower()
+    return FORMAT_MEDIA_TYPES.get(format, source_media_type)
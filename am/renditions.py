@@ -0,0 +1,195 @@
+"""
+Renditions: transforms generated at upload time.
+
+Each bucket can have rendition presets in the config:
+
+    buckets:
+      - name: images
+        renditions:
+          thumb: resize width=200 height=200 fit=cover format=webp
+
+After a file is written, a background worker applies every preset that fits
+its mime type and stores the result in the same bucket, under an internal key
+that is never listed. Requests for a preset are then served as a plain file.
+"""
+
+import fnmatch
+import logging
+import mimetypes
+import queue
+import threading
+
+from am.config import config
+from am.executors import get_executor
+from am.storage import events
+from am.storage.factory import registry
+from am.storage.types import (
+    INTERNAL_PREFIX,
+    FileData,
+    NoSuchFileError,
+    Storage,
+    is_internal_key,
+)
+from am.transforms.factory import factory as transforms_factory
+from am.transforms.types import Transform, run_transform, transform_source
+
+logger = logging.getLogger(__name__)
+
+RENDITIONS_PREFIX = INTERNAL_PREFIX + "renditions/"
+
+
+def rendition_key(preset: str, key: str) -> str:
+    return f"{RENDITIONS_PREFIX}{preset}/{key}"
+
+
+def parse_spec(spec: str | dict) -> tuple[str, dict]:
+    """
+    Parse a preset spec, as "resize width=200 height=200" or as a dict with the
+    transform name at "transform", into the transform name and its config.
+    """
+    if isinstance(spec, dict):
+        params = {key: str(value) for key, value in spec.items()}
+        return params.pop("transform"), params
+    name, *params = spec.split()
+    return name, dict(param.split("=", 1) for param in params)
+
+
+def bucket_presets(bucket: str) -> dict[str, Transform]:
+    """
+    Get the rendition presets of a bucket as transforms.
+    """
+    presets = {}
+    for preset, spec in config.bucket(bucket).renditions.items():
+        name, params = parse_spec(spec)
+        presets[preset] = transforms_factory.create_transform(name, params)
+    return presets
+
+
+def find_preset(bucket: str, transform: Transform) -> str | None:
+    """
+    Get the preset of the bucket that produces the same as the transform.
+    """
+    variant = transform.cache_key()
+    for preset, preset_transform in bucket_presets(bucket).items():
+        if preset_transform.cache_key() == variant:
+            return preset
+    return None
+
+
+def applies_to(transform: Transform, key: str) -> bool:
+    mime_type = mimetypes.guess_type(key)[0] or "application/octet-stream"
+    return any(
+        fnmatch.fnmatch(mime_type, pattern) for pattern in transform.for_mime_types()
+    )
+
+
+def rendition_stat(
+    storage: Storage, bucket: str, source: FileData, preset: str
+) -> FileData | None:
+    """
+    Get the stat of a stored rendition, if it exists and is not older than the
+    source.
+    """
+    try:
+        stat = storage.stat(bucket, rendition_key(preset, source.key))
+    except NoSuchFileError:
+        return None
+    if stat.last_modified < source.last_modified:
+        return None
+    return stat
+
+
+class RenditionWorker:
+    """
+    Background threads that generate the renditions of changed files.
+    """
+
+    def __init__(self, max_queued: int = 10000):
+        self.queue: queue.Queue[tuple[str, str, str] | None] = queue.Queue(
+            maxsize=max_queued
+        )
+        self.threads: list[threading.Thread] = []
+
+    def start(self, workers: int) -> None:
+        for index in range(workers):
+            thread = threading.Thread(
+                target=self.run, name=f"renditions-{index}", daemon=True
+            )
+            thread.start()
+            self.threads.append(thread)
+
+    def stop(self) -> None:
+        for _ in self.threads:
+            self.queue.put(None)
+        for thread in self.threads:
+            thread.join()
+        self.threads = []
+
+    def enqueue(self, storage_name: str, bucket: str, key: str) -> None:
+        try:
+            self.queue.put_nowait((storage_name, bucket, key))
+        except queue.Full:
+            # it is still generated on demand when requested
+            logger.warning(
+                "Renditions queue full, skipping bucket=%s key=%s", bucket, key
+            )
+
+    def run(self) -> None:
+        while True:
+            job = self.queue.get()
+            if job is None:
+                return
+            try:
+                self.process(*job)
+            except Exception:
+                logger.exception("Error generating renditions of job=%s", job)
+
+    def process(self, storage_name: str, bucket: str, key: str) -> None:
+        """
+        Generate the renditions of a file, or delete them if it is gone.
+        """
+        storage = registry.get(storage_name)
+        presets = bucket_presets(bucket)
+        try:
+            stat = storage.stat(bucket, key)
+        except NoSuchFileError:
+            for preset in presets:
+                try:
+                    storage.delete_file(bucket, rendition_key(preset, key))
+                except NoSuchFileError:
+                    pass
+            return
+
+        source = None
+        for preset, transform in presets.items():
+            if not applies_to(transform, key):
+                continue
+            if source is None:
+                source = transform_source(storage, bucket, key)
+            logger.debug(
+                "Generating rendition=%s bucket=%s key=%s", preset, bucket, key
+            )
+            content = (
+                get_executor("transform")
+                .submit(run_transform, transform, source, admitted=True)
+                .result()
+            )
+            if storage.stat(bucket, key) != stat:
+                # changed meanwhile, a new job will generate it again
+                return
+            with storage.open_write(bucket, rendition_key(preset, key)) as f:
+                f.write(content)
+
+
+worker = RenditionWorker()
+
+
+@events.on_change
+def _generate_on_change(storage_name: str, bucket: str, key: str | None) -> None:
+    if key is None or is_internal_key(key):
+        return
+    bucket_config = config.bucket(bucket)
+    # a storage can also notify the changes of the one it wraps, as tiered
+    # storages do, only the one of the bucket generates its renditions
+    if bucket_config.renditions and storage_name == bucket_config.storage:
+        worker.enqueue(storage_name, bucket, key)
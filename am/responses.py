@@ -0,0 +1,338 @@
+"""
+HTTP responses that stream files straight from a storage backend.
+
+Their bodies are sync generators, as storage reads block, and each step runs
+as a job of the io executor.
+"""
+
+import json
+import logging
+import re
+import time
+import uuid
+from typing import Any, AsyncIterator, Callable, Generator, Iterable
+
+from starlette.responses import Response, StreamingResponse
+from starlette.types import Receive, Scope, Send
+
+from am import metrics
+from am.executors import get_executor
+from am.storage.types import FileData, Storage, StorageError
+
+logger = logging.getLogger(__name__)
+
+CHUNK_SIZE = 256 * 1024
+# more ranges than this in one request are ignored and the full file is sent
+MAX_RANGES = 64
+
+RANGE_RE = re.compile(r"^\s*(\d*)\s*-\s*(\d*)\s*$")
+
+type Range = tuple[int, int]
+
+
+class RangeNotSatisfiableError(Exception):
+    """
+    RangeNotSatisfiableError is raised when none of the requested ranges
+    overlap the file.
+    """
+
+
+def parse_range_header(header: str, size: int) -> list[Range] | None:
+    """
+    Parse a `Range: bytes=...` header into a sorted list of non overlapping
+    (start, end) ranges, end exclusive.
+
+    Returns None if the header is malformed or not for bytes, in which case it
+    must be ignored and the full file sent, as per RFC 7233.
+    """
+    unit, _, spec = header.partition("=")
+    if unit.strip().lower() != "bytes" or not spec:
+        return None
+    parts = spec.split(",")
+    if len(parts) > MAX_RANGES:
+        return None
+
+    ranges = []
+    for part in parts:
+        match = RANGE_RE.match(part)
+        if not match:
+            return None
+        first, last = match.groups()
+        if not first and not last:
+            return None
+        if not first:
+            # suffix range, the last N bytes
+            suffix = int(last)
+            if suffix == 0:
+                continue
+            ranges.append((max(size - suffix, 0), size))
+            continue
+        start = int(first)
+        end = int(last) + 1 if last else size
+        if last and end <= start:
+            return None
+        if start >= size:
+            continue
+        ranges.append((start, min(end, size)))
+
+    if not ranges:
+        raise RangeNotSatisfiableError(f"Range {header} not satisfiable for {size}")
+
+    ranges.sort()
+    merged = [ranges[0]]
+    for start, end in ranges[1:]:
+        last_start, last_end = merged[-1]
+        if start <= last_end:
+            merged[-1] = (last_start, max(last_end, end))
+        else:
+            merged.append((start, end))
+    return merged
+
+
+def timed_chunks(chunks: Iterable[bytes]) -> Generator[bytes, None, None]:
+    """
+    Yield the chunks, recording the time spent reading them, and not sending
+    them, as the storage.read stage.
+    """
+    elapsed = 0.0
+    iterator = iter(chunks)
+    try:
+        while True:
+            start = time.perf_counter()
+            try:
+                chunk = next(iterator)
+            except StopIteration:
+                return
+            finally:
+                elapsed += time.perf_counter() - start
+            yield chunk
+    finally:
+        metrics.record_stage("storage.read", elapsed)
+
+
+class StorageFileResponse(StreamingResponse):
+    """
+    Streams a file from the storage in chunks, so memory use does not depend on
+    the file size.
+
+    If ranges are given, only those are sent, as a 206 response. A single range
+    is sent as is, several as `multipart/byteranges`.
+
+    If the storage can give a local path for the file and the server supports
+    the `http.response.pathsend` ASGI extension, full files are sent by the
+    server itself (normally with `sendfile`) and no data goes through Python.
+    """
+
+    def __init__(
+        self,
+        storage: Storage,
+        bucket: str,
+        stat: FileData,
+        media_type: str | None = None,
+        headers: dict[str, str] | None = None,
+        ranges: list[Range] | None = None,
+        chunk_size: int = CHUNK_SIZE,
+    ):
+        self.storage = storage
+        self.bucket = bucket
+        self.stat = stat
+        self.ranges = ranges
+        self.chunk_size = chunk_size
+        media_type = media_type or "application/octet-stream"
+
+        io_executor = get_executor("io")
+        if not ranges:
+            super().__init__(
+                io_executor.iterate(self.iter_chunks()),
+                media_type=media_type,
+                headers=headers,
+            )
+            self.headers["content-length"] = str(stat.size)
+        elif len(ranges) == 1:
+            start, end = ranges[0]
+            super().__init__(
+                io_executor.iterate(self.iter_range(start, end)),
+                status_code=206,
+                media_type=media_type,
+                headers=headers,
+            )
+            self.headers["content-range"] = f"bytes {start}-{end - 1}/{stat.size}"
+            self.headers["content-length"] = str(end - start)
+        else:
+            boundary = uuid.uuid4().hex
+            part_headers = [
+                (
+                    f"--{boundary}\r\n"
+                    f"Content-Type: {media_type}\r\n"
+                    f"Content-Range: bytes {start}-{end - 1}/{stat.size}\r\n\r\n"
+                ).encode("ascii")
+                for start, end in ranges
+            ]
+            closing = f"\r\n--{boundary}--\r\n".encode("ascii")
+            content_length = (
+                sum(len(header) for header in part_headers)
+                + sum(end - start for start, end in ranges)
+                + 2 * (len(ranges) - 1)
+                + len(closing)
+            )
+            super().__init__(
+                io_executor.iterate(self.iter_multipart(part_headers, closing)),
+                status_code=206,
+                media_type=f"multipart/byteranges; boundary={boundary}",
+                headers=headers,
+            )
+            self.headers["content-length"] = str(content_length)
+        self.headers["accept-ranges"] = "bytes"
+
+    def iter_chunks(self) -> Generator[bytes, None, None]:
+        """
+        Read the file in chunks.
+        """
+        with self.storage.open_read(self.bucket, self.stat.key) as f:
+            yield from timed_chunks(iter(lambda: f.read(self.chunk_size), b""))
+
+    def iter_range(self, start: int, end: int) -> Generator[bytes, None, None]:
+        yield from timed_chunks(
+            self.storage.read_range(
+                self.bucket, self.stat.key, start, end, chunk_size=self.chunk_size
+            )
+        )
+
+    def iter_multipart(
+        self, part_headers: list[bytes], closing: bytes
+    ) -> Generator[bytes, None, None]:
+        for index, ((start, end), header) in enumerate(zip(self.ranges, part_headers)):
+            if index > 0:
+                yield b"\r\n"
+            yield header
+            yield from self.iter_range(start, end)
+        yield closing
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
+        if not self.ranges and "http.response.pathsend" in scope.get("extensions", {}):
+            path = self.storage.local_path(self.bucket, self.stat.key, self.stat)
+            if path is not None:
+                logger.debug("Sending file with pathsend: path=%s", path)
+                await send(
+                    {
+                        "type": "http.response.start",
+                        "status": self.status_code,
+                        "headers": self.raw_headers,
+                    }
+                )
+                await send({"type": "http.response.pathsend", "path": path})
+                return
+        # the file is opened by the first read, so one gone since its stat is
+        # still answered with a 404 and not with a broken response
+        try:
+            first = await anext(self.body_iterator, None)
+        except (StorageError, OSError):
+            logger.debug("File gone before reading: key=%s", self.stat.key)
+            response = Response(
+                status_code=404,
+                media_type="application/json",
+                content=json.dumps({"details": f"File {self.stat.key} not found"}),
+            )
+            await response(scope, receive, send)
+            return
+        self.body_iterator = prepend(first, self.body_iterator)
+        await super().__call__(scope, receive, send)
+
+
+async def prepend(first: bytes | None, rest: AsyncIterator) -> AsyncIterator:
+    """
+    Yield first, if there is one, and then the rest.
+    """
+    if first is not None:
+        yield first
+    async for chunk in rest:
+        yield chunk
+
+
+class JSONArrayResponse(StreamingResponse):
+    """
+    Streams a JSON object with a single array, as `{"contents": [...]}`, from
+    an iterable, so the full list is never in memory.
+
+    Items are encoded one by one and sent in chunks of about chunk_size bytes.
+    If given, the trailer is called once all the items are sent, and the keys
+    it returns are added to the object after the array.
+    """
+
+    def __init__(
+        self,
+        items: Iterable[Any],
+        key: str = "contents",
+        headers: dict[str, str] | None = None,
+        trailer: Callable[[], dict] | None = None,
+        chunk_size: int = 64 * 1024,
+    ):
+        self.items = items
+        self.key = key
+        self.trailer = trailer
+        self.chunk_size = chunk_size
+        super().__init__(
+            get_executor("io").iterate(self.iter_json()),
+            media_type="application/json",
+            headers=headers,
+        )
+
+    def iter_json(self) -> Generator[bytes, None, None]:
+        buffer = [f"{{{json.dumps(self.key)}: ["]
+        size = 0
+        separator = ""
+        for item in self.items:
+            encoded = separator + json.dumps(item)
+            separator = ", "
+            buffer.append(encoded)
+            size += len(encoded)
+            if size >= self.chunk_size:
+                yield "".join(buffer).encode("utf-8")
+                buffer = []
+                size = 0
+        buffer.append("]")
+        if self.trailer is not None:
+            for key, value in self.trailer().items():
+                buffer.append(f", {json.dumps(key)}: {json.dumps(value)}")
+        buffer.append("}")
+        yield "".join(buffer).encode("utf-8")
+
+
+class NDJSONResponse(StreamingResponse):
+    """
+    Streams an iterable as newline delimited JSON, one item per line.
+
+    If given, the trailer is called once all the items are sent, and what it
+    returns is sent as the last line.
+    """
+
+    def __init__(
+        self,
+        items: Iterable[Any],
+        headers: dict[str, str] | None = None,
+        trailer: Callable[[], dict] | None = None,
+        chunk_size: int = 64 * 1024,
+    ):
+        self.items = items
+        self.trailer = trailer
+        self.chunk_size = chunk_size
+        super().__init__(
+            get_executor("io").iterate(self.iter_lines()),
+            media_type="application/x-ndjson",
+            headers=headers,
+        )
+
+    def iter_lines(self) -> Generator[bytes, None, None]:
+        buffer = []
+        size = 0
+        for item in self.items:
+            line = json.dumps(item) + "\n"
+            buffer.append(line)
+            size += len(line)
+            if size >= self.chunk_size:
+                yield "".join(buffer).encode("utf-8")
+                buffer = []
+                size = 0
+        if self.trailer is not None:
+            buffer.append(json.dumps(self.trailer()) + "\n")
+        yield "".join(buffer).encode("utf-8")
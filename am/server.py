@@ -0,0 +1,266 @@
+"""
+Run the server, in a single process or with several pre-forked workers.
+
+With `server.workers` above 1, the master process loads the app once, with
+its config, Pillow codecs and templates, and forks the workers from it, so
+they start fast and share its memory. Each worker is a uvicorn server on the
+same port, either sharing the listening socket of the master or, with
+`server.reuse_port`, binding its own with SO_REUSEPORT so the kernel
+balances the connections among them.
+
+Workers are recycled gracefully, finishing their requests, after
+`server.max_requests` requests or once their RSS is over
+`server.max_worker_rss`, and the master forks a new one. Setting either one
+runs the master even with a single worker. SIGTERM or SIGINT
+stop the workers and then the master, SIGHUP recycles all of them.
+
+Caches are shared-nothing: each worker has its own hot object cache, metrics
+and executors. The transform cache is shared on disk.
+"""
+
+import gc
+import logging
+import mimetypes
+import os
+import random
+import signal
+import socket
+import sys
+import time
+
+import uvicorn
+
+from am.config import config
+from am.setup import stop_logging
+
+logger = logging.getLogger(__name__)
+
+# seconds a worker must run for its exit not to count as a crash on start
+MIN_WORKER_LIFETIME = 1.0
+BACKLOG = 2048
+
+
+def current_rss() -> int | None:
+    """
+    Current RSS of the process in bytes, None where not available.
+    """
+    try:
+        with open("/proc/self/statm", encoding="ascii") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError):
+        return None
+
+
+class WorkerServer(uvicorn.Server):
+    """
+    uvicorn server that exits gracefully once its RSS is over max_rss.
+    """
+
+    def __init__(self, config: uvicorn.Config, max_rss: int):
+        super().__init__(config)
+        self.max_rss = max_rss
+
+    async def on_tick(self, counter: int) -> bool:
+        if await super().on_tick(counter):
+            return True
+        # checked once a second
+        if self.max_rss and counter % 10 == 0:
+            rss = current_rss()
+            if rss is not None and rss > self.max_rss:
+                logger.info(
+                    "Recycling worker: pid=%s rss=%s max_worker_rss=%s",
+                    os.getpid(),
+                    rss,
+                    self.max_rss,
+                )
+                return True
+        return False
+
+
+def bind_socket(host: str, port: int, reuse_port: bool) -> socket.socket:
+    family = socket.AF_INET6 if ":" in host else socket.AF_INET
+    sock = socket.socket(family, socket.SOCK_STREAM)
+    try:
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        if reuse_port:
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+        sock.bind((host, port))
+        sock.listen(BACKLOG)
+    except OSError:
+        sock.close()
+        raise
+    sock.set_inheritable(True)
+    return sock
+
+
+def preload() -> None:
+    """
+    Load once in the master what the workers would each load on their first
+    requests.
+
+    Storage backends are created by each worker, as they hold database
+    connections, threads and sockets that must not cross a fork.
+    """
+    from PIL import Image
+
+    Image.init()
+    mimetypes.init()
+    if config.server.enable_web_ui:
+        from amm.app import templates
+
+        for name in templates.env.list_templates(extensions=["html"]):
+            templates.env.get_template(name)
+    if any(storage.type == "s3" for storage in config.storage.values()):
+        import am.storage.s3  # noqa: F401
+    # objects loaded until now are never freed, so the pages holding them
+    # are not copied by the garbage collector of each worker
+    gc.collect()
+    gc.freeze()
+
+
+def exit_worker(signum, frame) -> None:
+    raise SystemExit(0)
+
+
+class Supervisor:
+    """
+    Supervisor forks the workers and replaces the ones that exit.
+    """
+
+    def __init__(self, app, host: str, port: int, workers: int, log_level: str):
+        self.app = app
+        self.host = host
+        self.port = port
+        self.workers = workers
+        self.log_level = log_level
+        self.reuse_port = config.server.reuse_port
+        self.socket: socket.socket | None = None
+        # pid -> monotonic time it was started
+        self.children: dict[int, float] = {}
+        self.stopping = False
+
+    def run(self) -> None:
+        if not self.reuse_port:
+            self.socket = bind_socket(self.host, self.port, reuse_port=False)
+        preload()
+        signal.signal(signal.SIGTERM, self.stop)
+        signal.signal(signal.SIGINT, self.stop)
+        signal.signal(signal.SIGHUP, self.recycle)
+        logger.info(
+            "Starting workers=%s host=%s port=%s reuse_port=%s",
+            self.workers,
+            self.host,
+            self.port,
+            self.reuse_port,
+        )
+        for _ in range(self.workers):
+            self.spawn()
+
+        while self.children:
+            try:
+                pid, status = os.wait()
+            except ChildProcessError:
+                break
+            started = self.children.pop(pid, None)
+            if started is None or self.stopping:
+                continue
+            code = os.waitstatus_to_exitcode(status)
+            logger.info("Worker exited: pid=%s code=%s", pid, code)
+            if code != 0 and time.monotonic() - started < MIN_WORKER_LIFETIME:
+                # failing on start, do not fork in a loop
+                time.sleep(MIN_WORKER_LIFETIME)
+            self.spawn()
+        logger.info("All workers stopped")
+
+    def stop(self, signum, frame) -> None:
+        self.stopping = True
+        self.signal_workers(signal.SIGTERM)
+
+    def recycle(self, signum, frame) -> None:
+        logger.info("Recycling all workers")
+        self.signal_workers(signal.SIGTERM)
+
+    def signal_workers(self, signum: int) -> None:
+        for pid in list(self.children):
+            try:
+                os.kill(pid, signum)
+            except ProcessLookupError:
+                pass
+
+    def spawn(self) -> None:
+        pid = os.fork()
+        if pid != 0:
+            self.children[pid] = time.monotonic()
+            return
+
+        code = 1
+        try:
+            # uvicorn handles them while serving, and raises them again
+            # once it is done
+            signal.signal(signal.SIGTERM, exit_worker)
+            signal.signal(signal.SIGINT, exit_worker)
+            signal.signal(signal.SIGHUP, signal.SIG_DFL)
+            random.seed()
+            self.run_worker()
+            code = 0
+        except SystemExit as e:
+            code = e.code if isinstance(e.code, int) else 1
+        except BaseException:
+            logger.exception("Worker failed: pid=%s", os.getpid())
+        finally:
+            stop_logging()
+            os._exit(code)
+
+    def run_worker(self) -> None:
+        # the transform processes of all the workers share the cores
+        transform = config.executors.get("transform")
+        if transform is not None and transform.type == "process":
+            if not transform.workers:
+                transform.workers = max(1, (os.cpu_count() or 1) // self.workers)
+
+        sock = self.socket or bind_socket(self.host, self.port, reuse_port=True)
+        max_requests = config.server.max_requests
+        if max_requests:
+            max_requests += random.randint(0, config.server.max_requests_jitter)
+        server_config = uvicorn.Config(
+            self.app,
+            log_level=self.log_level,
+            limit_max_requests=max_requests or None,
+            timeout_graceful_shutdown=config.server.graceful_timeout,
+        )
+        server = WorkerServer(server_config, max_rss=config.server.max_worker_rss)
+        logger.info("Worker started: pid=%s", os.getpid())
+        server.run(sockets=[sock])
+
+
+def run(
+    app,
+    app_path: str,
+    host: str,
+    port: int,
+    workers: int,
+    reload: bool = False,
+) -> None:
+    """
+    Run the app, given as is and by its import path for the reloader.
+    A workers count of 0 is one per CPU.
+    """
+    log_level = os.environ.get("LOG_LEVEL", "info").lower()
+    workers = workers or os.cpu_count() or 1
+    recycle = config.server.max_requests or config.server.max_worker_rss
+    if reload:
+        if workers > 1:
+            logger.warning("Reload runs a single worker, not %s", workers)
+        uvicorn.run(app_path, host=host, port=port, reload=True, log_level=log_level)
+    elif workers == 1 and not recycle:
+        uvicorn.run(
+            app,
+            host=host,
+            port=port,
+            log_level=log_level,
+            timeout_graceful_shutdown=config.server.graceful_timeout,
+        )
+    elif not hasattr(os, "fork"):
+        sys.exit("Several workers, or recycling them, need os.fork")
+    else:
+        Supervisor(app, host, port, workers, log_level).run()
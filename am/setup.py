@@ -1,61 +1,209 @@
 """
 Setup logging for the application.
+
+It is configured by environment variables, as exported by run.sh:
+
+- LOG_LEVEL: level of the application loggers, DEBUG by default.
+- LOG_FORMAT: `text`, colored when writing to a terminal, or `json`, one
+  object per line, for log collectors.
+- LOG_DEBUG_SAMPLE: fraction of the requests, from 0 to 1, whose DEBUG
+  records are kept, 1 by default. Sampling is by trace_id, so the sampled
+  requests keep all their records.
+
+Records are put on a queue and written by a background thread, so log I/O
+never blocks the event loop or the request threads.
 """
 
+import atexit
 import contextvars
+import copy
+import json
 import logging
-
+import logging.handlers
+import os
+import queue
+import random
+import sys
+import zlib
+from datetime import datetime, timezone
 
 # Context variable to store trace_id across async calls
 trace_id_var: contextvars.ContextVar[str | None] = contextvars.ContextVar(
     "trace_id", default=None
 )
 
+# loggers of the application, the others only log warnings and errors
+APP_LOGGERS = ["am", "amm", "tests", "serve", "__main__"]
+
+COLORS = {
+    logging.DEBUG: "\033[94m",
+    logging.WARNING: "\033[93m",
+    logging.ERROR: "\033[91m",
+    logging.CRITICAL: "\033[91m",
+}
+
+_listener: logging.handlers.QueueListener | None = None
+
 
 class TraceIdFilter(logging.Filter):
     """Filter to add trace_id to log records if available."""
 
     def filter(self, record):
-        trace_id = trace_id_var.get(None)
-        if trace_id:
-            record.trace_id = trace_id
+        record.trace_id = trace_id_var.get(None)
         return True
 
 
+class DebugSampleFilter(logging.Filter):
+    """
+    Filter keeping the DEBUG records of a fraction of the requests, by
+    trace_id, and of the same fraction of the records out of requests.
+    """
+
+    def __init__(self, rate: float):
+        super().__init__()
+        self.rate = rate
+
+    def filter(self, record):
+        if record.levelno > logging.DEBUG:
+            return True
+        trace_id = getattr(record, "trace_id", None)
+        if trace_id:
+            return zlib.crc32(trace_id.encode()) < self.rate * 2**32
+        return random.random() < self.rate
+
+
+class LogQueueHandler(logging.handlers.QueueHandler):
+    """
+    Queue handler merging the arguments of the records into their message and
+    keeping the exception text apart, for the formatters to place it.
+    """
+
+    def prepare(self, record):
+        record = copy.copy(record)
+        record.msg = record.getMessage()
+        record.args = None
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+        record.exc_info = None
+        return record
+
+
+class TraceFormatter(logging.Formatter):
+    """
+    Text formatter showing the trace_id when there is one, colored for
+    terminals.
+    """
+
+    def __init__(self, color: bool):
+        if color:
+            fmt = "\033[94m[%(levelname)s\t]\033[0m \033[92m[%(name)24s]\033[0m%(trace)s %(message)s"
+        else:
+            fmt = "[%(levelname)s\t] [%(name)24s]%(trace)s %(message)s"
+        super().__init__(fmt)
+        self.color = color
+
+    def format(self, record):
+        trace_id = getattr(record, "trace_id", None)
+        if not trace_id:
+            record.trace = ""
+        elif self.color:
+            record.trace = f" \033[96m[trace_id={trace_id}]\033[0m"
+        else:
+            record.trace = f" [trace_id={trace_id}]"
+        levelname = record.levelname
+        if self.color and record.levelno in COLORS:
+            record.levelname = f"{COLORS[record.levelno]}{levelname}\033[0m"
+        try:
+            return super().format(record)
+        finally:
+            record.levelname = levelname
+
+
+class JsonFormatter(logging.Formatter):
+    """
+    Formatter writing each record as a JSON object on one line.
+    """
+
+    def format(self, record):
+        entry = {
+            "time": datetime.fromtimestamp(record.created, timezone.utc).isoformat(),
+            "level": record.levelname,
+            "logger": record.name,
+            "message": record.getMessage(),
+        }
+        trace_id = getattr(record, "trace_id", None)
+        if trace_id:
+            entry["trace_id"] = trace_id
+        if record.exc_text:
+            entry["exception"] = record.exc_text
+        return json.dumps(entry)
+
+
 def setup_logging():
     """
     Setup logging for the application.
     """
-    # make logging to log DEBUG in blue, warning in yellow, error in red
-    logging.addLevelName(logging.DEBUG, "\033[94mDEBUG\033[0m")
-    logging.addLevelName(logging.WARNING, "\033[93mWARN\033[0m")
-    logging.addLevelName(logging.ERROR, "\033[91mERROR\033[0m")
-    logging.basicConfig(
-        format="\033[94m[%(levelname)s\t]\033[0m \033[92m[%(name)24s]\033[0m%(trace_id)s %(message)s",
-        level=logging.DEBUG,
-    )
-    ALLOWED_NAME_PREFIX = ["am.", "tests.", "serve"]
-    trace_filter = TraceIdFilter()
-
-    for handler in logging.root.handlers:
-        handler.addFilter(trace_filter)
-        handler.addFilter(
-            lambda record: any(
-                record.name.startswith(prefix) for prefix in ALLOWED_NAME_PREFIX
-            )
-        )
-
-    # Custom formatter to conditionally show trace_id
-    class TraceFormatter(logging.Formatter):
-        def format(self, record):
-            if hasattr(record, "trace_id") and record.trace_id:
-                record.trace_id = f" \033[96m[trace_id={record.trace_id}]\033[0m"
-            else:
-                record.trace_id = ""
-            return super().format(record)
+    global _listener
+    level_name = os.environ.get("LOG_LEVEL", "DEBUG").upper()
+    level = logging.getLevelNamesMapping().get(level_name)
+    if level is None:
+        raise ValueError(f"Unknown LOG_LEVEL: {level_name}")
+    log_format = os.environ.get("LOG_FORMAT", "text").lower()
+    sample = float(os.environ.get("LOG_DEBUG_SAMPLE", "1"))
 
-    formatter = TraceFormatter(
-        "\033[94m[%(levelname)s\t]\033[0m \033[92m[%(name)24s]\033[0m%(trace_id)s %(message)s"
-    )
-    for handler in logging.root.handlers:
-        handler.setFormatter(formatter)
+    handler = logging.StreamHandler(sys.stderr)
+    if log_format == "json":
+        handler.setFormatter(JsonFormatter())
+    else:
+        handler.setFormatter(TraceFormatter(color=sys.stderr.isatty()))
+
+    # filters run in the thread that logs, before the record is queued, so
+    # the trace_id is the one of its request
+    queue_handler = LogQueueHandler(queue.SimpleQueue())
+    queue_handler.addFilter(TraceIdFilter())
+    if sample < 1:
+        queue_handler.addFilter(DebugSampleFilter(sample))
+
+    if _listener is None:
+        atexit.register(stop_logging)
+        # forked processes, as the ones of the transform executor, have no
+        # logging thread of their own
+        os.register_at_fork(after_in_child=restart_logging)
+    else:
+        _listener.stop()
+    _listener = logging.handlers.QueueListener(queue_handler.queue, handler)
+    _listener.start()
+
+    root = logging.getLogger()
+    for existing in list(root.handlers):
+        root.removeHandler(existing)
+    root.addHandler(queue_handler)
+    # other libraries only reach the handler with warnings and errors, so
+    # their debug records are not even created
+    root.setLevel(max(level, logging.WARNING))
+    for name in APP_LOGGERS:
+        logging.getLogger(name).setLevel(level)
+
+
+def restart_logging():
+    """
+    Start a logging thread, with a new queue, in a forked process.
+    """
+    global _listener
+    if _listener is None:
+        return
+    root = logging.getLogger()
+    records = queue.SimpleQueue()
+    for handler in root.handlers:
+        if isinstance(handler, logging.handlers.QueueHandler):
+            handler.queue = records
+    _listener = logging.handlers.QueueListener(records, *_listener.handlers)
+    _listener.start()
+
+
+def stop_logging():
+    """
+    Write the queued records and stop the logging thread.
+    """
+    if _listener is not None:
+        _listener.stop()
@@ -0,0 +1,69 @@
+"""
+Single flight: one computation per key at a time.
+
+When many requests need the same result at once, as the thumbnails of a page
+that was just published, the first one runs the computation and the others
+wait for it and share its result, instead of all of them doing the same work.
+"""
+
+import asyncio
+import logging
+from typing import Any, Awaitable, Callable, Hashable
+
+logger = logging.getLogger(__name__)
+
+
+class SingleFlightTimeoutError(Exception):
+    """
+    SingleFlightTimeoutError is raised when a caller gave up waiting for a result.
+    """
+
+    def __init__(self, key: Hashable, timeout: float):
+        super().__init__(f"Timed out after {timeout}s waiting for {key}")
+        self.key = key
+        self.timeout = timeout
+
+
+class SingleFlight:
+    """
+    Deduplicates concurrent calls with the same key in the running event loop.
+
+    The computation runs as its own task, so it is not cancelled when the
+    caller that started it goes away while others are still waiting.
+    """
+
+    def __init__(self):
+        self.calls: dict[Hashable, asyncio.Task] = {}
+        self.shared = 0
+
+    async def do(
+        self,
+        key: Hashable,
+        fn: Callable[[], Awaitable[Any]],
+        timeout: float | None = None,
+    ) -> Any:
+        """
+        Get the result of fn(), or of the call already running for key.
+
+        Raises SingleFlightTimeoutError if it takes more than timeout seconds,
+        the computation itself keeps running for the other callers.
+        """
+        task = self.calls.get(key)
+        if task is None:
+            task = asyncio.ensure_future(fn())
+            self.calls[key] = task
+            task.add_done_callback(lambda task: self.done(key, task))
+        else:
+            self.shared += 1
+            logger.debug("Joining running call key=%s", key)
+        try:
+            return await asyncio.wait_for(asyncio.shield(task), timeout)
+        except TimeoutError:
+            raise SingleFlightTimeoutError(key, timeout)
+
+    def done(self, key: Hashable, task: asyncio.Task) -> None:
+        if self.calls.get(key) is task:
+            del self.calls[key]
+        if not task.cancelled() and task.exception() is not None:
+            # retrieved here too, in case every caller timed out
+            logger.debug("Call key=%s failed: %s", key, task.exception())
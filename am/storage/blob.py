@@ -0,0 +1,460 @@
+"""
+BlobStorage is a content addressed storage backend on the local filesystem.
+
+Every file content is stored once, as a blob named by its SHA-256, however
+many buckets and keys have it. A SQLite database maps the bucket keys to their
+blob and keeps a reference count per blob, so a blob is removed when the last
+key pointing to it is deleted or overwritten.
+
+The layout is:
+
+    <path>/blobs/<hash[:2]>/<hash[2:4]>/<hash>
+    <path>/tmp/                 uploads being written
+    <path>/metadata.db          buckets, keys and blob references
+
+The content hash is computed while the upload is streamed, and is the strong
+ETag of the file.
+"""
+
+import hashlib
+import logging
+import os
+import sqlite3
+import tempfile
+import threading
+import time
+from contextlib import contextmanager
+from datetime import datetime, timezone
+from itertools import islice
+from typing import BinaryIO, Callable, Generator
+
+from am.config import StorageConfig
+from am.storage import events
+from am.storage.disk import UMASK, fsync_dir
+from am.storage.listing import iter_listing, list_page
+from am.storage.types import (
+    BucketData,
+    FileData,
+    ListPage,
+    NoSuchBucketError,
+    NoSuchFileError,
+    Storage,
+    is_internal_key,
+)
+
+logger = logging.getLogger(__name__)
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS buckets (
+    name TEXT PRIMARY KEY,
+    creation_date REAL NOT NULL
+) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS objects (
+    bucket TEXT NOT NULL,
+    key TEXT NOT NULL,
+    hash TEXT NOT NULL,
+    size INTEGER NOT NULL,
+    last_modified REAL NOT NULL,
+    PRIMARY KEY (bucket, key)
+) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS blobs (
+    hash TEXT PRIMARY KEY,
+    size INTEGER NOT NULL,
+    refs INTEGER NOT NULL
+) WITHOUT ROWID;
+"""
+
+BATCH_SIZE = 1000
+
+
+class HashingWriter:
+    """
+    File wrapper that hashes what is written to it.
+    """
+
+    def __init__(self, f: BinaryIO):
+        self.f = f
+        self.hash = hashlib.sha256()
+        self.size = 0
+
+    def write(self, data: bytes) -> int:
+        self.hash.update(data)
+        self.size += len(data)
+        return self.f.write(data)
+
+    def __getattr__(self, name: str):
+        return getattr(self.f, name)
+
+
+class BlobStorage(Storage):
+    """
+    BlobStorage stores each distinct content once, shared by all the keys with it.
+    """
+
+    def __init__(self, config: StorageConfig):
+        self.config = config
+        self.name = config.name
+        self.path = config.config["path"]
+        self.blobs_path = os.path.join(self.path, "blobs")
+        self.tmp_path = os.path.join(self.path, "tmp")
+        self.db_path = os.path.join(self.path, "metadata.db")
+        self.local = threading.local()
+        os.makedirs(self.blobs_path, exist_ok=True)
+        os.makedirs(self.tmp_path, exist_ok=True)
+        self.connection().executescript(SCHEMA)
+
+    def connection(self) -> sqlite3.Connection:
+        """
+        Get the connection of the current thread.
+        """
+        conn = getattr(self.local, "conn", None)
+        if conn is None:
+            # transactions are explicit, see transaction()
+            conn = sqlite3.connect(self.db_path, timeout=30, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self.local.conn = conn
+        return conn
+
+    @contextmanager
+    def transaction(
+        self, on_rollback: Callable[[], None] | None = None
+    ) -> Generator[sqlite3.Connection, None, None]:
+        """
+        Run a write transaction. It takes the database write lock from the
+        start, so reference counts and blob files change together, also
+        across processes.
+
+        If it fails, on_rollback is called before the lock is released, to
+        undo the file changes made in the transaction.
+        """
+        conn = self.connection()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            yield conn
+            conn.execute("COMMIT")
+        except BaseException:
+            try:
+                if on_rollback is not None:
+                    on_rollback()
+            finally:
+                if conn.in_transaction:
+                    conn.execute("ROLLBACK")
+            raise
+
+    def blob_path(self, hash: str) -> str:
+        return os.path.join(self.blobs_path, hash[:2], hash[2:4], hash)
+
+    def close(self) -> None:
+        conn = getattr(self.local, "conn", None)
+        if conn is not None:
+            conn.close()
+            self.local.conn = None
+
+    def create_bucket(self, name: str) -> None:
+        logger.debug("Creating bucket=%s", name)
+        with self.transaction() as conn:
+            conn.execute(
+                "INSERT OR IGNORE INTO buckets VALUES (?, ?)", (name, time.time())
+            )
+
+    def delete_bucket(self, name: str) -> None:
+        logger.debug("Deleting bucket=%s", name)
+        with self.transaction() as conn:
+            self.check_bucket(name)
+            hashes = conn.execute(
+                "SELECT hash FROM objects WHERE bucket = ?", (name,)
+            ).fetchall()
+            conn.execute("DELETE FROM objects WHERE bucket = ?", (name,))
+            conn.execute("DELETE FROM buckets WHERE name = ?", (name,))
+            released = [hash for (hash,) in hashes if self.release_blob(conn, hash)]
+        self.remove_blobs(released)
+        events.notify_change(self.name, name)
+
+    def check_bucket(self, bucket: str) -> None:
+        row = (
+            self.connection()
+            .execute("SELECT 1 FROM buckets WHERE name = ?", (bucket,))
+            .fetchone()
+        )
+        if row is None:
+            raise NoSuchBucketError(f"Bucket {bucket} does not exist")
+
+    def list_buckets(self, start: int = 0, limit: int = 100) -> list[BucketData]:
+        logger.debug("Listing buckets: start=%s limit=%s", start, limit)
+        rows = (
+            self.connection()
+            .execute(
+                "SELECT name, creation_date FROM buckets ORDER BY name "
+                "LIMIT ? OFFSET ?",
+                (limit, start),
+            )
+            .fetchall()
+        )
+        return [
+            BucketData(
+                name=name,
+                creation_date=datetime.fromtimestamp(creation_date, tz=timezone.utc),
+            )
+            for name, creation_date in rows
+        ]
+
+    def list_files(
+        self, bucket: str, start: int = 0, limit: int = 100
+    ) -> list[FileData]:
+        logger.debug("Listing files: bucket=%s start=%s limit=%s", bucket, start, limit)
+        return list(islice(self.scan_files(bucket), start, start + limit))
+
+    def list_page(
+        self,
+        bucket: str,
+        prefix: str = "",
+        delimiter: str | None = None,
+        token: str | None = None,
+        max_keys: int = 1000,
+    ) -> ListPage:
+        logger.debug(
+            "Listing page: bucket=%s prefix=%s delimiter=%s max_keys=%s",
+            bucket,
+            prefix,
+            delimiter,
+            max_keys,
+        )
+
+        def scan(prefix: str, start_after: str | None):
+            return self.scan_files(bucket, prefix, start_after)
+
+        return list_page(scan, prefix, delimiter, token, max_keys)
+
+    def iter_listing(
+        self,
+        bucket: str,
+        prefix: str = "",
+        delimiter: str | None = None,
+        start_after: str | None = None,
+    ) -> Generator[FileData | str, None, None]:
+        def scan(prefix: str, start_after: str | None):
+            return self.scan_files(bucket, prefix, start_after)
+
+        # check the bucket exists before streaming anything
+        scan(prefix, start_after)
+        return iter_listing(scan, prefix, delimiter, start_after)
+
+    def scan_files(
+        self, bucket: str, prefix: str = "", start_after: str | None = None
+    ) -> Generator[FileData, None, None]:
+        self.check_bucket(bucket)
+        return self.scan_objects(bucket, prefix, start_after)
+
+    def scan_objects(
+        self, bucket: str, prefix: str, start_after: str | None
+    ) -> Generator[FileData, None, None]:
+        """
+        Yield the objects in key order, in batches, with no cursor kept open
+        between them.
+        """
+        if start_after is None or start_after < prefix:
+            query = "key >= ?"
+            position = prefix
+        else:
+            query = "key > ?"
+            position = start_after
+        while True:
+            rows = (
+                self.connection()
+                .execute(
+                    "SELECT key, size, last_modified, hash FROM objects "
+                    f"WHERE bucket = ? AND {query} ORDER BY key LIMIT ?",
+                    (bucket, position, BATCH_SIZE),
+                )
+                .fetchall()
+            )
+            for row in rows:
+                if not row[0].startswith(prefix):
+                    return
+                if not is_internal_key(row[0]):
+                    yield self.to_file_data(row)
+            if len(rows) < BATCH_SIZE:
+                return
+            query = "key > ?"
+            position = rows[-1][0]
+
+    def get_object(self, bucket: str, file: str) -> FileData:
+        row = (
+            self.connection()
+            .execute(
+                "SELECT key, size, last_modified, hash FROM objects "
+                "WHERE bucket = ? AND key = ?",
+                (bucket, file),
+            )
+            .fetchone()
+        )
+        if row is None:
+            raise NoSuchFileError(f"File {file} does not exist")
+        return self.to_file_data(row)
+
+    @contextmanager
+    def open_read(self, bucket: str, file: str) -> Generator[BinaryIO, None, None]:
+        logger.debug("Opening file for reading: bucket=%s file=%s", bucket, file)
+        stat = self.get_object(bucket, file)
+        with open(self.blob_path(stat.etag), "rb") as f:
+            yield f
+
+    def read_range(
+        self, bucket: str, file: str, start: int, end: int, chunk_size: int = 65536
+    ) -> Generator[bytes, None, None]:
+        stat = self.get_object(bucket, file)
+        fd = os.open(self.blob_path(stat.etag), os.O_RDONLY)
+        try:
+            offset = start
+            while offset < end:
+                chunk = os.pread(fd, min(chunk_size, end - offset), offset)
+                if not chunk:
+                    break
+                offset += len(chunk)
+                yield chunk
+        finally:
+            os.close(fd)
+
+    @contextmanager
+    def open_write(self, bucket: str, file: str) -> Generator[BinaryIO, None, None]:
+        """
+        Writes to a temporary file while hashing it. Once written, it becomes
+        the blob of its hash, unless that blob already exists, and the key is
+        pointed to it. If the writer fails the old file is kept.
+        """
+        logger.debug("Opening file for writing: bucket=%s file=%s", bucket, file)
+        fd, tmppath = tempfile.mkstemp(dir=self.tmp_path)
+        try:
+            os.fchmod(fd, 0o666 & ~UMASK)
+            with os.fdopen(fd, "wb") as f:
+                writer = HashingWriter(f)
+                yield writer
+                f.flush()
+                os.fsync(f.fileno())
+            hash = writer.hash.hexdigest()
+            added = False
+            released = []
+
+            def remove_added_blob() -> None:
+                # a new blob must not stay without the reference to it
+                if added:
+                    os.unlink(self.blob_path(hash))
+
+            with self.transaction(on_rollback=remove_added_blob) as conn:
+                # as on disk, writing to a missing bucket creates it
+                conn.execute(
+                    "INSERT OR IGNORE INTO buckets VALUES (?, ?)", (bucket, time.time())
+                )
+                added = self.add_blob(conn, hash, writer.size, tmppath)
+                old = conn.execute(
+                    "SELECT hash FROM objects WHERE bucket = ? AND key = ?",
+                    (bucket, file),
+                ).fetchone()
+                conn.execute(
+                    "INSERT OR REPLACE INTO objects VALUES (?, ?, ?, ?, ?)",
+                    (bucket, file, hash, writer.size, time.time()),
+                )
+                if old is not None and self.release_blob(conn, old[0]):
+                    released.append(old[0])
+            self.remove_blobs(released)
+        finally:
+            if os.path.exists(tmppath):
+                os.unlink(tmppath)
+        events.notify_change(self.name, bucket, file)
+
+    def add_blob(
+        self, conn: sqlite3.Connection, hash: str, size: int, tmppath: str
+    ) -> bool:
+        """
+        Add a reference to a blob, moving the temporary file into place if it
+        is new. Returns whether it was. Must run in a transaction.
+        """
+        updated = conn.execute(
+            "UPDATE blobs SET refs = refs + 1 WHERE hash = ?", (hash,)
+        ).rowcount
+        if updated:
+            logger.debug("Reusing blob=%s", hash)
+            return False
+        path = self.blob_path(hash)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        os.replace(tmppath, path)
+        fsync_dir(os.path.dirname(path))
+        conn.execute("INSERT INTO blobs VALUES (?, ?, 1)", (hash, size))
+        return True
+
+    def release_blob(self, conn: sqlite3.Connection, hash: str) -> bool:
+        """
+        Drop a reference to a blob, deleting its row if it was the last one.
+        Returns whether it was. Must run in a transaction, and its file is
+        removed with remove_blobs once it is committed.
+        """
+        conn.execute("UPDATE blobs SET refs = refs - 1 WHERE hash = ?", (hash,))
+        row = conn.execute("SELECT refs FROM blobs WHERE hash = ?", (hash,)).fetchone()
+        if row is not None and row[0] <= 0:
+            conn.execute("DELETE FROM blobs WHERE hash = ?", (hash,))
+            return True
+        return False
+
+    def remove_blobs(self, hashes: list[str]) -> None:
+        """
+        Remove the files of the blobs released by a committed transaction, so
+        a rolled back one never loses a file still referenced. A blob added
+        again since is kept.
+        """
+        if not hashes:
+            return
+        try:
+            with self.transaction() as conn:
+                for hash in hashes:
+                    row = conn.execute(
+                        "SELECT 1 FROM blobs WHERE hash = ?", (hash,)
+                    ).fetchone()
+                    if row is not None:
+                        continue
+                    logger.debug("Removing unreferenced blob=%s", hash)
+                    try:
+                        os.unlink(self.blob_path(hash))
+                    except FileNotFoundError:
+                        pass
+        except (OSError, sqlite3.Error):
+            # the change is committed, a left over file only takes space
+            logger.exception("Error removing blobs=%s", hashes)
+
+    def delete_file(self, bucket: str, file: str) -> None:
+        logger.debug("Deleting file: bucket=%s file=%s", bucket, file)
+        with self.transaction() as conn:
+            row = conn.execute(
+                "SELECT hash FROM objects WHERE bucket = ? AND key = ?",
+                (bucket, file),
+            ).fetchone()
+            if row is None:
+                raise NoSuchFileError(f"File {file} does not exist")
+            conn.execute(
+                "DELETE FROM objects WHERE bucket = ? AND key = ?", (bucket, file)
+            )
+            released = self.release_blob(conn, row[0])
+        if released:
+            self.remove_blobs([row[0]])
+        events.notify_change(self.name, bucket, file)
+
+    def stat(self, bucket: str, file: str) -> FileData:
+        logger.debug("Statting file: bucket=%s file=%s", bucket, file)
+        return self.get_object(bucket, file)
+
+    def local_path(
+        self, bucket: str, file: str, stat: FileData | None = None
+    ) -> str | None:
+        # the etag is the hash of the blob, so no lookup is needed with a stat
+        if stat is None:
+            stat = self.get_object(bucket, file)
+        return os.path.abspath(self.blob_path(stat.etag))
+
+    def to_file_data(self, row: tuple) -> FileData:
+        key, size, last_modified, hash = row
+        return FileData(
+            key=key,
+            size=size,
+            last_modified=datetime.fromtimestamp(last_modified, tz=timezone.utc),
+            etag=hash,
+        )
@@ -4,27 +4,76 @@ DiskStorage is a storage backend that uses the local filesystem.
 It is used to store the data of the application.
 
 It is a simple storage backend that uses the local filesystem.
+
+By default a key is stored at `<path>/<bucket>/<key>`. With `layout: sharded`
+in the storage config, keys are spread by their hash as
+`<path>/<bucket>/.am-shards/<hash[:2]>/<hash[2:4]>/<key>`, so buckets with
+millions of flat keys do not end up with huge directories. Existing data can
+be moved between layouts with `python -m am.storage.migrate`.
 """
 
 from datetime import datetime, timezone
+import hashlib
 import os
 import shutil
+import tempfile
+import threading
 import logging
 from contextlib import contextmanager
 from itertools import islice
 from pathlib import Path
+from stat import S_ISREG
 from typing import BinaryIO, Generator
 from am.config import StorageConfig
+from am.storage import events
+from am.storage.index import get_index
+from am.storage.listing import MAX_CHAR, iter_listing, list_page
 from am.storage.types import (
+    INTERNAL_PREFIX,
     BucketData,
+    ListPage,
     NoSuchBucketError,
     NoSuchFileError,
     Storage,
     FileData,
+    is_internal_key,
 )
 
 logger = logging.getLogger(__name__)
 
+# prefix of the files being written, which are not listed
+TMP_PREFIX = INTERNAL_PREFIX + "upload-"
+
+# directory of the bucket with the shards, in the sharded layout
+SHARDS_DIR = INTERNAL_PREFIX + "shards"
+LAYOUTS = ("direct", "sharded")
+
+# mkstemp creates files only readable by the owner, keep the usual permissions
+UMASK = os.umask(0)
+os.umask(UMASK)
+
+
+def fsync_dir(path: Path) -> None:
+    """
+    Sync a directory, so a rename in it survives a crash.
+    """
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+def scandir_dirs(path: str) -> list[str]:
+    """
+    Get the paths of the directories in path, none if it does not exist.
+    """
+    try:
+        with os.scandir(path) as it:
+            return [entry.path for entry in it if entry.is_dir()]
+    except FileNotFoundError:
+        return []
+
 
 class DiskStorage(Storage):
     """
@@ -32,7 +81,32 @@ class DiskStorage(Storage):
     """
 
     def __init__(self, config: StorageConfig):
+        self.config = config
+        self.name = config.name
         self.path = config.config["path"]
+        self.index = get_index() if config.config.get("index") else None
+        # buckets known to be in the index, and the lock to index the others
+        self.indexed: set[str] = set()
+        self.indexing = threading.Lock()
+        self.layout = config.config.get("layout", "direct")
+        if self.layout not in LAYOUTS:
+            raise ValueError(f"Unknown disk layout: {self.layout}")
+        if self.layout == "sharded" and self.index is None:
+            logger.warning(
+                "Storage %s is sharded without index, listings read all keys",
+                self.name,
+            )
+
+    def file_path(self, bucket: str, file: str) -> Path:
+        """
+        Get the path of a key in the layout of the storage.
+        """
+        if self.layout == "sharded":
+            digest = hashlib.sha256(file.encode("utf-8")).hexdigest()
+            return (
+                Path(self.path) / bucket / SHARDS_DIR / digest[:2] / digest[2:4] / file
+            )
+        return Path(self.path) / bucket / file
 
     def create_bucket(self, name: str) -> None:
         logger.debug("Creating bucket=%s", name)
@@ -41,19 +115,30 @@ class DiskStorage(Storage):
     def delete_bucket(self, name: str) -> None:
         logger.debug("Deleting bucket=%s", name)
         shutil.rmtree(os.path.join(self.path, name))
+        if self.index is not None:
+            self.index.delete_bucket(self.name, name)
+            self.indexed.discard(name)
+        events.notify_change(self.name, name)
 
     def list_buckets(self, start: int = 0, limit: int = 100) -> list[BucketData]:
         logger.debug("Listing buckets: start=%s limit=%s", start, limit)
-        return [
-            BucketData(
-                name=name,
+        return list(islice(self.iter_buckets(), start, start + limit))
+
+    def iter_buckets(self) -> Generator[BucketData, None, None]:
+        """
+        Yield the buckets sorted by name, with one stat per bucket.
+        """
+        with os.scandir(self.path) as it:
+            entries = sorted(
+                (entry for entry in it if entry.is_dir()), key=lambda e: e.name
+            )
+        for entry in entries:
+            yield BucketData(
+                name=entry.name,
                 creation_date=datetime.fromtimestamp(
-                    os.path.getmtime(os.path.join(self.path, name)),
-                    tz=timezone.utc,
+                    entry.stat().st_mtime, tz=timezone.utc
                 ),
             )
-            for name in os.listdir(self.path)[start : start + limit]
-        ]
 
     def list_files(
         self, bucket: str, start: int = 0, limit: int = 100
@@ -65,72 +150,218 @@ class DiskStorage(Storage):
             limit,
             self.path,
         )
+        return list(islice(self.scan_files(bucket), start, start + limit))
+
+    def list_page(
+        self,
+        bucket: str,
+        prefix: str = "",
+        delimiter: str | None = None,
+        token: str | None = None,
+        max_keys: int = 1000,
+    ) -> ListPage:
+        logger.debug(
+            "Listing page: bucket=%s prefix=%s delimiter=%s max_keys=%s",
+            bucket,
+            prefix,
+            delimiter,
+            max_keys,
+        )
+
+        def scan(prefix: str, start_after: str | None):
+            return self.scan_files(bucket, prefix, start_after)
 
-        def list_recursive(path: Path, prefix: str) -> Generator[FileData, None, None]:
-            files = os.listdir(path)
-            # first list plain files
-            for file in files:
-                if not os.path.isdir(os.path.join(path, file)):
+        return list_page(scan, prefix, delimiter, token, max_keys)
+
+    def iter_listing(
+        self,
+        bucket: str,
+        prefix: str = "",
+        delimiter: str | None = None,
+        start_after: str | None = None,
+    ) -> Generator[FileData | str, None, None]:
+        def scan(prefix: str, start_after: str | None):
+            return self.scan_files(bucket, prefix, start_after)
+
+        # check the bucket exists before streaming anything
+        scan(prefix, start_after)
+        return iter_listing(scan, prefix, delimiter, start_after)
+
+    def scan_files(
+        self, bucket: str, prefix: str = "", start_after: str | None = None
+    ) -> Generator[FileData, None, None]:
+        if self.index is None:
+            return self.walk_files(bucket, prefix, start_after)
+        if not os.path.isdir(os.path.join(self.path, bucket)):
+            raise NoSuchBucketError(f"Bucket {bucket} does not exist")
+        if bucket not in self.indexed:
+            self.ensure_indexed(bucket)
+        return self.index.scan(self.name, bucket, prefix, start_after)
+
+    def ensure_indexed(self, bucket: str) -> None:
+        """
+        Index the stored files of a bucket not indexed yet, as the ones written
+        before the index was turned on.
+        """
+        with self.indexing:
+            if bucket in self.indexed:
+                return
+            if not self.index.is_indexed(self.name, bucket):
+                count = self.index.reconcile(self.name, bucket, self.walk_files(bucket))
+                logger.info("Indexed bucket=%s files=%s", bucket, count)
+            self.indexed.add(bucket)
+
+    def walk_files(
+        self,
+        bucket: str,
+        prefix: str = "",
+        start_after: str | None = None,
+        internal: bool = False,
+    ) -> Generator[FileData, None, None]:
+        """
+        Walk the bucket directory, yielding the files in key order.
+
+        Directories out of the prefix or fully before start_after are skipped.
+        It uses os.scandir, so there is a single stat per listed file, and the
+        files are yielded lazily. In the sharded layout the keys of all the
+        shards are read and sorted first.
+
+        Internal keys, as renditions, are only yielded if internal is True.
+        """
+
+        def is_hidden(name: str) -> bool:
+            if not name.startswith(INTERNAL_PREFIX):
+                return False
+            return not internal or name.startswith(TMP_PREFIX) or name == SHARDS_DIR
+
+        def list_recursive(path: str, dir_key: str) -> Generator[FileData, None, None]:
+            # only one directory is kept in memory at a time, as it must be sorted
+            with os.scandir(path) as it:
+                entries = [
+                    # "a/..." keys sort after "a-b", so sort dirs with the slash
+                    (entry.name + "/" if entry.is_dir() else entry.name, entry)
+                    for entry in it
+                    if not is_hidden(entry.name)
+                ]
+            entries.sort(key=lambda item: item[0])
+
+            for sort_name, entry in entries:
+                key = dir_key + sort_name
+                if sort_name.endswith("/"):
+                    if not (key.startswith(prefix) or prefix.startswith(key)):
+                        continue
+                    if start_after is not None and (
+                        # as when a delimiter listing restarts after it
+                        key + MAX_CHAR <= start_after
+                        or (key < start_after and not start_after.startswith(key))
+                    ):
+                        continue
+                    yield from list_recursive(entry.path, key)
+                else:
+                    if not key.startswith(prefix):
+                        continue
+                    if start_after is not None and key <= start_after:
+                        continue
+                    # DirEntry caches the stat, this is the only syscall per file
+                    stat = entry.stat()
                     yield FileData(
-                        key=os.path.join(prefix, file),
-                        size=os.path.getsize(os.path.join(path, file)),
+                        key=key,
+                        size=stat.st_size,
                         last_modified=datetime.fromtimestamp(
-                            os.path.getmtime(os.path.join(path, file)),
-                            tz=timezone.utc,
+                            stat.st_mtime, tz=timezone.utc
                         ),
                     )
-            # then list directories
-            for file in files:
-                if os.path.isdir(os.path.join(path, file)):
-                    yield from list_recursive(
-                        os.path.join(path, file), os.path.join(prefix, file)
-                    )
+
+        def list_shards(path: str) -> Generator[FileData, None, None]:
+            files = []
+            for first in scandir_dirs(path):
+                for second in scandir_dirs(first):
+                    files.extend(list_recursive(second, ""))
+            files.sort(key=lambda file: file.key)
+            yield from files
 
         bucket_path = Path(self.path) / bucket
         if not bucket_path.exists():
             raise NoSuchBucketError(f"Bucket {bucket} does not exist")
-
-        ret = list(
-            islice(
-                list_recursive(bucket_path, ""),
-                start,
-                start + limit,
-            )
-        )
-        # logger.debug("Found files count=%s", ret)
-        return ret
+        if self.layout == "sharded":
+            return list_shards(str(bucket_path / SHARDS_DIR))
+        return list_recursive(str(bucket_path), "")
 
     @contextmanager
     def open_read(self, bucket: str, file: str) -> Generator[BinaryIO, None, None]:
-        filepath = Path(self.path) / bucket / file
-        if not filepath.exists():
+        filepath = self.file_path(bucket, file)
+        if not filepath.is_file():
             raise NoSuchFileError(f"File {file} does not exist")
         logger.debug("Opening file for reading: bucket=%s file=%s", bucket, file)
         with open(filepath, "rb") as f:
             yield f
 
+    def read_range(
+        self, bucket: str, file: str, start: int, end: int, chunk_size: int = 65536
+    ) -> Generator[bytes, None, None]:
+        filepath = self.file_path(bucket, file)
+        if not filepath.is_file():
+            raise NoSuchFileError(f"File {file} does not exist")
+        # pread reads at an offset without buffering more than asked for
+        fd = os.open(filepath, os.O_RDONLY)
+        try:
+            offset = start
+            while offset < end:
+                chunk = os.pread(fd, min(chunk_size, end - offset), offset)
+                if not chunk:
+                    break
+                offset += len(chunk)
+                yield chunk
+        finally:
+            os.close(fd)
+
     @contextmanager
     def open_write(self, bucket: str, file: str) -> Generator[BinaryIO, None, None]:
-        filepath = Path(self.path) / bucket / file
+        """
+        Writes to a temporary file in the same directory, which replaces the
+        file atomically once written and synced. Readers never see a partial
+        file, and if the writer fails the old file is kept.
+        """
+        filepath = self.file_path(bucket, file)
         filepath.parent.mkdir(parents=True, exist_ok=True)
         logger.debug("Opening file for writing: bucket=%s file=%s", bucket, file)
-        with open(filepath, "wb") as f:
-            yield f
+        fd, tmppath = tempfile.mkstemp(dir=filepath.parent, prefix=TMP_PREFIX)
+        try:
+            os.fchmod(fd, 0o666 & ~UMASK)
+            with os.fdopen(fd, "wb") as f:
+                yield f
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(tmppath, filepath)
+        except BaseException:
+            os.unlink(tmppath)
+            raise
+        fsync_dir(filepath.parent)
+        if self.index is not None and not is_internal_key(file):
+            self.index.put(self.name, bucket, self.stat(bucket, file))
+        events.notify_change(self.name, bucket, file)
 
     def delete_file(self, bucket: str, file: str) -> None:
         logger.debug("Deleting file: bucket=%s file=%s", bucket, file)
-        filepath = Path(self.path) / bucket / file
+        filepath = self.file_path(bucket, file)
         if not filepath.exists():
             raise NoSuchFileError(f"File {file} does not exist")
         filepath.unlink()
+        if self.index is not None:
+            self.index.delete(self.name, bucket, file)
+        events.notify_change(self.name, bucket, file)
 
     def stat(self, bucket: str, file: str) -> FileData:
         logger.debug("Statting file: bucket=%s file=%s", bucket, file)
-        filepath = Path(self.path) / bucket / file
-        if not filepath.exists():
+        filepath = self.file_path(bucket, file)
+        try:
+            statdata = filepath.stat()
+        except (FileNotFoundError, NotADirectoryError):
+            statdata = None
+        # directories under the bucket are not files
+        if statdata is None or not S_ISREG(statdata.st_mode):
             raise NoSuchFileError(f"File {file} does not exist")
 
-        statdata = filepath.stat()
         return FileData(
             key=file,
             size=statdata.st_size,
@@ -139,3 +370,8 @@ class DiskStorage(Storage):
                 tz=timezone.utc,
             ),
         )
+
+    def local_path(
+        self, bucket: str, file: str, stat: FileData | None = None
+    ) -> str | None:
+        return os.path.abspath(self.file_path(bucket, file))
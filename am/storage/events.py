@@ -0,0 +1,47 @@
+"""
+Change notifications for storage backends.
+
+Caches and indexes built on top of a storage subscribe here to learn when a
+file is written or deleted, so they can drop whatever they derived from it.
+"""
+
+import logging
+from typing import Callable
+
+logger = logging.getLogger(__name__)
+
+# callback(storage_name, bucket, key). key is None when the whole bucket changed.
+type ChangeListener = Callable[[str, str, str | None], None]
+
+_listeners: list[ChangeListener] = []
+
+
+def on_change(listener: ChangeListener) -> ChangeListener:
+    """
+    Register a listener to be called whenever a file or bucket changes.
+
+    Can be used as a decorator.
+    """
+    _listeners.append(listener)
+    return listener
+
+
+def remove_listener(listener: ChangeListener) -> None:
+    """
+    Unregister a listener previously registered with on_change.
+    """
+    if listener in _listeners:
+        _listeners.remove(listener)
+
+
+def notify_change(storage_name: str, bucket: str, key: str | None = None) -> None:
+    """
+    Notify all listeners that a file (or a whole bucket if key is None) changed.
+
+    Listener errors are logged and never propagate to the writer.
+    """
+    for listener in _listeners:
+        try:
+            listener(storage_name, bucket, key)
+        except Exception:
+            logger.exception("Error in change listener: bucket=%s key=%s", bucket, key)
@@ -1,7 +1,22 @@
+"""
+Storage backends factory and registry.
+
+Each backend is built once, when the config is loaded, and shared by all the
+requests. Buckets are resolved to their backend through the buckets section of
+the config, and the result is cached.
+
+The registry can watch the config file and reload it when it changes. Backends
+whose config did not change are kept, so their caches and connections survive.
+"""
+
 from am.storage.types import Storage
 from am.storage.disk import DiskStorage
-from am.config import config, StorageConfig
+from am.storage.blob import BlobStorage
+from am.storage.tiered import TieredStorage
+from am.config import config, reload_config, StorageConfig
 import logging
+import os
+import threading
 
 logger = logging.getLogger(__name__)
 
@@ -10,20 +25,122 @@ def create_storage(config: StorageConfig) -> Storage:
     """
     Create a storage backend from the config.
     """
-    logger.debug(f"Creating storage backend: {config and config.name}")
+    logger.debug("Creating storage backend: %s", config.name)
     if config.type == "disk":
         return DiskStorage(config)
+    if config.type == "blob":
+        return BlobStorage(config)
+    if config.type == "tiered":
+        return TieredStorage(config)
+    if config.type == "s3":
+        # boto3 is optional, only needed for this backend
+        from am.storage.s3 import S3Storage
+
+        return S3Storage(config)
     raise ValueError(f"Unknown storage type: {config.type}")
 
 
+class StorageRegistry:
+    """
+    Keeps a single instance of each configured storage backend.
+    """
+
+    def __init__(self):
+        self.backends: dict[str, Storage] = {}
+        self.buckets: dict[str, Storage] = {}
+        self.lock = threading.Lock()
+        self.watcher: threading.Thread | None = None
+        self.stop_watching = threading.Event()
+
+    def load(self) -> None:
+        """
+        Build the backends from the current config, keeping the ones that did
+        not change and closing the removed ones.
+        """
+        with self.lock:
+            backends = {}
+            for name, storage_config in config.storage.items():
+                current = self.backends.get(name)
+                if current is not None and current.config == storage_config:
+                    backends[name] = current
+                else:
+                    backends[name] = create_storage(storage_config)
+            removed = [
+                storage
+                for name, storage in self.backends.items()
+                if backends.get(name) is not storage
+            ]
+            self.backends = backends
+            self.buckets = {}
+        for storage in removed:
+            logger.info("Closing storage backend=%s", storage.config.name)
+            storage.close()
+
+    def get(self, name: str) -> Storage:
+        """
+        Get a backend by its name.
+        """
+        if not self.backends:
+            # first use, load it lazily
+            self.load()
+        storage = self.backends.get(name)
+        if storage is None:
+            raise ValueError(f"Storage backend {name} not found")
+        return storage
+
+    def for_bucket(self, bucket: str) -> Storage:
+        """
+        Get the backend of a bucket.
+        """
+        storage = self.buckets.get(bucket)
+        if storage is None:
+            storage = self.get(config.bucket(bucket).storage)
+            self.buckets[bucket] = storage
+        return storage
+
+    def watch(self, path: str, interval: float) -> None:
+        """
+        Start a thread that reloads the config when the file at path changes.
+        """
+        if self.watcher is not None:
+            return
+        self.stop_watching.clear()
+        self.watcher = threading.Thread(
+            target=self.watch_loop, args=(path, interval), daemon=True
+        )
+        self.watcher.start()
+
+    def watch_loop(self, path: str, interval: float) -> None:
+        mtime = os.path.getmtime(path)
+        while not self.stop_watching.wait(interval):
+            try:
+                current = os.path.getmtime(path)
+                if current == mtime:
+                    continue
+                mtime = current
+                logger.info("Config changed, reloading path=%s", path)
+                reload_config(path)
+                self.load()
+            except Exception:
+                logger.exception("Error reloading config path=%s", path)
+
+    def stop(self) -> None:
+        """
+        Stop watching the config.
+        """
+        self.stop_watching.set()
+        if self.watcher is not None:
+            self.watcher.join()
+            self.watcher = None
+
+
+registry = StorageRegistry()
+
+
 def get_storage(name: str) -> Storage:
     """
-    Get a storage backend from the config.
+    Get the storage backend of a bucket.
 
-    TODO: there needs to be a map in db for bucket to storage backend.
+    Backends are built once and shared by all the requests.
     """
-    logger.debug(f"Getting storage backend for bucket={name}")
-    storage_config = config.storage.get("default")
-    if storage_config is None:
-        raise ValueError(f"Storage backend for bucket={name} not found")
-    return create_storage(storage_config)
+    return registry.for_bucket(name)
@@ -0,0 +1,256 @@
+"""
+SQLite metadata index of the stored files.
+
+Backends with `index: true` in their config keep the index in sync on every
+write and delete, and list files from it instead of walking the storage.
+Buckets are indexed from the stored files the first time they are listed, as
+when the index is turned on for existing data.
+
+If the index gets out of sync, as when files are copied into the data
+directory by hand, it can be rebuilt with:
+
+    python -m am.storage.index --config config.yaml [--storage default] [bucket...]
+"""
+
+import argparse
+import logging
+import os
+import sqlite3
+import sys
+import threading
+from datetime import datetime, timezone
+from typing import Generator, Iterable
+
+from am.config import config
+from am.storage.types import FileData
+
+logger = logging.getLogger(__name__)
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS files (
+    storage TEXT NOT NULL,
+    bucket TEXT NOT NULL,
+    key TEXT NOT NULL,
+    size INTEGER NOT NULL,
+    last_modified REAL NOT NULL,
+    etag TEXT,
+    PRIMARY KEY (storage, bucket, key)
+) WITHOUT ROWID;
+
+CREATE TABLE IF NOT EXISTS buckets (
+    storage TEXT NOT NULL,
+    bucket TEXT NOT NULL,
+    PRIMARY KEY (storage, bucket)
+) WITHOUT ROWID;
+"""
+
+BATCH_SIZE = 1000
+
+
+class MetadataIndex:
+    """
+    Index of the files metadata, by storage, bucket and key.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self.local = threading.local()
+        dirname = os.path.dirname(path)
+        if dirname:
+            os.makedirs(dirname, exist_ok=True)
+        self.connection().executescript(SCHEMA)
+
+    def connection(self) -> sqlite3.Connection:
+        """
+        Get the connection of the current thread.
+        """
+        conn = getattr(self.local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=30)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self.local.conn = conn
+        return conn
+
+    def put(self, storage: str, bucket: str, file: FileData) -> None:
+        with self.connection() as conn:
+            conn.execute(
+                "INSERT OR REPLACE INTO files VALUES (?, ?, ?, ?, ?, ?)",
+                (
+                    storage,
+                    bucket,
+                    file.key,
+                    file.size,
+                    file.last_modified.timestamp(),
+                    file.etag,
+                ),
+            )
+
+    def delete(self, storage: str, bucket: str, key: str) -> None:
+        with self.connection() as conn:
+            conn.execute(
+                "DELETE FROM files WHERE storage = ? AND bucket = ? AND key = ?",
+                (storage, bucket, key),
+            )
+
+    def delete_bucket(self, storage: str, bucket: str) -> None:
+        with self.connection() as conn:
+            conn.execute(
+                "DELETE FROM files WHERE storage = ? AND bucket = ?",
+                (storage, bucket),
+            )
+            conn.execute(
+                "DELETE FROM buckets WHERE storage = ? AND bucket = ?",
+                (storage, bucket),
+            )
+
+    def is_indexed(self, storage: str, bucket: str) -> bool:
+        """
+        Whether the bucket was reconciled, so its files are all in the index.
+        """
+        row = (
+            self.connection()
+            .execute(
+                "SELECT 1 FROM buckets WHERE storage = ? AND bucket = ?",
+                (storage, bucket),
+            )
+            .fetchone()
+        )
+        return row is not None
+
+    def get(self, storage: str, bucket: str, key: str) -> FileData | None:
+        row = (
+            self.connection()
+            .execute(
+                "SELECT key, size, last_modified, etag FROM files "
+                "WHERE storage = ? AND bucket = ? AND key = ?",
+                (storage, bucket, key),
+            )
+            .fetchone()
+        )
+        return row and self.to_file_data(row)
+
+    def scan(
+        self,
+        storage: str,
+        bucket: str,
+        prefix: str = "",
+        start_after: str | None = None,
+    ) -> Generator[FileData, None, None]:
+        """
+        Yield the files with the given prefix, after start_after, in key order.
+
+        Rows are read in batches, with no cursor kept open between them, so
+        the generator can be consumed from different threads.
+        """
+        if start_after is None or start_after < prefix:
+            # keys starting with prefix are >= prefix
+            query = "key >= ?"
+            position = prefix
+        else:
+            query = "key > ?"
+            position = start_after
+        while True:
+            rows = (
+                self.connection()
+                .execute(
+                    "SELECT key, size, last_modified, etag FROM files "
+                    f"WHERE storage = ? AND bucket = ? AND {query} "
+                    "ORDER BY key LIMIT ?",
+                    (storage, bucket, position, BATCH_SIZE),
+                )
+                .fetchall()
+            )
+            for row in rows:
+                if not row[0].startswith(prefix):
+                    return
+                yield self.to_file_data(row)
+            if len(rows) < BATCH_SIZE:
+                return
+            query = "key > ?"
+            position = rows[-1][0]
+
+    def reconcile(self, storage: str, bucket: str, files: Iterable[FileData]) -> int:
+        """
+        Replace the index of a bucket with the given files. Returns the count.
+        """
+        count = 0
+        with self.connection() as conn:
+            conn.execute(
+                "DELETE FROM files WHERE storage = ? AND bucket = ?",
+                (storage, bucket),
+            )
+            for file in files:
+                conn.execute(
+                    "INSERT OR REPLACE INTO files VALUES (?, ?, ?, ?, ?, ?)",
+                    (
+                        storage,
+                        bucket,
+                        file.key,
+                        file.size,
+                        file.last_modified.timestamp(),
+                        file.etag,
+                    ),
+                )
+                count += 1
+            conn.execute(
+                "INSERT OR IGNORE INTO buckets VALUES (?, ?)", (storage, bucket)
+            )
+        return count
+
+    def to_file_data(self, row: tuple) -> FileData:
+        key, size, last_modified, etag = row
+        return FileData(
+            key=key,
+            size=size,
+            last_modified=datetime.fromtimestamp(last_modified, tz=timezone.utc),
+            etag=etag,
+        )
+
+
+_indexes: dict[str, MetadataIndex] = {}
+_indexes_lock = threading.Lock()
+
+
+def get_index() -> MetadataIndex:
+    """
+    Get the index at the database url of the config.
+    """
+    url = config.database.url
+    if not url.startswith("sqlite://"):
+        raise ValueError(f"Unsupported database url: {url}")
+    path = url.removeprefix("sqlite://")
+    with _indexes_lock:
+        if path not in _indexes:
+            logger.debug("Opening metadata index path=%s", path)
+            _indexes[path] = MetadataIndex(path)
+        return _indexes[path]
+
+
+def main():
+    """
+    Rebuild the index of the given storage and buckets from the stored files.
+    """
+    from am.config import load_config
+    from am.storage.factory import registry
+
+    parser = argparse.ArgumentParser(description="Rebuild the metadata index")
+    parser.add_argument("buckets", nargs="*", help="Buckets to rebuild, all if none")
+    parser.add_argument("--config", type=str, default="config.yaml")
+    parser.add_argument("--storage", type=str, default="default")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    load_config(args.config)
+    storage = registry.get(args.storage)
+    index = get_index()
+    buckets = args.buckets or [
+        bucket.name for bucket in storage.list_buckets(limit=sys.maxsize)
+    ]
+    for bucket in buckets:
+        count = index.reconcile(storage.name, bucket, storage.walk_files(bucket))
+        logger.info("Reindexed bucket=%s files=%s", bucket, count)
+
+
+if __name__ == "__main__":
+    main()
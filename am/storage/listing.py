@@ -0,0 +1,116 @@
+"""
+Paginated listing with prefix, delimiter and continuation tokens.
+
+It works on top of any scan function that yields the files of a bucket in key
+order, starting after a given key. Common prefixes are skipped by restarting
+the scan after them, so a page costs about its size and not all the keys
+before it.
+"""
+
+import base64
+import binascii
+from typing import Callable, Generator, Iterator
+
+from am.storage.types import FileData, ListPage
+
+# sorts after any key that starts with the same prefix
+MAX_CHAR = "\U0010ffff"
+
+type Scan = Callable[[str, str | None], Iterator[FileData]]
+
+
+class InvalidTokenError(ValueError):
+    """
+    InvalidTokenError is raised when a continuation token can not be decoded.
+    """
+
+
+def encode_token(start_after: str) -> str:
+    return base64.urlsafe_b64encode(start_after.encode("utf-8")).decode("ascii")
+
+
+def decode_token(token: str) -> str:
+    try:
+        return base64.b64decode(token, altchars=b"-_", validate=True).decode("utf-8")
+    except (binascii.Error, UnicodeError, ValueError):
+        raise InvalidTokenError(f"Invalid continuation token {token}")
+
+
+def iter_listing(
+    scan: Scan,
+    prefix: str = "",
+    delimiter: str | None = None,
+    start_after: str | None = None,
+) -> Generator[FileData | str, None, None]:
+    """
+    Yield the files under prefix in key order, after start_after.
+
+    With a delimiter, keys with the delimiter after the prefix are grouped and
+    yielded once as their common prefix, a str.
+    """
+    while True:
+        restart = None
+        for file in scan(prefix, start_after):
+            if delimiter:
+                index = file.key.find(delimiter, len(prefix))
+                if index >= 0:
+                    common_prefix = file.key[: index + len(delimiter)]
+                    yield common_prefix
+                    restart = common_prefix + MAX_CHAR
+                    break
+            yield file
+            start_after = file.key
+        if restart is None:
+            return
+        start_after = restart
+
+
+class LimitedListing:
+    """
+    Iterates a listing up to max_keys entries, files or common prefixes.
+
+    Once iterated, next_token continues the listing if it was cut, or is None.
+    """
+
+    def __init__(self, entries: Iterator[FileData | str], max_keys: int | None):
+        self.entries = entries
+        self.max_keys = max_keys
+        self.next_token: str | None = None
+
+    def __iter__(self) -> Generator[FileData | str, None, None]:
+        count = 0
+        start_after = None
+        for entry in self.entries:
+            if count == self.max_keys:
+                self.next_token = encode_token(start_after)
+                return
+            if isinstance(entry, str):
+                start_after = entry + MAX_CHAR
+            else:
+                start_after = entry.key
+            yield entry
+            count += 1
+
+
+def list_page(
+    scan: Scan,
+    prefix: str = "",
+    delimiter: str | None = None,
+    token: str | None = None,
+    max_keys: int = 1000,
+) -> ListPage:
+    """
+    Get a page of at most max_keys files and common prefixes.
+    """
+    start_after = decode_token(token) if token else None
+    listing = LimitedListing(
+        iter_listing(scan, prefix, delimiter, start_after), max_keys
+    )
+    page = ListPage()
+    for entry in listing:
+        if isinstance(entry, str):
+            page.common_prefixes.append(entry)
+        else:
+            page.files.append(entry)
+    page.next_token = listing.next_token
+    return page
@@ -0,0 +1,115 @@
+"""
+Move the files of a disk storage to the layout set at its config.
+
+After changing `layout` of a disk storage, as to `sharded`, stop the server and
+move the existing files with:
+
+    python -m am.storage.migrate --config config.yaml [--storage default] [bucket...]
+
+Files are renamed in place, so it is fast and needs no extra space. Keys,
+modification times and so the metadata index do not change.
+"""
+
+import argparse
+import dataclasses
+import logging
+import os
+import sys
+
+from am.storage.disk import LAYOUTS, SHARDS_DIR, DiskStorage
+
+logger = logging.getLogger(__name__)
+
+
+def migrate_bucket(source: DiskStorage, target: DiskStorage, bucket: str) -> int:
+    """
+    Move the files of a bucket from the source layout to the target one.
+    Returns the count of moved files.
+    """
+    count = 0
+    for file in source.walk_files(bucket, internal=True):
+        source_path = source.file_path(bucket, file.key)
+        target_path = target.file_path(bucket, file.key)
+        target_path.parent.mkdir(parents=True, exist_ok=True)
+        os.replace(source_path, target_path)
+        count += 1
+    remove_empty_dirs(source, bucket)
+    return count
+
+
+def remove_empty_dirs(source: DiskStorage, bucket: str) -> None:
+    """
+    Remove the directories left empty in the source layout of a bucket.
+    """
+    bucket_path = os.path.join(source.path, bucket)
+    if source.layout == "sharded":
+        top = os.path.join(bucket_path, SHARDS_DIR)
+    else:
+        top = bucket_path
+    for dirpath, dirnames, _ in os.walk(top, topdown=False):
+        if dirpath == bucket_path:
+            continue
+        if source.layout == "direct" and dirpath.startswith(
+            os.path.join(bucket_path, SHARDS_DIR)
+        ):
+            continue
+        try:
+            os.rmdir(dirpath)
+        except OSError:
+            # not empty
+            pass
+
+
+def main():
+    """
+    Move the files of the given storage and buckets to its configured layout.
+    """
+    from am.config import config, load_config
+    from am.storage.factory import registry
+
+    parser = argparse.ArgumentParser(description="Migrate a disk storage layout")
+    parser.add_argument("buckets", nargs="*", help="Buckets to migrate, all if none")
+    parser.add_argument("--config", type=str, default="config.yaml")
+    parser.add_argument("--storage", type=str, default="default")
+    parser.add_argument(
+        "--from",
+        dest="source_layout",
+        choices=LAYOUTS,
+        help="Current layout of the files, the other one by default",
+    )
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    load_config(args.config)
+    target = registry.get(args.storage)
+    if not isinstance(target, DiskStorage):
+        parser.error(f"Storage {args.storage} is not a disk storage")
+    source_layout = args.source_layout or next(
+        layout for layout in LAYOUTS if layout != target.layout
+    )
+    if source_layout == target.layout:
+        parser.error(f"Storage {args.storage} already has layout {source_layout}")
+
+    storage_config = config.storage[args.storage]
+    source = DiskStorage(
+        dataclasses.replace(
+            storage_config,
+            config={**storage_config.config, "layout": source_layout, "index": False},
+        )
+    )
+    buckets = args.buckets or [
+        bucket.name for bucket in target.list_buckets(limit=sys.maxsize)
+    ]
+    for bucket in buckets:
+        count = migrate_bucket(source, target, bucket)
+        logger.info(
+            "Migrated bucket=%s files=%s from=%s to=%s",
+            bucket,
+            count,
+            source_layout,
+            target.layout,
+        )
+
+
+if __name__ == "__main__":
+    main()
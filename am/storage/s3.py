@@ -0,0 +1,474 @@
+"""
+S3Storage is a storage backend on any S3 compatible object store, as AWS S3,
+MinIO or Ceph.
+
+All the buckets of the backend live in a single S3 bucket, each under its own
+key prefix:
+
+    s3://<bucket>/<prefix><am bucket>/<key>
+
+A bucket exists while its marker object, `<am bucket>/.am-bucket`, exists.
+
+Clients are shared by all the backends with the same endpoint and
+credentials, and keep a bounded pool of keep alive connections, so requests
+do not pay a new TCP and TLS handshake. Large uploads are sent as multipart
+uploads while they are streamed, with several parts in flight at once, and
+reads use ranged GETs.
+
+It needs boto3, installed with the `s3` extra.
+"""
+
+import io
+import logging
+import threading
+from concurrent.futures import Future, ThreadPoolExecutor
+from contextlib import contextmanager
+from datetime import datetime, timezone
+from itertools import islice
+from typing import BinaryIO, Generator
+
+import boto3
+from botocore.config import Config as BotoConfig
+from botocore.exceptions import ClientError
+
+from am.config import StorageConfig
+from am.storage import events
+from am.storage.listing import iter_listing, list_page
+from am.storage.types import (
+    INTERNAL_PREFIX,
+    BucketData,
+    FileData,
+    ListPage,
+    NoSuchBucketError,
+    NoSuchFileError,
+    Storage,
+    is_internal_key,
+)
+
+logger = logging.getLogger(__name__)
+
+BUCKET_MARKER = INTERNAL_PREFIX + "bucket"
+
+DEFAULT_MAX_CONNECTIONS = 32
+# S3 needs parts of at least 5 MiB, but the last one
+DEFAULT_PART_SIZE = 8 * 1024 * 1024
+DEFAULT_MAX_CONCURRENCY = 4
+
+_clients: dict[tuple, object] = {}
+_clients_lock = threading.Lock()
+
+
+def get_client(config: dict):
+    """
+    Get the S3 client for the endpoint and credentials of the config, shared
+    by all the backends using them.
+    """
+    key = (
+        config.get("endpoint_url"),
+        config.get("region"),
+        config.get("access_key_id"),
+        config.get("secret_access_key"),
+        int(config.get("max_connections", DEFAULT_MAX_CONNECTIONS)),
+    )
+    with _clients_lock:
+        client = _clients.get(key)
+        if client is None:
+            endpoint_url, region, access_key_id, secret_access_key, max_connections = (
+                key
+            )
+            logger.debug("Creating S3 client endpoint=%s", endpoint_url)
+            client = boto3.session.Session().client(
+                "s3",
+                endpoint_url=endpoint_url,
+                region_name=region,
+                aws_access_key_id=access_key_id,
+                aws_secret_access_key=secret_access_key,
+                config=BotoConfig(
+                    max_pool_connections=max_connections,
+                    tcp_keepalive=True,
+                    retries={"max_attempts": 3, "mode": "standard"},
+                ),
+            )
+            _clients[key] = client
+        return client
+
+
+def is_not_found(error: ClientError) -> bool:
+    code = error.response.get("Error", {}).get("Code")
+    return code in ("404", "NoSuchKey", "NotFound")
+
+
+class RangedReader(io.RawIOBase):
+    """
+    Seekable reader of an object, reading from the current position with a
+    ranged GET, and starting a new one only when seeking.
+    """
+
+    def __init__(self, client, bucket: str, key: str, size: int):
+        self.client = client
+        self.bucket = bucket
+        self.key = key
+        self.size = size
+        self.position = 0
+        self.body = None
+
+    def readable(self) -> bool:
+        return True
+
+    def seekable(self) -> bool:
+        return True
+
+    def tell(self) -> int:
+        return self.position
+
+    def seek(self, offset: int, whence: int = io.SEEK_SET) -> int:
+        if whence == io.SEEK_CUR:
+            offset += self.position
+        elif whence == io.SEEK_END:
+            offset += self.size
+        if offset != self.position:
+            self.close_body()
+            self.position = offset
+        return self.position
+
+    def readinto(self, buffer) -> int:
+        if self.position >= self.size:
+            return 0
+        if self.body is None:
+            response = self.client.get_object(
+                Bucket=self.bucket, Key=self.key, Range=f"bytes={self.position}-"
+            )
+            self.body = response["Body"]
+        data = self.body.read(len(buffer))
+        buffer[: len(data)] = data
+        self.position += len(data)
+        return len(data)
+
+    def close_body(self) -> None:
+        if self.body is not None:
+            self.body.close()
+            self.body = None
+
+    def close(self) -> None:
+        self.close_body()
+        super().close()
+
+
+class MultipartWriter:
+    """
+    Writer that sends an object as a multipart upload while it is written.
+
+    Parts are uploaded in the backend executor, at most max_concurrency at a
+    time per writer, so memory is bounded to about max_concurrency parts.
+    Objects smaller than a part are sent with a single PUT.
+    """
+
+    def __init__(
+        self,
+        client,
+        executor: ThreadPoolExecutor,
+        bucket: str,
+        key: str,
+        part_size: int,
+        max_concurrency: int,
+    ):
+        self.client = client
+        self.executor = executor
+        self.bucket = bucket
+        self.key = key
+        self.part_size = part_size
+        self.max_concurrency = max_concurrency
+        self.buffer = bytearray()
+        self.upload_id: str | None = None
+        self.parts: list[Future] = []
+
+    def write(self, data: bytes) -> int:
+        self.buffer += data
+        while len(self.buffer) >= self.part_size:
+            self.send_part(bytes(self.buffer[: self.part_size]))
+            del self.buffer[: self.part_size]
+        return len(data)
+
+    def send_part(self, data: bytes) -> None:
+        if self.upload_id is None:
+            response = self.client.create_multipart_upload(
+                Bucket=self.bucket, Key=self.key
+            )
+            self.upload_id = response["UploadId"]
+        in_flight = [part for part in self.parts if not part.done()]
+        if len(in_flight) >= self.max_concurrency:
+            in_flight[0].result()
+        number = len(self.parts) + 1
+        self.parts.append(self.executor.submit(self.upload_part, number, data))
+
+    def upload_part(self, number: int, data: bytes) -> dict:
+        response = self.client.upload_part(
+            Bucket=self.bucket,
+            Key=self.key,
+            UploadId=self.upload_id,
+            PartNumber=number,
+            Body=data,
+        )
+        return {"PartNumber": number, "ETag": response["ETag"]}
+
+    def commit(self) -> None:
+        if self.upload_id is None:
+            self.client.put_object(
+                Bucket=self.bucket, Key=self.key, Body=bytes(self.buffer)
+            )
+            return
+        if self.buffer:
+            self.send_part(bytes(self.buffer))
+            self.buffer.clear()
+        parts = [part.result() for part in self.parts]
+        self.client.complete_multipart_upload(
+            Bucket=self.bucket,
+            Key=self.key,
+            UploadId=self.upload_id,
+            MultipartUpload={"Parts": parts},
+        )
+
+    def abort(self) -> None:
+        for part in self.parts:
+            part.cancel()
+        if self.upload_id is not None:
+            try:
+                self.client.abort_multipart_upload(
+                    Bucket=self.bucket, Key=self.key, UploadId=self.upload_id
+                )
+            except ClientError:
+                logger.exception("Error aborting multipart upload key=%s", self.key)
+
+
+class S3Storage(Storage):
+    """
+    S3Storage is a storage backend on an S3 compatible object store.
+    """
+
+    def __init__(self, config: StorageConfig):
+        self.config = config
+        self.name = config.name
+        self.bucket = config.config["bucket"]
+        self.prefix = config.config.get("prefix", "")
+        self.part_size = int(config.config.get("part_size", DEFAULT_PART_SIZE))
+        self.max_concurrency = int(
+            config.config.get("max_concurrency", DEFAULT_MAX_CONCURRENCY)
+        )
+        self.client = get_client(config.config)
+        self.executor = ThreadPoolExecutor(
+            max_workers=self.max_concurrency, thread_name_prefix=f"s3-{self.name}"
+        )
+
+    def object_key(self, bucket: str, file: str) -> str:
+        return f"{self.prefix}{bucket}/{file}"
+
+    def close(self) -> None:
+        self.executor.shutdown(wait=True)
+
+    def create_bucket(self, name: str) -> None:
+        logger.debug("Creating bucket=%s", name)
+        self.client.put_object(
+            Bucket=self.bucket, Key=self.object_key(name, BUCKET_MARKER), Body=b""
+        )
+
+    def delete_bucket(self, name: str) -> None:
+        logger.debug("Deleting bucket=%s", name)
+        self.check_bucket(name)
+        paginator = self.client.get_paginator("list_objects_v2")
+        for page in paginator.paginate(
+            Bucket=self.bucket, Prefix=self.object_key(name, "")
+        ):
+            objects = [{"Key": item["Key"]} for item in page.get("Contents", [])]
+            if objects:
+                self.client.delete_objects(
+                    Bucket=self.bucket, Delete={"Objects": objects, "Quiet": True}
+                )
+        events.notify_change(self.name, name)
+
+    def check_bucket(self, bucket: str) -> datetime:
+        """
+        Raise NoSuchBucketError if the bucket does not exist, or else get its
+        creation date.
+        """
+        try:
+            response = self.client.head_object(
+                Bucket=self.bucket, Key=self.object_key(bucket, BUCKET_MARKER)
+            )
+        except ClientError as e:
+            if is_not_found(e):
+                raise NoSuchBucketError(f"Bucket {bucket} does not exist")
+            raise
+        return response["LastModified"]
+
+    def list_buckets(self, start: int = 0, limit: int = 100) -> list[BucketData]:
+        logger.debug("Listing buckets: start=%s limit=%s", start, limit)
+        paginator = self.client.get_paginator("list_objects_v2")
+        names = (
+            common_prefix["Prefix"].removeprefix(self.prefix).removesuffix("/")
+            for page in paginator.paginate(
+                Bucket=self.bucket, Prefix=self.prefix, Delimiter="/"
+            )
+            for common_prefix in page.get("CommonPrefixes", [])
+        )
+        buckets = []
+        for name in islice(names, start, start + limit):
+            try:
+                creation_date = self.check_bucket(name)
+            except NoSuchBucketError:
+                # keys written under a prefix that was never created as bucket
+                continue
+            buckets.append(BucketData(name=name, creation_date=creation_date))
+        return buckets
+
+    def list_files(
+        self, bucket: str, start: int = 0, limit: int = 100
+    ) -> list[FileData]:
+        logger.debug("Listing files: bucket=%s start=%s limit=%s", bucket, start, limit)
+        return list(islice(self.scan_files(bucket), start, start + limit))
+
+    def list_page(
+        self,
+        bucket: str,
+        prefix: str = "",
+        delimiter: str | None = None,
+        token: str | None = None,
+        max_keys: int = 1000,
+    ) -> ListPage:
+        logger.debug(
+            "Listing page: bucket=%s prefix=%s delimiter=%s max_keys=%s",
+            bucket,
+            prefix,
+            delimiter,
+            max_keys,
+        )
+
+        def scan(prefix: str, start_after: str | None):
+            return self.scan_files(bucket, prefix, start_after)
+
+        return list_page(scan, prefix, delimiter, token, max_keys)
+
+    def iter_listing(
+        self,
+        bucket: str,
+        prefix: str = "",
+        delimiter: str | None = None,
+        start_after: str | None = None,
+    ) -> Generator[FileData | str, None, None]:
+        def scan(prefix: str, start_after: str | None):
+            return self.scan_files(bucket, prefix, start_after)
+
+        # check the bucket exists before streaming anything
+        scan(prefix, start_after)
+        return iter_listing(scan, prefix, delimiter, start_after)
+
+    def scan_files(
+        self, bucket: str, prefix: str = "", start_after: str | None = None
+    ) -> Generator[FileData, None, None]:
+        self.check_bucket(bucket)
+        return self.scan_objects(bucket, prefix, start_after)
+
+    def scan_objects(
+        self, bucket: str, prefix: str, start_after: str | None
+    ) -> Generator[FileData, None, None]:
+        """
+        Yield the objects in key order, a page of up to 1000 at a time. S3
+        sorts keys by their UTF-8 bytes, which is the same as by code points.
+        """
+        bucket_prefix = self.object_key(bucket, "")
+        params = {"Bucket": self.bucket, "Prefix": bucket_prefix + prefix}
+        if start_after is not None:
+            params["StartAfter"] = bucket_prefix + start_after
+        paginator = self.client.get_paginator("list_objects_v2")
+        for page in paginator.paginate(**params):
+            for item in page.get("Contents", []):
+                key = item["Key"].removeprefix(bucket_prefix)
+                if is_internal_key(key):
+                    continue
+                yield FileData(
+                    key=key,
+                    size=item["Size"],
+                    last_modified=item["LastModified"].astimezone(timezone.utc),
+                    etag=item["ETag"].strip('"'),
+                )
+
+    @contextmanager
+    def open_read(self, bucket: str, file: str) -> Generator[BinaryIO, None, None]:
+        logger.debug("Opening file for reading: bucket=%s file=%s", bucket, file)
+        stat = self.stat(bucket, file)
+        reader = io.BufferedReader(
+            RangedReader(
+                self.client, self.bucket, self.object_key(bucket, file), stat.size
+            ),
+            buffer_size=256 * 1024,
+        )
+        with reader:
+            yield reader
+
+    def read_range(
+        self, bucket: str, file: str, start: int, end: int, chunk_size: int = 65536
+    ) -> Generator[bytes, None, None]:
+        if end <= start:
+            return
+        try:
+            response = self.client.get_object(
+                Bucket=self.bucket,
+                Key=self.object_key(bucket, file),
+                Range=f"bytes={start}-{end - 1}",
+            )
+        except ClientError as e:
+            if is_not_found(e):
+                raise NoSuchFileError(f"File {file} does not exist")
+            raise
+        body = response["Body"]
+        try:
+            yield from body.iter_chunks(chunk_size)
+        finally:
+            body.close()
+
+    @contextmanager
+    def open_write(self, bucket: str, file: str) -> Generator[BinaryIO, None, None]:
+        """
+        Streams the file to the object store, as a multipart upload once it
+        is larger than a part. The object only appears once complete, and if
+        the writer fails the upload is aborted and the old object is kept.
+        """
+        logger.debug("Opening file for writing: bucket=%s file=%s", bucket, file)
+        writer = MultipartWriter(
+            self.client,
+            self.executor,
+            self.bucket,
+            self.object_key(bucket, file),
+            self.part_size,
+            self.max_concurrency,
+        )
+        try:
+            yield writer
+            writer.commit()
+        except BaseException:
+            writer.abort()
+            raise
+        events.notify_change(self.name, bucket, file)
+
+    def delete_file(self, bucket: str, file: str) -> None:
+        logger.debug("Deleting file: bucket=%s file=%s", bucket, file)
+        # S3 deletes succeed for missing keys too
+        self.stat(bucket, file)
+        self.client.delete_object(Bucket=self.bucket, Key=self.object_key(bucket, file))
+        events.notify_change(self.name, bucket, file)
+
+    def stat(self, bucket: str, file: str) -> FileData:
+        logger.debug("Statting file: bucket=%s file=%s", bucket, file)
+        try:
+            response = self.client.head_object(
+                Bucket=self.bucket, Key=self.object_key(bucket, file)
+            )
+        except ClientError as e:
+            if is_not_found(e):
+                raise NoSuchFileError(f"File {file} does not exist")
+            raise
+        return FileData(
+            key=file,
+            size=response["ContentLength"],
+            last_modified=response["LastModified"].astimezone(timezone.utc),
+            etag=response["ETag"].strip('"'),
+        )
@@ -0,0 +1,656 @@
+"""
+TieredStorage is a read-through cache in front of another storage backend.
+
+Objects read from the backend are kept on local disk, and the small ones also
+in memory, so hot objects are served at local speed whatever the backend is:
+
+    storage:
+      - name: remote
+        type: s3
+        ...
+      - name: cached
+        type: tiered
+        backend: remote
+        path: ./data/cached.tier/
+        max_size: 10737418240         # bytes on disk
+        max_object_size: 67108864     # larger objects are not cached
+        memory_max_size: 67108864     # bytes in memory
+        memory_max_object_size: 262144
+        stat_ttl: 5                   # seconds a backend stat is trusted
+        write: through                # or back
+
+Cached objects are checked against the backend stat at most every stat_ttl
+seconds, so changes made by other processes are seen after that.
+
+With `write: through`, writes go to the backend and are kept in the cache too.
+With `write: back`, they are written to local disk and uploaded in the
+background. They are served from the cache meanwhile, but do not show in
+listings until uploaded. Pending uploads survive restarts.
+
+The layout is:
+
+    <path>/<hash[:2]>/<hash>        content of the object
+    <path>/<hash[:2]>/<hash>.json   its bucket, key, stat and dirty flag
+
+with hash the SHA-256 of the bucket and key.
+"""
+
+import hashlib
+import io
+import json
+import logging
+import os
+import queue
+import tempfile
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import Future
+from contextlib import contextmanager
+from datetime import datetime, timezone
+from typing import BinaryIO, Generator
+
+from am import metrics
+from am.config import StorageConfig
+from am.lru import SizedLRU
+from am.storage import events
+from am.storage.disk import UMASK
+from am.storage.types import (
+    BucketData,
+    FileData,
+    ListPage,
+    NoSuchFileError,
+    Storage,
+)
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_MAX_SIZE = 1024 * 1024 * 1024
+DEFAULT_MAX_OBJECT_SIZE = 64 * 1024 * 1024
+DEFAULT_MEMORY_MAX_SIZE = 64 * 1024 * 1024
+DEFAULT_MEMORY_MAX_OBJECT_SIZE = 256 * 1024
+WRITE_MODES = ("through", "back")
+# seconds to wait before retrying a failed upload
+FLUSH_RETRY_INTERVAL = 5
+
+type ObjectKey = tuple[str, str]
+
+
+class TeeWriter:
+    """
+    Writer that sends the data to the backend and keeps a local copy, until
+    it gets larger than limit.
+    """
+
+    def __init__(self, remote: BinaryIO, local: BinaryIO, limit: int):
+        self.remote = remote
+        self.local = local
+        self.limit = limit
+        self.size = 0
+
+    @property
+    def complete(self) -> bool:
+        return self.size <= self.limit
+
+    def write(self, data: bytes) -> int:
+        self.size += len(data)
+        if self.complete:
+            self.local.write(data)
+        return self.remote.write(data)
+
+
+class TieredStorage(Storage):
+    """
+    TieredStorage caches the objects of a backend on local disk and memory.
+    """
+
+    def __init__(self, config: StorageConfig):
+        self.config = config
+        self.name = config.name
+        self.backend_name = config.config["backend"]
+        self.path = config.config["path"]
+        self.max_size = int(config.config.get("max_size", DEFAULT_MAX_SIZE))
+        self.max_object_size = int(
+            config.config.get("max_object_size", DEFAULT_MAX_OBJECT_SIZE)
+        )
+        self.memory_max_object_size = int(
+            config.config.get("memory_max_object_size", DEFAULT_MEMORY_MAX_OBJECT_SIZE)
+        )
+        self.stat_ttl = float(config.config.get("stat_ttl", 5))
+        self.write_mode = config.config.get("write", "through")
+        if self.write_mode not in WRITE_MODES:
+            raise ValueError(f"Unknown write mode: {self.write_mode}")
+
+        # (bucket, key) -> (stat, content)
+        self.memory = SizedLRU(
+            int(config.config.get("memory_max_size", DEFAULT_MEMORY_MAX_SIZE)),
+            size=lambda value: len(value[1]),
+        )
+        # (bucket, key) -> stat of the content on disk, least recently used first
+        self.entries: OrderedDict[ObjectKey, FileData] = OrderedDict()
+        self.size = 0
+        # entries written back and not yet uploaded, never evicted
+        self.dirty: set[ObjectKey] = set()
+        # (bucket, key) -> (backend stat, monotonic time it was checked)
+        self.stats: dict[ObjectKey, tuple[FileData, float]] = {}
+        # keys being written to the backend by this storage
+        self.writing: set[ObjectKey] = set()
+        # keys being downloaded, to the future of their path
+        self.fetching: dict[ObjectKey, Future[str | None]] = {}
+        self.lock = threading.Lock()
+        self.disk_hits = 0
+        self.misses = 0
+
+        self.flush_queue: queue.Queue[ObjectKey | None] = queue.Queue()
+        self.flusher: threading.Thread | None = None
+        os.makedirs(self.path, exist_ok=True)
+        self.load()
+        if self.write_mode == "back" or self.dirty:
+            self.flusher = threading.Thread(
+                target=self.flush_loop, name=f"tiered-{self.name}", daemon=True
+            )
+            self.flusher.start()
+            for object_key in self.dirty:
+                self.flush_queue.put(object_key)
+        events.on_change(self.on_backend_change)
+
+    @property
+    def backend(self) -> Storage:
+        # resolved on use, so it follows config reloads
+        from am.storage.factory import registry
+
+        return registry.get(self.backend_name)
+
+    @property
+    def hits(self) -> int:
+        return self.memory.hits + self.disk_hits
+
+    def close(self) -> None:
+        events.remove_listener(self.on_backend_change)
+        if self.flusher is not None:
+            # pending uploads are done first
+            self.flush_queue.put(None)
+            self.flusher.join()
+            self.flusher = None
+
+    def load(self) -> None:
+        """
+        Load the entries stored on disk, oldest access first.
+        """
+        found = []
+        for dirpath, _, filenames in os.walk(self.path):
+            for filename in filenames:
+                path = os.path.join(dirpath, filename)
+                if filename.startswith("."):
+                    # leftover temporary file from an interrupted write
+                    os.unlink(path)
+                    continue
+                if not filename.endswith(".json"):
+                    continue
+                data_path = path.removesuffix(".json")
+                try:
+                    with open(path) as f:
+                        meta = json.load(f)
+                    atime = os.stat(data_path).st_atime
+                except (OSError, ValueError):
+                    logger.warning("Dropping broken tier entry path=%s", data_path)
+                    self.unlink(data_path)
+                    continue
+                found.append((atime, meta))
+        for _, meta in sorted(found, key=lambda item: item[0]):
+            object_key = (meta["bucket"], meta["key"])
+            stat = FileData(
+                key=meta["key"],
+                size=meta["size"],
+                last_modified=datetime.fromisoformat(meta["last_modified"]),
+                etag=meta["etag"],
+            )
+            self.entries[object_key] = stat
+            self.size += stat.size
+            if meta["dirty"]:
+                self.dirty.add(object_key)
+        logger.debug(
+            "Loaded tier: path=%s entries=%s size=%s dirty=%s",
+            self.path,
+            len(self.entries),
+            self.size,
+            len(self.dirty),
+        )
+        with self.lock:
+            self.evict()
+
+    def data_path(self, bucket: str, key: str) -> str:
+        digest = hashlib.sha256(f"{bucket}\0{key}".encode("utf-8")).hexdigest()
+        return os.path.join(self.path, digest[:2], digest)
+
+    def unlink(self, data_path: str) -> None:
+        for path in (data_path, data_path + ".json"):
+            try:
+                os.unlink(path)
+            except FileNotFoundError:
+                pass
+
+    def store(
+        self, bucket: str, tmppath: str, stat: FileData, dirty: bool = False
+    ) -> None:
+        """
+        Move a downloaded or written file into the tier, with its stat.
+        """
+        data_path = self.data_path(bucket, stat.key)
+        os.replace(tmppath, data_path)
+        self.write_meta(bucket, stat, dirty)
+        object_key = (bucket, stat.key)
+        with self.lock:
+            self.forget(object_key)
+            self.entries[object_key] = stat
+            self.size += stat.size
+            if dirty:
+                self.dirty.add(object_key)
+            self.evict()
+
+    def write_meta(self, bucket: str, stat: FileData, dirty: bool) -> None:
+        data_path = self.data_path(bucket, stat.key)
+        fd, tmppath = tempfile.mkstemp(dir=os.path.dirname(data_path), prefix=".")
+        with os.fdopen(fd, "w") as f:
+            json.dump(
+                {
+                    "bucket": bucket,
+                    "key": stat.key,
+                    "size": stat.size,
+                    "last_modified": stat.last_modified.isoformat(),
+                    "etag": stat.etag,
+                    "dirty": dirty,
+                },
+                f,
+            )
+        os.replace(tmppath, data_path + ".json")
+
+    def forget(self, object_key: ObjectKey) -> None:
+        stat = self.entries.pop(object_key, None)
+        if stat is not None:
+            self.size -= stat.size
+        self.dirty.discard(object_key)
+
+    def evict(self) -> None:
+        """
+        Remove the least recently used entries until under max_size. Must
+        hold the lock.
+        """
+        for object_key in list(self.entries):
+            if self.size <= self.max_size:
+                return
+            if object_key in self.dirty:
+                continue
+            stat = self.entries.pop(object_key)
+            self.size -= stat.size
+            logger.debug("Evicting tier entry=%s size=%s", object_key, stat.size)
+            self.unlink(self.data_path(*object_key))
+
+    def invalidate(self, bucket: str, key: str | None = None) -> None:
+        """
+        Drop the cached copies of an object, or of a whole bucket if key is
+        None. Pending uploads are kept.
+        """
+
+        def match(object_key: ObjectKey) -> bool:
+            return object_key[0] == bucket and (key is None or object_key[1] == key)
+
+        self.memory.pop_matching(match)
+        with self.lock:
+            for object_key in [k for k in self.stats if match(k)]:
+                del self.stats[object_key]
+            for object_key in [k for k in self.entries if match(k)]:
+                if object_key in self.dirty:
+                    continue
+                self.forget(object_key)
+                self.unlink(self.data_path(*object_key))
+
+    def on_backend_change(self, storage_name: str, bucket: str, key: str | None):
+        if storage_name != self.backend_name:
+            return
+        if key is not None and (bucket, key) in self.writing:
+            # our own write, handled by it
+            return
+        self.invalidate(bucket, key)
+        events.notify_change(self.name, bucket, key)
+
+    def cached(self, bucket: str, key: str, stat: FileData) -> str | None:
+        """
+        Get the path of the cached content, if it is the one of the stat.
+        """
+        object_key = (bucket, key)
+        with self.lock:
+            if self.entries.get(object_key) != stat:
+                return None
+            self.entries.move_to_end(object_key)
+        return self.data_path(bucket, key)
+
+    def fetch(self, bucket: str, key: str, stat: FileData) -> str | None:
+        """
+        Download an object into the tier. Returns its path, or None if the
+        object changed while downloading.
+
+        Concurrent misses of the same object download it once, the others
+        wait for that download and use it if it got the content of their stat.
+        """
+        object_key = (bucket, key)
+        with self.lock:
+            self.misses += 1
+            future = self.fetching.get(object_key)
+            if future is None:
+                future = self.fetching[object_key] = Future()
+                owner = True
+            else:
+                owner = False
+        if not owner:
+            logger.debug("Waiting for the download of tier entry=%s", object_key)
+            future.result()
+            return self.cached(bucket, key, stat)
+        try:
+            path = self.download(bucket, key, stat)
+        except BaseException as e:
+            future.set_exception(e)
+            raise
+        else:
+            future.set_result(path)
+        finally:
+            with self.lock:
+                del self.fetching[object_key]
+        return path
+
+    def download(self, bucket: str, key: str, stat: FileData) -> str | None:
+        data_path = self.data_path(bucket, key)
+        os.makedirs(os.path.dirname(data_path), exist_ok=True)
+        fd, tmppath = tempfile.mkstemp(dir=os.path.dirname(data_path), prefix=".")
+        try:
+            os.fchmod(fd, 0o666 & ~UMASK)
+            with os.fdopen(fd, "wb") as f:
+                for chunk in self.backend.read_range(bucket, key, 0, stat.size):
+                    f.write(chunk)
+            if self.backend.stat(bucket, key) != stat:
+                return None
+            self.store(bucket, tmppath, stat)
+        finally:
+            if os.path.exists(tmppath):
+                os.unlink(tmppath)
+        return data_path
+
+    def create_bucket(self, name: str) -> None:
+        self.backend.create_bucket(name)
+
+    def delete_bucket(self, name: str) -> None:
+        self.backend.delete_bucket(name)
+        with self.lock:
+            for object_key in [k for k in self.dirty if k[0] == name]:
+                self.dirty.discard(object_key)
+        self.invalidate(name)
+
+    def list_buckets(self, start: int = 0, limit: int = 100) -> list[BucketData]:
+        return self.backend.list_buckets(start, limit)
+
+    def list_files(
+        self, bucket: str, start: int = 0, limit: int = 100
+    ) -> list[FileData]:
+        return self.backend.list_files(bucket, start, limit)
+
+    def scan_files(
+        self, bucket: str, prefix: str = "", start_after: str | None = None
+    ) -> Generator[FileData, None, None]:
+        return self.backend.scan_files(bucket, prefix, start_after)
+
+    def list_page(
+        self,
+        bucket: str,
+        prefix: str = "",
+        delimiter: str | None = None,
+        token: str | None = None,
+        max_keys: int = 1000,
+    ) -> ListPage:
+        return self.backend.list_page(bucket, prefix, delimiter, token, max_keys)
+
+    def iter_listing(
+        self,
+        bucket: str,
+        prefix: str = "",
+        delimiter: str | None = None,
+        start_after: str | None = None,
+    ) -> Generator[FileData | str, None, None]:
+        return self.backend.iter_listing(bucket, prefix, delimiter, start_after)
+
+    def stat(self, bucket: str, file: str) -> FileData:
+        object_key = (bucket, file)
+        with self.lock:
+            if object_key in self.dirty:
+                return self.entries[object_key]
+            checked = self.stats.get(object_key)
+        if checked is not None and time.monotonic() - checked[1] < self.stat_ttl:
+            return checked[0]
+        try:
+            stat = self.backend.stat(bucket, file)
+        except NoSuchFileError:
+            self.invalidate(bucket, file)
+            raise
+        with self.lock:
+            self.stats[object_key] = (stat, time.monotonic())
+        return stat
+
+    @contextmanager
+    def open_read(self, bucket: str, file: str) -> Generator[BinaryIO, None, None]:
+        stat = self.stat(bucket, file)
+        cached = self.memory.get((bucket, file))
+        if cached is not None and cached[0] == stat:
+            yield io.BytesIO(cached[1])
+            return
+
+        path = self.cached(bucket, file, stat)
+        if path is not None:
+            with self.lock:
+                self.disk_hits += 1
+        elif stat.size <= self.max_object_size:
+            path = self.fetch(bucket, file, stat)
+        else:
+            with self.lock:
+                self.misses += 1
+        if path is None:
+            with self.backend.open_read(bucket, file) as f:
+                yield f
+            return
+
+        try:
+            f = open(path, "rb")
+        except FileNotFoundError:
+            # evicted meanwhile, by this or another process
+            with self.lock:
+                self.forget((bucket, file))
+            with self.backend.open_read(bucket, file) as f:
+                yield f
+            return
+        with f:
+            if stat.size <= self.memory_max_object_size:
+                content = f.read()
+                self.memory.put((bucket, file), (stat, content))
+                yield io.BytesIO(content)
+            else:
+                yield f
+
+    def read_range(
+        self, bucket: str, file: str, start: int, end: int, chunk_size: int = 65536
+    ) -> Generator[bytes, None, None]:
+        stat = self.stat(bucket, file)
+        cached = self.memory.get((bucket, file))
+        if cached is not None and cached[0] == stat:
+            for offset in range(start, end, chunk_size):
+                yield cached[1][offset : min(offset + chunk_size, end)]
+            return
+
+        path = self.cached(bucket, file, stat)
+        if path is not None:
+            with self.lock:
+                self.disk_hits += 1
+        elif start == 0 and end >= stat.size and stat.size <= self.max_object_size:
+            # full reads fill the cache, ranges only use it
+            path = self.fetch(bucket, file, stat)
+        else:
+            with self.lock:
+                self.misses += 1
+        try:
+            fd = os.open(path, os.O_RDONLY) if path is not None else None
+        except FileNotFoundError:
+            fd = None
+        if fd is None:
+            yield from self.backend.read_range(bucket, file, start, end, chunk_size)
+            return
+        try:
+            offset = start
+            while offset < end:
+                chunk = os.pread(fd, min(chunk_size, end - offset), offset)
+                if not chunk:
+                    break
+                offset += len(chunk)
+                yield chunk
+        finally:
+            os.close(fd)
+
+    @contextmanager
+    def open_write(self, bucket: str, file: str) -> Generator[BinaryIO, None, None]:
+        """
+        Writes through to the backend keeping a local copy, or with
+        `write: back` to local disk only, uploading it in the background.
+        """
+        data_path = self.data_path(bucket, file)
+        os.makedirs(os.path.dirname(data_path), exist_ok=True)
+        fd, tmppath = tempfile.mkstemp(dir=os.path.dirname(data_path), prefix=".")
+        object_key = (bucket, file)
+        try:
+            os.fchmod(fd, 0o666 & ~UMASK)
+            with os.fdopen(fd, "wb") as local:
+                if self.write_mode == "back":
+                    yield local
+                    local.flush()
+                    os.fsync(local.fileno())
+                    stat = FileData(
+                        key=file,
+                        size=local.tell(),
+                        last_modified=datetime.now(timezone.utc),
+                    )
+                else:
+                    with self.lock:
+                        self.writing.add(object_key)
+                    try:
+                        with self.backend.open_write(bucket, file) as remote:
+                            tee = TeeWriter(remote, local, self.max_object_size)
+                            yield tee
+                        stat = self.backend.stat(bucket, file)
+                    finally:
+                        with self.lock:
+                            self.writing.discard(object_key)
+            self.memory.pop(object_key)
+            with self.lock:
+                self.stats.pop(object_key, None)
+            if self.write_mode == "back":
+                self.store(bucket, tmppath, stat, dirty=True)
+                self.flush_queue.put(object_key)
+            elif tee.complete:
+                self.store(bucket, tmppath, stat)
+            else:
+                self.invalidate(bucket, file)
+        finally:
+            if os.path.exists(tmppath):
+                os.unlink(tmppath)
+        events.notify_change(self.name, bucket, file)
+
+    def delete_file(self, bucket: str, file: str) -> None:
+        object_key = (bucket, file)
+        with self.lock:
+            was_dirty = object_key in self.dirty
+            self.dirty.discard(object_key)
+            self.writing.add(object_key)
+        try:
+            self.backend.delete_file(bucket, file)
+        except NoSuchFileError:
+            # only written back, not uploaded yet
+            if not was_dirty:
+                raise
+        finally:
+            with self.lock:
+                self.writing.discard(object_key)
+        self.invalidate(bucket, file)
+        events.notify_change(self.name, bucket, file)
+
+    def local_path(
+        self, bucket: str, file: str, stat: FileData | None = None
+    ) -> str | None:
+        # no backend calls here, it is called from the event loop
+        object_key = (bucket, file)
+        with self.lock:
+            stat = self.entries.get(object_key)
+            checked = self.stats.get(object_key)
+            fresh = object_key in self.dirty or (
+                checked is not None
+                and checked[0] == stat
+                and time.monotonic() - checked[1] < self.stat_ttl
+            )
+        if stat is None or not fresh:
+            return None
+        return os.path.abspath(self.data_path(bucket, file))
+
+    def flush_loop(self) -> None:
+        while True:
+            object_key = self.flush_queue.get()
+            if object_key is None:
+                return
+            try:
+                self.flush(*object_key)
+            except Exception:
+                logger.exception("Error uploading tier entry=%s, retrying", object_key)
+                time.sleep(FLUSH_RETRY_INTERVAL)
+                self.flush_queue.put(object_key)
+
+    def flush(self, bucket: str, file: str) -> None:
+        """
+        Upload an entry written back to the backend.
+        """
+        object_key = (bucket, file)
+        with self.lock:
+            if object_key not in self.dirty:
+                # deleted, or already uploaded
+                return
+            written = self.entries[object_key]
+            self.writing.add(object_key)
+        data_path = self.data_path(bucket, file)
+        logger.debug("Uploading tier entry bucket=%s file=%s", bucket, file)
+        try:
+            with open(data_path, "rb") as local:
+                with self.backend.open_write(bucket, file) as remote:
+                    while chunk := local.read(1024 * 1024):
+                        remote.write(chunk)
+            stat = self.backend.stat(bucket, file)
+        finally:
+            with self.lock:
+                self.writing.discard(object_key)
+        with self.lock:
+            if object_key not in self.dirty or self.entries.get(object_key) != written:
+                # written again meanwhile, that write queued its own upload
+                return
+            self.dirty.discard(object_key)
+            self.forget(object_key)
+            self.entries[object_key] = stat
+            self.size += stat.size
+            self.stats[object_key] = (stat, time.monotonic())
+        # the stat is now the one of the backend
+        self.write_meta(bucket, stat, dirty=False)
+        self.memory.pop(object_key)
+        events.notify_change(self.name, bucket, file)
+
+
+def _tiered_storages() -> list[tuple[str, TieredStorage]]:
+    from am.storage.factory import registry
+
+    return [
+        (name, storage)
+        for name, storage in list(registry.backends.items())
+        if isinstance(storage, TieredStorage)
+    ]
+
+
+metrics.cache_metrics("tiered_cache", _tiered_storages)
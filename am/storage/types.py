@@ -1,8 +1,25 @@
 from abc import ABC, abstractmethod
-from dataclasses import dataclass
+from dataclasses import dataclass, field
 from datetime import datetime
 from typing import BinaryIO, Generator
 
+from am.config import StorageConfig
+
+# keys starting with this are internal, as renditions, and are not listed
+INTERNAL_PREFIX = ".am-"
+
+
+def is_internal_key(key: str) -> bool:
+    return key.startswith(INTERNAL_PREFIX)
+
+
+def is_reserved_key(key: str) -> bool:
+    """
+    Whether any part of the key is internal, so clients must not read or
+    write it, as the renditions of a file.
+    """
+    return any(is_internal_key(part) for part in key.split("/"))
+
 
 class StorageError(Exception):
     """
@@ -37,6 +54,19 @@ class FileData:
     key: str
     size: int
     last_modified: datetime
+    # content hash, if the backend stores one
+    etag: str | None = None
+
+
+@dataclass
+class ListPage:
+    """
+    ListPage is a page of a bucket listing.
+    """
+
+    files: list[FileData] = field(default_factory=list)
+    common_prefixes: list[str] = field(default_factory=list)
+    next_token: str | None = None
 
 
 @dataclass
@@ -54,6 +84,8 @@ class Storage(ABC):
     Storage is the interface for the storage backend.
     """
 
+    config: StorageConfig
+
     @abstractmethod
     def create_bucket(self, name: str) -> None:
         """
@@ -84,6 +116,61 @@ class Storage(ABC):
         """
         pass
 
+    def scan_files(
+        self, bucket: str, prefix: str = "", start_after: str | None = None
+    ) -> Generator[FileData, None, None]:
+        """
+        Yield the files of a bucket with the given prefix, and with a key after
+        start_after, in key order.
+
+        By default it gets all the files with list_files and sorts them.
+        Backends should override it with something that does not need to.
+        """
+        files = []
+        start = 0
+        while page := self.list_files(bucket, start=start, limit=1000):
+            files.extend(
+                file
+                for file in page
+                if file.key.startswith(prefix)
+                and (start_after is None or file.key > start_after)
+            )
+            start += len(page)
+        files.sort(key=lambda file: file.key)
+        yield from files
+
+    @abstractmethod
+    def list_page(
+        self,
+        bucket: str,
+        prefix: str = "",
+        delimiter: str | None = None,
+        token: str | None = None,
+        max_keys: int = 1000,
+    ) -> ListPage:
+        """
+        Get a page of the files of a bucket, with optional prefix and delimiter
+        to group keys into common prefixes. The page next_token continues the
+        listing.
+        """
+        pass
+
+    @abstractmethod
+    def iter_listing(
+        self,
+        bucket: str,
+        prefix: str = "",
+        delimiter: str | None = None,
+        start_after: str | None = None,
+    ) -> Generator[FileData | str, None, None]:
+        """
+        Yield the files of a bucket in key order, after start_after, lazily.
+
+        With a delimiter, keys with the delimiter after the prefix are grouped
+        and yielded once as their common prefix, a str.
+        """
+        pass
+
     @abstractmethod
     def open_read(self, bucket: str, file: str) -> Generator[BinaryIO, None, None]:
         """
@@ -91,6 +178,26 @@ class Storage(ABC):
         """
         pass
 
+    def read_range(
+        self, bucket: str, file: str, start: int, end: int, chunk_size: int = 65536
+    ) -> Generator[bytes, None, None]:
+        """
+        Read the bytes from start (inclusive) to end (exclusive) of a file, in
+        chunks of at most chunk_size.
+
+        By default it seeks on the file returned by open_read. Backends that can
+        do better, as ranged requests to a remote store, should override it.
+        """
+        with self.open_read(bucket, file) as f:
+            f.seek(start)
+            remaining = end - start
+            while remaining > 0:
+                chunk = f.read(min(chunk_size, remaining))
+                if not chunk:
+                    break
+                remaining -= len(chunk)
+                yield chunk
+
     @abstractmethod
     def open_write(self, bucket: str, file: str) -> Generator[BinaryIO, None, None]:
         """
@@ -111,3 +218,21 @@ class Storage(ABC):
         Get the data of a file.
         """
         pass
+
+    def close(self) -> None:
+        """
+        Release the resources of the backend, as connections. Called when the
+        backend is removed from the config.
+        """
+
+    def local_path(
+        self, bucket: str, file: str, stat: FileData | None = None
+    ) -> str | None:
+        """
+        Get the absolute path of the file in the local filesystem, if it has one.
+
+        Used to let the server send the file directly, from the event loop, so
+        it must not block. The stat of the file, when the caller has it, saves
+        looking it up. By default files are not local.
+        """
+        return None
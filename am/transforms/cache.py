@@ -0,0 +1,256 @@
+"""
+Persistent cache of transform outputs.
+
+Transformed files are stored on disk, content addressed by the source file
+(bucket, key, size and mtime) and the normalized transform parameters. A repeat
+request for the same rendition costs a single file read instead of a full
+decode, transform and encode.
+
+The layout is:
+
+    <path>/<bucket hash>/<source hash[:2]>/<source hash>/<variant hash>
+
+so all the renditions of a source file, or of a bucket, live in the same
+directory and can be dropped at once when the source is written or deleted.
+
+Several server processes can share a cache directory. Entries written by
+another process are picked up on read, and computing an entry is guarded by
+a file lock at `<path>/.locks/` so only one process does it at a time. Each
+process keeps its own size accounting, so the size bound is per process.
+"""
+
+import fcntl
+import hashlib
+import logging
+import os
+import shutil
+import tempfile
+import threading
+from collections import OrderedDict
+
+from am import metrics
+from am.config import StorageConfig
+from am.storage import events
+from am.storage.types import FileData
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_MAX_SIZE = 512 * 1024 * 1024
+# entries are spread over this many lock files, by the first hex digits
+LOCK_DIGITS = 3
+
+
+class TransformCache:
+    """
+    Size bounded LRU cache of transform outputs stored on disk.
+    """
+
+    def __init__(self, path: str, max_size: int = DEFAULT_MAX_SIZE):
+        self.path = path
+        self.max_size = max_size
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        # entry path -> size, least recently used first
+        self.entries: OrderedDict[str, int] = OrderedDict()
+        self.lock = threading.Lock()
+        os.makedirs(os.path.join(self.path, ".locks"), exist_ok=True)
+        self.load()
+
+    def load(self) -> None:
+        """
+        Load the existing entries from disk, oldest access first.
+        """
+        found = []
+        for dirpath, dirnames, filenames in os.walk(self.path):
+            dirnames[:] = [name for name in dirnames if not name.startswith(".")]
+            for filename in filenames:
+                path = os.path.join(dirpath, filename)
+                if filename.startswith("."):
+                    # leftover temporary file from an interrupted write
+                    os.unlink(path)
+                    continue
+                stat = os.stat(path)
+                found.append((stat.st_atime, path, stat.st_size))
+        for _, path, size in sorted(found):
+            self.entries[path] = size
+            self.size += size
+        logger.debug(
+            "Loaded transform cache: path=%s entries=%s size=%s",
+            self.path,
+            len(self.entries),
+            self.size,
+        )
+        self.evict()
+
+    def bucket_dir(self, bucket: str) -> str:
+        digest = hashlib.sha256(bucket.encode("utf-8")).hexdigest()
+        return os.path.join(self.path, digest[:16])
+
+    def source_dir(self, bucket: str, key: str) -> str:
+        digest = hashlib.sha256(key.encode("utf-8")).hexdigest()
+        return os.path.join(self.bucket_dir(bucket), digest[:2], digest)
+
+    def entry_path(self, bucket: str, stat: FileData, variant: str) -> str:
+        source = f"{stat.size}\0{stat.last_modified.timestamp()}\0{variant}"
+        digest = hashlib.sha256(source.encode("utf-8")).hexdigest()
+        return os.path.join(self.source_dir(bucket, stat.key), digest)
+
+    def get(self, bucket: str, stat: FileData, variant: str) -> bytes | None:
+        """
+        Get the cached output for the given source file and transform variant.
+        """
+        path = self.entry_path(bucket, stat, variant)
+        with self.lock:
+            if path in self.entries:
+                self.entries.move_to_end(path)
+        # read even if unknown, it could be written by another process
+        try:
+            with open(path, "rb") as f:
+                data = f.read()
+        except FileNotFoundError:
+            with self.lock:
+                self.forget(path)
+                self.misses += 1
+            return None
+        with self.lock:
+            if path not in self.entries:
+                self.entries[path] = len(data)
+                self.size += len(data)
+                self.evict()
+            self.hits += 1
+        return data
+
+    def try_lock(self, bucket: str, stat: FileData, variant: str) -> int | None:
+        """
+        Take the lock to compute an entry, shared with other processes.
+
+        Returns the locked file descriptor, to be given to unlock, or None if
+        it is already taken.
+        """
+        digest = os.path.basename(self.entry_path(bucket, stat, variant))
+        path = os.path.join(self.path, ".locks", digest[:LOCK_DIGITS])
+        fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o666)
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            os.close(fd)
+            return None
+        return fd
+
+    def unlock(self, fd: int) -> None:
+        fcntl.flock(fd, fcntl.LOCK_UN)
+        os.close(fd)
+
+    def put(self, bucket: str, stat: FileData, variant: str, data: bytes) -> None:
+        """
+        Store the output for the given source file and transform variant.
+        """
+        if len(data) > self.max_size:
+            return
+        path = self.entry_path(bucket, stat, variant)
+        dirname = os.path.dirname(path)
+        os.makedirs(dirname, exist_ok=True)
+        fd, tmppath = tempfile.mkstemp(dir=dirname, prefix=".")
+        try:
+            with os.fdopen(fd, "wb") as f:
+                f.write(data)
+            os.replace(tmppath, path)
+        except Exception:
+            os.unlink(tmppath)
+            raise
+        with self.lock:
+            self.forget(path)
+            self.entries[path] = len(data)
+            self.size += len(data)
+            self.evict()
+
+    def invalidate(self, bucket: str, key: str | None = None) -> None:
+        """
+        Drop all the cached outputs of a file, or of a whole bucket if key is None.
+        """
+        if key is None:
+            directory = self.bucket_dir(bucket)
+        else:
+            directory = self.source_dir(bucket, key)
+        prefix = directory + os.sep
+        with self.lock:
+            for path in [path for path in self.entries if path.startswith(prefix)]:
+                self.forget(path)
+            shutil.rmtree(directory, ignore_errors=True)
+
+    def forget(self, path: str) -> None:
+        size = self.entries.pop(path, None)
+        if size is not None:
+            self.size -= size
+
+    def evict(self) -> None:
+        while self.size > self.max_size and self.entries:
+            path, size = self.entries.popitem(last=False)
+            self.size -= size
+            logger.debug("Evicting transform cache entry=%s size=%s", path, size)
+            try:
+                os.unlink(path)
+            except FileNotFoundError:
+                pass
+
+
+_caches: dict[str, TransformCache | None] = {}
+# storage name -> the settings its cache was built with
+_cache_settings: dict[str, tuple] = {}
+_caches_lock = threading.Lock()
+
+
+def get_transform_cache(config: StorageConfig) -> TransformCache | None:
+    """
+    Get the transform cache for the given storage, or None if it is disabled.
+
+    It is configured at the storage config:
+
+        transform_cache:
+          path: ./data/default.cache/  # defaults to next to the storage path,
+                                       # or ./data/<name>.cache
+          max_size: 536870912          # bytes
+
+    The cache is built again when those settings change, as on a config
+    reload.
+    """
+    cache_config = config.config.get("transform_cache")
+    settings = (cache_config, config.config.get("path"))
+    with _caches_lock:
+        if _cache_settings.get(config.name) == settings:
+            return _caches[config.name]
+        if config.name in _caches:
+            logger.info("Transform cache of storage=%s changed", config.name)
+        if not cache_config:
+            _caches[config.name] = None
+            _cache_settings[config.name] = settings
+            return None
+        if cache_config is True:
+            cache_config = {}
+        path = cache_config.get("path")
+        if path is None and "path" in config.config:
+            path = config.config["path"].rstrip("/") + ".cache"
+        elif path is None:
+            # remote storages have no path of their own
+            path = f"./data/{config.name}.cache"
+        cache = TransformCache(
+            path=path,
+            max_size=int(cache_config.get("max_size", DEFAULT_MAX_SIZE)),
+        )
+        _caches[config.name] = cache
+        _cache_settings[config.name] = settings
+        return cache
+
+
+@events.on_change
+def _invalidate_on_change(storage_name: str, bucket: str, key: str | None) -> None:
+    cache = _caches.get(storage_name)
+    if cache is not None:
+        cache.invalidate(bucket, key)
+
+
+metrics.cache_metrics(
+    "transform_cache",
+    lambda: [(name, cache) for name, cache in list(_caches.items()) if cache],
+)
@@ -1,5 +1,8 @@
-from am.transforms.types import Transform
+from am.transforms.types import InvalidTransformError, Transform
+from am.transforms.format import FormatTransform
+from am.transforms.pipeline import PipelineTransform
 from am.transforms.resize import ResizeTransform
+from am.transforms.sharpen import SharpenTransform
 
 
 class Factory:
@@ -10,8 +13,37 @@ class Factory:
         self.transforms[name] = transform
 
     def create_transform(self, name: str, config: dict) -> Transform:
-        return self.transforms[name](name, config)
+        """
+        Create a transform, or a pipeline for comma separated names, as
+        "resize,sharpen,format".
+
+        Every step gets the whole config, and "<step>.<param>" entries set a
+        param only for that step, as "sharpen.radius=1".
+
+        Raises InvalidTransformError for unknown steps and invalid params.
+        """
+        names = name.split(",")
+        for step in names:
+            if step not in self.transforms:
+                raise InvalidTransformError(f"Unknown transform {step}")
+        if len(names) == 1:
+            return self.transforms[name](name, self.step_config(name, config))
+        steps = [
+            self.transforms[step](step, self.step_config(step, config))
+            for step in names
+        ]
+        return PipelineTransform(name, config, steps)
+
+    def step_config(self, name: str, config: dict) -> dict:
+        prefix = name + "."
+        step_config = {k: v for k, v in config.items() if "." not in k}
+        for key, value in config.items():
+            if key.startswith(prefix):
+                step_config[key.removeprefix(prefix)] = value
+        return step_config
 
 
 factory = Factory()
 factory.register_transform("resize", ResizeTransform)
+factory.register_transform("sharpen", SharpenTransform)
+factory.register_transform("format", FormatTransform)
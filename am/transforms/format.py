@@ -0,0 +1,43 @@
+from PIL import Image
+
+from .types import Transform
+
+
+class FormatTransform(Transform):
+    """
+    FormatTransform reencodes an image in another format.
+    """
+
+    def __init__(self, name: str, config: dict):
+        super().__init__(name, config)
+        self.quality = self.param("quality", int, 80)
+        self.format = config.get("format", "auto")
+
+    def config_schema(self):
+        return {
+            "quality": {
+                "type": "integer",
+                "required": False,
+                "description": "Quality of the image, 0-100",
+                "default": 80,
+            },
+            "format": {
+                "type": "select",
+                "options": ["auto", "avif", "webp", "png", "jpg", "jpeg"],
+                "required": False,
+                "default": "auto",
+                "description": "Format of the image, auto to choose by Accept",
+            },
+        }
+
+    def for_mime_types(self):
+        return ["image/*"]
+
+    def cache_key(self):
+        return f"{self.name}?quality={self.quality}&format={self.format}"
+
+    def encode_options(self):
+        return {"format": self.format, "quality": self.quality}
+
+    def apply_image(self, image: Image.Image) -> Image.Image:
+        return image
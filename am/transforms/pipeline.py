@@ -0,0 +1,39 @@
+from PIL import Image
+
+from .types import InvalidTransformError, Transform
+
+
+class PipelineTransform(Transform):
+    """
+    PipelineTransform applies several image transforms in order.
+
+    The image is decoded once, goes through the apply_image of every step,
+    and is encoded once at the end, with the encode options of the steps
+    merged, later steps winning over earlier ones and "auto".
+    """
+
+    def __init__(self, name: str, config: dict, steps: list[Transform]):
+        super().__init__(name, config)
+        for step in steps:
+            if not step.works_on_images():
+                raise InvalidTransformError(f"Transform {step.name} can not be chained")
+        self.steps = steps
+
+    def for_mime_types(self):
+        return self.steps[0].for_mime_types()
+
+    def cache_key(self):
+        return "|".join(step.cache_key() for step in self.steps)
+
+    def encode_options(self):
+        options = {}
+        for step in self.steps:
+            for key, value in step.encode_options().items():
+                if value != "auto":
+                    options[key] = value
+        return options
+
+    def apply_image(self, image: Image.Image) -> Image.Image:
+        for step in self.steps:
+            image = step.apply_image(image)
+        return image
@@ -1,10 +1,13 @@
 import logging
 from PIL import Image
 
-from .types import Input, Output, Transform
+from .types import InvalidTransformError, Transform
 
 logger = logging.getLogger(__name__)
 
+# keep at least this factor of pixels over the target before the final resample
+REDUCING_GAP = 2.0
+
 
 class ResizeTransform(Transform):
     """
@@ -13,11 +16,16 @@ class ResizeTransform(Transform):
 
     def __init__(self, name: str, config: dict):
         super().__init__(name, config)
-        self.width = int(config["width"])
-        self.height = int(config["height"])
+        self.width = self.param("width", int)
+        self.height = self.param("height", int)
+        for key in ["width", "height"]:
+            if getattr(self, key) <= 0:
+                raise InvalidTransformError(
+                    f"Invalid {key}={config[key]} for transform {name}"
+                )
         self.fit = config.get("fit", "cover")
-        self.quality = int(config.get("quality", 80))
-        self.format = config.get("format", "webp")
+        self.quality = self.param("quality", int, 80)
+        self.format = config.get("format", "auto")
 
     def config_schema(self):
         return {
@@ -46,35 +54,91 @@ class ResizeTransform(Transform):
             },
             "format": {
                 "type": "select",
-                "options": ["webp", "png", "jpg", "jpeg"],
+                "options": ["auto", "avif", "webp", "png", "jpg", "jpeg"],
                 "required": False,
-                "default": "webp",
-                "description": "Format of the image",
+                "default": "auto",
+                "description": "Format of the image, auto to choose by Accept",
             },
         }
 
     def for_mime_types(self):
         return ["image/*"]
 
-    def apply(self, input: Input, output: Output):
-        image = Image.open(input)
+    def cache_key(self):
+        return (
+            f"{self.name}?width={self.width}&height={self.height}&fit={self.fit}"
+            f"&quality={self.quality}&format={self.format}"
+        )
+
+    def encode_options(self):
+        return {"format": self.format, "quality": self.quality}
+
+    def apply_image(self, image: Image.Image) -> Image.Image:
         match self.fit:
             case "cover":
-                image = self.cover(image)
+                box, size = self.cover(image)
             case "contain":
-                image = self.contain(image)
+                box, size = self.contain(image)
             case "fill":
-                image = image.resize((self.width, self.height))
+                box, size = (0, 0, image.width, image.height), (self.width, self.height)
             case _:
                 logger.warning("Unknown fit=%s. Using cover", self.fit)
-                image = self.cover(image)
+                box, size = self.cover(image)
+
+        return self.scale(image, box, size)
 
-        image.save(output, quality=self.quality, format=self.format)
+    def scale(
+        self, image: Image.Image, box: tuple[float, ...], size: tuple[int, int]
+    ) -> Image.Image:
+        """
+        Resizes the box region of the image to size, decoding as little as
+        possible.
+
+        JPEG images are decoded at 1/2, 1/4 or 1/8 of their size when still
+        large enough (DCT scaling), and the remaining downscale is done in
+        steps, first with a fast reduce and then resampling, as thumbnail does.
+        The crop is part of the resize, so no full size copy is made.
+        """
+        box_width = box[2] - box[0]
+        box_height = box[3] - box[1]
+        # size of the whole image at which the box would be the requested size
+        requested = (
+            max(1, int(image.width * size[0] * REDUCING_GAP / box_width)),
+            max(1, int(image.height * size[1] * REDUCING_GAP / box_height)),
+        )
+        original_width, original_height = image.size
+        if image.draft(None, requested) is not None:
+            scale_x = image.width / original_width
+            scale_y = image.height / original_height
+            box = (
+                box[0] * scale_x,
+                box[1] * scale_y,
+                box[2] * scale_x,
+                box[3] * scale_y,
+            )
+            logger.debug(
+                "Decoding at %sx%s from %sx%s",
+                image.width,
+                image.height,
+                original_width,
+                original_height,
+            )
+
+        return image.resize(
+            size,
+            resample=Image.Resampling.LANCZOS,
+            box=box,
+            reducing_gap=REDUCING_GAP,
+        )
 
-    def cover(self, image: Image.Image) -> Image.Image:
+    def cover(
+        self, image: Image.Image
+    ) -> tuple[tuple[float, float, float, float], tuple[int, int]]:
         """
         Keeps the aspect ratio, cutting from the sides or from top and down if longer
         than the width or height.
+
+        Returns the crop box, in source coordinates, and the final size.
         """
         logger.info(
             "Transforming image cover %sx%s to %sx%s",
@@ -103,17 +167,22 @@ class ResizeTransform(Transform):
             crop_width = image.width
             crop_height = image.height - removed_height
 
-        image = image.crop((left, top, left + crop_width, top + crop_height))
-        image = image.resize((self.width, self.height))
-        return image
+        return (left, top, left + crop_width, top + crop_height), (
+            self.width,
+            self.height,
+        )
 
-    def contain(self, image: Image.Image) -> Image.Image:
+    def contain(
+        self, image: Image.Image
+    ) -> tuple[tuple[float, float, float, float], tuple[int, int]]:
         """
         Keeps the older aspect ratio, making the new image width and height at most
         the given width and height.
 
         If the image is wider ratio wise, it will be shorter than requested
         and if it is taller ratio wise, it will be wider than requested.
+
+        Returns the crop box, the whole image, and the final size.
         """
         logger.info(
             "Transforming image contain %sx%s to %sx%s",
@@ -130,26 +199,11 @@ class ResizeTransform(Transform):
 
         is_wider = current_aspect_ratio > new_aspect_ratio
         if is_wider:
-            # logger.info("Image is wider, scaling height")
             new_height = self.width / current_aspect_ratio
         else:
-            # logger.info("Image is taller, scaling width")
             new_width = self.height * current_aspect_ratio
 
-        # logger.info("New width: %s, new height: %s", new_width, new_height)
-
-        image = image.resize(
-            (int(new_width), int(new_height)),
-            resample=Image.Resampling.LANCZOS,
+        return (0, 0, image.width, image.height), (
+            max(1, int(new_width)),
+            max(1, int(new_height)),
         )
-        return image
-
-    # def crop_resize(
-    #     self, image: Image.Image, crop: list[int], resize: list[int]
-    # ) -> Image.Image:
-    #     """
-    #     Crops the image and then resizes it to the given width and height.
-    #     """
-    #     image = image.crop(crop)
-    #     image = image.resize(resize, resample=Image.Resampling.LANCZOS)
-    #     return image
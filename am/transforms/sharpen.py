@@ -0,0 +1,56 @@
+import logging
+from PIL import Image, ImageFilter
+
+from .types import Transform
+
+logger = logging.getLogger(__name__)
+
+
+class SharpenTransform(Transform):
+    """
+    SharpenTransform sharpens an image with an unsharp mask.
+    """
+
+    def __init__(self, name: str, config: dict):
+        super().__init__(name, config)
+        self.radius = self.param("radius", float, 2)
+        self.percent = self.param("percent", int, 150)
+        self.threshold = self.param("threshold", int, 3)
+
+    def config_schema(self):
+        return {
+            "radius": {
+                "type": "number",
+                "required": False,
+                "description": "Blur radius of the mask",
+                "default": 2,
+            },
+            "percent": {
+                "type": "integer",
+                "required": False,
+                "description": "Sharpening strength, in percent",
+                "default": 150,
+            },
+            "threshold": {
+                "type": "integer",
+                "required": False,
+                "description": "Minimum brightness change to sharpen",
+                "default": 3,
+            },
+        }
+
+    def for_mime_types(self):
+        return ["image/*"]
+
+    def cache_key(self):
+        return (
+            f"{self.name}?radius={self.radius}&percent={self.percent}"
+            f"&threshold={self.threshold}"
+        )
+
+    def apply_image(self, image: Image.Image) -> Image.Image:
+        if image.mode in ("P", "1"):
+            image = image.convert("RGBA" if "transparency" in image.info else "RGB")
+        return image.filter(
+            ImageFilter.UnsharpMask(self.radius, self.percent, self.threshold)
+        )
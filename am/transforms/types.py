@@ -1,9 +1,25 @@
-from typing import Generator
+import io
+from typing import Any, Callable, Generator
 from typing import BinaryIO
 
+from PIL import Image
+
+from am import metrics
+from am.storage.types import Storage
+
 type Input = Generator[BinaryIO, None, None]
 type Output = Generator[BinaryIO, None, None]
 
+# marks a param without a default, so it is required
+REQUIRED = object()
+
+
+class InvalidTransformError(ValueError):
+    """
+    InvalidTransformError is raised when a transform is unknown, or one of its
+    params is missing or invalid.
+    """
+
 
 class Transform:
     """
@@ -22,8 +38,111 @@ class Transform:
         """
         return []
 
-    def apply(self, input: Input) -> Output:
+    def cache_key(self) -> str:
+        """
+        Return a normalized representation of the transform and its parameters.
+
+        Two transforms with the same cache key must produce the same output for
+        the same input. Subclasses should only include the parameters they use.
+        """
+        params = "&".join(f"{k}={v}" for k, v in sorted(self.config.items()))
+        return f"{self.name}?{params}"
+
+    def param(self, key: str, type: Callable[[Any], Any], default: Any = REQUIRED):
+        """
+        Return the param key of the config converted with type, as int, or
+        default if it is not set.
+        """
+        value = self.config.get(key, default)
+        if value is REQUIRED:
+            raise InvalidTransformError(f"Missing {key} for transform {self.name}")
+        try:
+            return type(value)
+        except (TypeError, ValueError):
+            raise InvalidTransformError(
+                f"Invalid {key}={value} for transform {self.name}"
+            )
+
+    def apply(self, input: Input, output: Output):
         """
         Apply the transform to the file.
+
+        By default the input is decoded as an image, given to apply_image and
+        encoded with encode_options. Transforms that are not about images
+        override this instead.
+
+        Images are decoded lazily, so the decode is mostly timed in the
+        image.apply stage, with the transform.
+        """
+        with metrics.stage("image.open"):
+            image = Image.open(input)
+        source_format = image.format
+        with metrics.stage("image.apply"):
+            image = self.apply_image(image)
+        options = self.encode_options()
+        if options.get("format", "auto") == "auto":
+            options["format"] = source_format
+        with metrics.stage("image.encode"):
+            encode_image(image, output, options)
+
+    def apply_image(self, image: Image.Image) -> Image.Image:
         """
-        raise NotImplementedError("Subclasses must implement this method")
+        Apply the transform to a decoded image.
+
+        The image may still be lazy, not yet loaded, when the transform is
+        the first of a pipeline, so it can choose to decode only what it
+        needs. Transforms implementing it can be chained in a pipeline that
+        decodes and encodes only once.
+        """
+        raise NotImplementedError(f"Transform {self.name} does not work on images")
+
+    def encode_options(self) -> dict:
+        """
+        Return the options to encode the output image with, as format and
+        quality. A missing or "auto" format keeps the format of the source.
+        """
+        return {}
+
+    def works_on_images(self) -> bool:
+        return type(self).apply_image is not Transform.apply_image
+
+
+def encode_image(image: Image.Image, output: Output, options: dict) -> None:
+    """
+    Encode the image with the given options, converting the color mode when
+    the format does not support it.
+    """
+    options = dict(options)
+    format = (options.pop("format", None) or "png").upper()
+    if format == "JPG":
+        format = "JPEG"
+    if format == "JPEG" and image.mode not in ("RGB", "L", "CMYK"):
+        image = image.convert("RGB")
+    image.save(output, format=format, **options)
+
+
+def transform_source(storage: Storage, bucket: str, file: str) -> bytes | str:
+    """
+    Get the source of a transform: the local path if the file has one, so the
+    transform process reads it itself, or else its content.
+    """
+    path = storage.local_path(bucket, file)
+    if path is not None:
+        return path
+    with storage.open_read(bucket, file) as f:
+        return f.read()
+
+
+def run_transform(transform: Transform, source: bytes | str) -> bytes:
+    """
+    Apply the transform to the source, given as bytes or as a local path.
+
+    It is a plain function, so it can run in a process pool.
+    """
+    output = io.BytesIO()
+    if isinstance(source, str):
+        with open(source, "rb") as f:
+            transform.apply(f, output)
+    else:
+        transform.apply(io.BytesIO(source), output)
+    return output.getvalue()
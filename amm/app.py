@@ -2,6 +2,7 @@ import fastapi
 from fastapi.templating import Jinja2Templates
 import pathlib
 
+from am.executors import get_executor
 from am.storage.factory import get_storage
 
 templates = Jinja2Templates(directory=pathlib.Path(__file__).parent / "templates")
@@ -28,7 +29,7 @@ async def style():
 @routes.get("/")
 async def root(request: fastapi.Request):
     storage = get_storage("default")
-    buckets = storage.list_buckets()
+    buckets = await get_executor("io").run(storage.list_buckets)
 
     return templates.TemplateResponse(
         "buckets.html", {"request": request, "buckets": buckets}
@@ -38,7 +39,7 @@ async def root(request: fastapi.Request):
 @routes.get("/{bucket}")
 async def files(request: fastapi.Request, bucket: str):
     storage = get_storage(bucket)
-    files = storage.list_files(bucket)
+    files = await get_executor("io").run(storage.list_files, bucket)
     # print(files)
     return templates.TemplateResponse(
         "files.html", {"request": request, "files": files, "bucket": bucket}
@@ -0,0 +1,704 @@
+#!/usr/bin/env -S uv run --script
+"""
+Load test and benchmark of the server.
+
+It generates synthetic buckets in a work directory, with its own config, and
+drives the app with concurrent requests, both in process, calling the ASGI
+app directly, and over HTTP to a local uvicorn:
+
+    python benchmarks/bench.py [--mode inprocess|uvicorn|both]
+                               [--scenario get_small ...] [--factor 0.1]
+                               [--compare benchmarks/results/<previous>.json]
+
+For each scenario it reports requests per second, p50 and p99 latency and the
+peak RSS of the server process, and of its workers and transform processes. Results are
+saved as JSON at benchmarks/results/, so runs can be compared with --compare.
+
+The generated data is kept at the work directory, --workdir, and only built
+again if missing, so runs on the same data are comparable.
+"""
+
+import argparse
+import asyncio
+import http.client
+import io
+import itertools
+import json
+import os
+import platform
+import random
+import shutil
+import socket
+import statistics
+import subprocess
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import asdict, dataclass, field
+from datetime import datetime, timezone
+from pathlib import Path
+from typing import Callable
+
+ROOT = Path(__file__).parent.parent
+sys.path.append(str(ROOT))
+
+RESULTS_DIR = Path(__file__).parent / "results"
+MODES = ["inprocess", "uvicorn"]
+
+CONFIG = """
+server:
+  enable_web_ui: false
+  rendition_workers: 0
+
+storage:
+  - name: default
+    type: disk
+    path: ./data/default/
+    index: true
+{transform_cache}
+executors:
+  io:
+    type: thread
+    workers: 32
+    max_pending: 4096
+  transform:
+    type: process
+    workers: 0
+    max_pending: 4096
+
+database:
+  url: sqlite://data/database.db
+
+metrics:
+  slow_request: null
+"""
+
+# bucket -> description, built by build_data
+DATASETS = {
+    "small": "many small files, 1 to 16 KiB",
+    "huge": "few huge files",
+    "deep": "files in a deep tree",
+    "photos": "camera size JPEGs",
+}
+
+# (method, path, body)
+type Request = tuple[str, str, bytes]
+
+
+@dataclass
+class Scenario:
+    name: str
+    description: str
+    # requests at factor 1
+    requests: int
+    make: Callable[[random.Random, int], Request]
+
+
+@dataclass
+class Result:
+    mode: str
+    scenario: str
+    requests: int
+    concurrency: int
+    errors: int
+    seconds: float
+    rps: float
+    p50_ms: float
+    p99_ms: float
+    mean_ms: float
+    bytes: int
+    # bytes, None where not available
+    peak_rss: int | None
+    children_peak_rss: int | None
+    statuses: dict[str, int] = field(default_factory=dict)
+
+
+def write_file(storage, bucket: str, key: str, content: bytes) -> None:
+    with storage.open_write(bucket, key) as f:
+        f.write(content)
+
+
+def camera_jpeg(rng: random.Random, width: int = 4000, height: int = 3000) -> bytes:
+    """
+    A synthetic photo, noise over gradients, which compresses about as badly
+    as a real one.
+    """
+    from PIL import Image
+
+    noise = Image.effect_noise((width, height), rng.randint(20, 60))
+    gradient = Image.linear_gradient("L").resize((width, height))
+    radial = Image.radial_gradient("L").resize((width, height))
+    image = Image.merge("RGB", (noise, gradient, radial))
+    output = io.BytesIO()
+    image.save(output, format="JPEG", quality=90)
+    return output.getvalue()
+
+
+def build_data(args: argparse.Namespace) -> dict:
+    """
+    Generate the buckets at the work directory, unless already there.
+    Returns the manifest of the generated keys.
+    """
+    manifest_path = Path(args.workdir) / "manifest.json"
+    if manifest_path.exists():
+        manifest = json.loads(manifest_path.read_text())
+        if manifest.get("params") == data_params(args):
+            return manifest
+        shutil.rmtree(Path(args.workdir) / "data", ignore_errors=True)
+
+    from am.storage.factory import registry
+
+    storage = registry.get("default")
+    rng = random.Random(args.seed)
+    keys: dict[str, list[str]] = {name: [] for name in DATASETS}
+    for bucket in DATASETS:
+        storage.create_bucket(bucket)
+    storage.create_bucket("uploads")
+
+    print(f"Generating {args.small_files} small files", flush=True)
+    for i in range(args.small_files):
+        key = f"assets/file-{i:06d}.css"
+        write_file(storage, "small", key, rng.randbytes(rng.randint(1024, 16384)))
+        keys["small"].append(key)
+
+    print(f"Generating {args.huge_files} huge files", flush=True)
+    for i in range(args.huge_files):
+        key = f"video-{i}.bin"
+        with storage.open_write("huge", key) as f:
+            chunk = rng.randbytes(1024 * 1024)
+            for _ in range(args.huge_size // len(chunk)):
+                f.write(chunk)
+        keys["huge"].append(key)
+
+    print(f"Generating {args.deep_files} files in a deep tree", flush=True)
+    for i in range(args.deep_files):
+        parts = [f"d{(i >> (2 * level)) % 4}" for level in range(args.deep_levels)]
+        key = "/".join(parts) + f"/file-{i:06d}.json"
+        write_file(storage, "deep", key, rng.randbytes(rng.randint(256, 4096)))
+        keys["deep"].append(key)
+
+    print(f"Generating {args.photos} camera size JPEGs", flush=True)
+    for i in range(args.photos):
+        key = f"camera/IMG_{i:04d}.jpg"
+        write_file(storage, "photos", key, camera_jpeg(rng))
+        keys["photos"].append(key)
+
+    manifest = {"params": data_params(args), "keys": keys}
+    manifest_path.write_text(json.dumps(manifest))
+    return manifest
+
+
+def data_params(args: argparse.Namespace) -> dict:
+    return {
+        "seed": args.seed,
+        "small_files": args.small_files,
+        "huge_files": args.huge_files,
+        "huge_size": args.huge_size,
+        "deep_files": args.deep_files,
+        "deep_levels": args.deep_levels,
+        "photos": args.photos,
+    }
+
+
+def make_scenarios(manifest: dict, args: argparse.Namespace) -> list[Scenario]:
+    keys = manifest["keys"]
+    upload = random.Random(args.seed).randbytes(args.upload_size)
+    # unique keys across modes and runs
+    run_id = f"{os.getpid()}-{int(time.time())}"
+    counter = itertools.count()
+    sizes = [(320, 240), (800, 600), (1600, 1200)]
+
+    def get_small(rng, _):
+        return "GET", f"/api/v1/small/{rng.choice(keys['small'])}", b""
+
+    def get_deep(rng, _):
+        return "GET", f"/api/v1/deep/{rng.choice(keys['deep'])}", b""
+
+    def get_huge(rng, _):
+        return "GET", f"/api/v1/huge/{rng.choice(keys['huge'])}", b""
+
+    def get_resize(rng, _):
+        width, height = rng.choice(sizes)
+        key = rng.choice(keys["photos"])
+        query = f"transform=resize&width={width}&height={height}&format=jpeg"
+        return "GET", f"/api/v1/photos/{key}?{query}", b""
+
+    def list_small(rng, _):
+        return "GET", "/api/v1/small/?max_keys=1000", b""
+
+    def list_deep(rng, _):
+        prefix = "/".join(f"d{rng.randrange(4)}" for _ in range(2)) + "/"
+        return "GET", f"/api/v1/deep/?prefix={prefix}&delimiter=/", b""
+
+    def create_file(rng, _):
+        return "PUT", f"/api/v1/uploads/{run_id}/{next(counter)}.bin", upload
+
+    return [
+        Scenario("get_small", "get_file of small files", 5000, get_small),
+        Scenario("get_deep", "get_file in a deep tree", 2000, get_deep),
+        Scenario("get_huge", "get_file of huge files", 20, get_huge),
+        Scenario("get_resize", "get_file with transform=resize", 100, get_resize),
+        Scenario("list_small", "list_files, 1000 keys a page", 200, list_small),
+        Scenario("list_deep", "list_files with a delimiter", 1000, list_deep),
+        Scenario("create_file", "create_file", 1000, create_file),
+    ]
+
+
+def percentile(values: list[float], fraction: float) -> float:
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(int(len(values) * fraction), len(values) - 1)]
+
+
+def proc_status(pid: int, field_name: str) -> int | None:
+    """
+    A memory field of /proc/<pid>/status, in bytes, None if not available.
+    """
+    try:
+        with open(f"/proc/{pid}/status", encoding="ascii") as f:
+            for line in f:
+                if line.startswith(field_name + ":"):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    return None
+
+
+def child_pids(pid: int) -> list[int]:
+    """
+    The processes started by pid and by its children, as the workers and
+    their transform processes.
+    """
+    pids = []
+    try:
+        for task in os.listdir(f"/proc/{pid}/task"):
+            with open(f"/proc/{pid}/task/{task}/children", encoding="ascii") as f:
+                pids.extend(int(child) for child in f.read().split())
+    except OSError:
+        pass
+    return pids + [grandchild for child in pids for grandchild in child_pids(child)]
+
+
+def reset_peak_rss(pid: int) -> None:
+    """
+    Reset the peak RSS of the process and its children, so it is measured by
+    scenario. Only on Linux, elsewhere the peak is the one since start.
+    """
+    for target in [pid, *child_pids(pid)]:
+        try:
+            with open(f"/proc/{target}/clear_refs", "w", encoding="ascii") as f:
+                f.write("5")
+        except OSError:
+            pass
+
+
+def peak_rss(pid: int) -> tuple[int | None, int | None]:
+    """
+    Peak RSS of the process and the sum of the ones of its children.
+    """
+    peak = proc_status(pid, "VmHWM")
+    if peak is None and pid == os.getpid():
+        import resource
+
+        # KiB on Linux, only since the start of the process
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+    children = [proc_status(child, "VmHWM") for child in child_pids(pid)]
+    children_peak = sum(c for c in children if c) if children else None
+    return peak, children_peak
+
+
+def summarize(
+    mode: str,
+    scenario: Scenario,
+    concurrency: int,
+    latencies: list[float],
+    statuses: dict[int, int],
+    received: int,
+    seconds: float,
+    pid: int,
+) -> Result:
+    requests = sum(statuses.values())
+    errors = sum(count for status, count in statuses.items() if status >= 400)
+    peak, children_peak = peak_rss(pid)
+    return Result(
+        mode=mode,
+        scenario=scenario.name,
+        requests=requests,
+        concurrency=concurrency,
+        errors=errors,
+        seconds=round(seconds, 3),
+        rps=round(requests / seconds, 1) if seconds else 0.0,
+        p50_ms=round(percentile(latencies, 0.5) * 1000, 2),
+        p99_ms=round(percentile(latencies, 0.99) * 1000, 2),
+        mean_ms=round(statistics.fmean(latencies) * 1000, 2) if latencies else 0.0,
+        bytes=received,
+        peak_rss=peak,
+        children_peak_rss=children_peak,
+        statuses={str(status): count for status, count in sorted(statuses.items())},
+    )
+
+
+async def asgi_request(app, method: str, target: str, body: bytes) -> tuple[int, int]:
+    """
+    Call the ASGI app with a request, returning its status and body size.
+    """
+    path, _, query = target.partition("?")
+    headers = [(b"host", b"bench")]
+    if body:
+        headers.append((b"content-length", str(len(body)).encode()))
+    scope = {
+        "type": "http",
+        "asgi": {"version": "3.0"},
+        "http_version": "1.1",
+        "method": method,
+        "scheme": "http",
+        "path": path,
+        "raw_path": path.encode(),
+        "query_string": query.encode(),
+        "root_path": "",
+        "headers": headers,
+        "client": ("127.0.0.1", 0),
+        "server": ("bench", 80),
+        "extensions": {},
+    }
+    done = asyncio.Event()
+    sent_body = False
+    status = 0
+    size = 0
+
+    async def receive():
+        nonlocal sent_body
+        if not sent_body:
+            sent_body = True
+            return {"type": "http.request", "body": body, "more_body": False}
+        await done.wait()
+        return {"type": "http.disconnect"}
+
+    async def send(message):
+        nonlocal status, size
+        if message["type"] == "http.response.start":
+            status = message["status"]
+        elif message["type"] == "http.response.body":
+            size += len(message.get("body", b""))
+            if not message.get("more_body", False):
+                done.set()
+
+    try:
+        await app(scope, receive, send)
+    finally:
+        done.set()
+    return status, size
+
+
+async def run_inprocess(
+    app, scenarios: list[Scenario], args: argparse.Namespace
+) -> list[Result]:
+    results = []
+    async with app.router.lifespan_context(app):
+        for scenario in scenarios:
+            count = max(1, int(scenario.requests * args.factor))
+            rng = random.Random(args.seed)
+            requests = [scenario.make(rng, i) for i in range(count)]
+            queue = iter(requests)
+            latencies: list[float] = []
+            statuses: dict[int, int] = {}
+            received = 0
+
+            async def worker():
+                nonlocal received
+                for method, target, body in queue:
+                    start = time.perf_counter()
+                    status, size = await asgi_request(app, method, target, body)
+                    latencies.append(time.perf_counter() - start)
+                    statuses[status] = statuses.get(status, 0) + 1
+                    received += size
+
+            reset_peak_rss(os.getpid())
+            start = time.perf_counter()
+            await asyncio.gather(*(worker() for _ in range(args.concurrency)))
+            seconds = time.perf_counter() - start
+            result = summarize(
+                "inprocess",
+                scenario,
+                args.concurrency,
+                latencies,
+                statuses,
+                received,
+                seconds,
+                os.getpid(),
+            )
+            print_result(result)
+            results.append(result)
+    return results
+
+
+def free_port() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def start_uvicorn(args: argparse.Namespace) -> tuple[subprocess.Popen, int]:
+    port = free_port()
+    env = {
+        **os.environ,
+        "PYTHONPATH": str(ROOT),
+        "LOG_LEVEL": "WARNING",
+    }
+    process = subprocess.Popen(
+        [
+            sys.executable,
+            str(ROOT / "serve.py"),
+            "--host",
+            "127.0.0.1",
+            "--port",
+            str(port),
+            "--workers",
+            str(args.workers),
+        ],
+        cwd=args.workdir,
+        env=env,
+    )
+    deadline = time.monotonic() + 30
+    while time.monotonic() < deadline:
+        if process.poll() is not None:
+            raise RuntimeError("uvicorn exited while starting")
+        try:
+            connection = http.client.HTTPConnection("127.0.0.1", port, timeout=1)
+            connection.request("GET", "/api/v1/")
+            connection.getresponse().read()
+            connection.close()
+            return process, port
+        except OSError:
+            time.sleep(0.1)
+    process.terminate()
+    raise RuntimeError("uvicorn did not start")
+
+
+def run_uvicorn(scenarios: list[Scenario], args: argparse.Namespace) -> list[Result]:
+    """
+    Drive a local uvicorn over HTTP/1.1 with keep alive connections, one per
+    client thread.
+    """
+    process, port = start_uvicorn(args)
+    results = []
+    try:
+        for scenario in scenarios:
+            count = max(1, int(scenario.requests * args.factor))
+            rng = random.Random(args.seed)
+            requests = iter([scenario.make(rng, i) for i in range(count)])
+            lock = threading.Lock()
+            latencies: list[float] = []
+            statuses: dict[int, int] = {}
+            received = 0
+
+            def worker():
+                nonlocal received
+                connection = http.client.HTTPConnection("127.0.0.1", port)
+                try:
+                    while True:
+                        with lock:
+                            request = next(requests, None)
+                        if request is None:
+                            return
+                        method, target, body = request
+                        start = time.perf_counter()
+                        connection.request(method, target, body=body or None)
+                        response = connection.getresponse()
+                        size = len(response.read())
+                        elapsed = time.perf_counter() - start
+                        with lock:
+                            latencies.append(elapsed)
+                            statuses[response.status] = (
+                                statuses.get(response.status, 0) + 1
+                            )
+                            received += size
+                finally:
+                    connection.close()
+
+            reset_peak_rss(process.pid)
+            start = time.perf_counter()
+            with ThreadPoolExecutor(max_workers=args.concurrency) as pool:
+                for future in [pool.submit(worker) for _ in range(args.concurrency)]:
+                    future.result()
+            seconds = time.perf_counter() - start
+            result = summarize(
+                "uvicorn",
+                scenario,
+                args.concurrency,
+                latencies,
+                statuses,
+                received,
+                seconds,
+                process.pid,
+            )
+            print_result(result)
+            results.append(result)
+    finally:
+        process.terminate()
+        process.wait()
+    return results
+
+
+def format_bytes(size: int | None) -> str:
+    if size is None:
+        return "-"
+    return f"{size / 1024 / 1024:.0f}MiB"
+
+
+def print_result(result: Result) -> None:
+    print(
+        f"{result.mode:10} {result.scenario:12} {result.requests:6d} req "
+        f"{result.rps:9.1f} req/s  p50 {result.p50_ms:8.2f}ms  "
+        f"p99 {result.p99_ms:8.2f}ms  errors {result.errors:4d}  "
+        f"rss {format_bytes(result.peak_rss)}"
+        f" +{format_bytes(result.children_peak_rss)}",
+        flush=True,
+    )
+
+
+def compare(previous_path: str, results: list[Result]) -> None:
+    """
+    Print the change of each result against the same mode and scenario of a
+    previous run.
+    """
+    previous = json.loads(Path(previous_path).read_text())
+    before = {(r["mode"], r["scenario"]): r for r in previous["results"]}
+    print(f"\nCompared to {previous_path} ({previous.get('commit')}):")
+    for result in results:
+        old = before.get((result.mode, result.scenario))
+        if old is None:
+            continue
+        changes = []
+        for name in ["rps", "p50_ms", "p99_ms"]:
+            value, old_value = getattr(result, name), old[name]
+            change = (value - old_value) / old_value * 100 if old_value else 0.0
+            changes.append(f"{name} {old_value} -> {value} ({change:+.1f}%)")
+        print(f"{result.mode:10} {result.scenario:12} " + "  ".join(changes))
+
+
+def git_commit() -> str | None:
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"],
+            cwd=ROOT,
+            capture_output=True,
+            text=True,
+            check=True,
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def load_args() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description="Benchmark the server")
+    parser.add_argument("--mode", choices=[*MODES, "both"], default="both")
+    parser.add_argument(
+        "--scenario",
+        action="append",
+        help="Scenarios to run, all by default, may be repeated",
+    )
+    parser.add_argument(
+        "--factor",
+        type=float,
+        default=1.0,
+        help="Multiplier of the requests of each scenario, as 0.1 for a quick run",
+    )
+    parser.add_argument("--concurrency", type=int, default=16)
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=1,
+        help="Server processes of the uvicorn mode, 0 for one per CPU",
+    )
+    parser.add_argument("--workdir", type=str, default="/tmp/am-bench")
+    parser.add_argument("--output", type=str, default=None)
+    parser.add_argument("--compare", type=str, default=None)
+    parser.add_argument(
+        "--transform-cache",
+        action="store_true",
+        help="Enable the transform cache, so repeated resizes are cache hits",
+    )
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--small-files", type=int, default=5000)
+    parser.add_argument("--huge-files", type=int, default=2)
+    parser.add_argument("--huge-size", type=int, default=256 * 1024 * 1024)
+    parser.add_argument("--deep-files", type=int, default=2000)
+    parser.add_argument("--deep-levels", type=int, default=8)
+    parser.add_argument("--photos", type=int, default=8)
+    parser.add_argument("--upload-size", type=int, default=256 * 1024)
+    return parser.parse_args()
+
+
+def main():
+    args = load_args()
+    args.workdir = os.path.abspath(args.workdir)
+    if args.output:
+        args.output = os.path.abspath(args.output)
+    if args.compare:
+        args.compare = os.path.abspath(args.compare)
+    os.makedirs(args.workdir, exist_ok=True)
+    transform_cache = "    transform_cache: true\n" if args.transform_cache else ""
+    config_path = Path(args.workdir) / "config.yaml"
+    config_path.write_text(CONFIG.format(transform_cache=transform_cache))
+
+    # the server reads its config and logging settings at import time
+    os.chdir(args.workdir)
+    os.environ.setdefault("LOG_LEVEL", "WARNING")
+    os.environ["AM_CONFIG"] = str(config_path)
+    import serve
+    from am.storage.factory import registry
+
+    registry.load()
+    manifest = build_data(args)
+    scenarios = make_scenarios(manifest, args)
+    if args.scenario:
+        unknown = set(args.scenario) - {s.name for s in scenarios}
+        if unknown:
+            raise SystemExit(f"Unknown scenarios: {', '.join(sorted(unknown))}")
+        scenarios = [s for s in scenarios if s.name in args.scenario]
+
+    modes = MODES if args.mode == "both" else [args.mode]
+    results: list[Result] = []
+    if "inprocess" in modes:
+        results += asyncio.run(run_inprocess(serve.app, scenarios, args))
+    if "uvicorn" in modes:
+        results += run_uvicorn(scenarios, args)
+
+    started = datetime.now(timezone.utc)
+    output = (
+        Path(args.output)
+        if args.output
+        else (RESULTS_DIR / f"{started.strftime('%Y%m%dT%H%M%SZ')}.json")
+    )
+    output.parent.mkdir(parents=True, exist_ok=True)
+    output.write_text(
+        json.dumps(
+            {
+                "date": started.isoformat(),
+                "commit": git_commit(),
+                "python": platform.python_version(),
+                "platform": platform.platform(),
+                "cpu_count": os.cpu_count(),
+                "params": {
+                    **data_params(args),
+                    "factor": args.factor,
+                    "concurrency": args.concurrency,
+                    "workers": args.workers,
+                    "upload_size": args.upload_size,
+                    "transform_cache": args.transform_cache,
+                },
+                "results": [asdict(result) for result in results],
+            },
+            indent=2,
+        )
+    )
+    print(f"\nResults saved at {output}")
+    if args.compare:
+        compare(args.compare, results)
+
+
+if __name__ == "__main__":
+    main()
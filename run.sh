@@ -4,17 +4,26 @@
 PORT=${PORT:-8004}
 HOST=${HOST:-0.0.0.0}
 RELOAD=${RELOAD:-0}
+# server processes, 0 for one per CPU, the config one if empty
+WORKERS=${WORKERS:-}
 ENV=${ENV:-production}
 LOG_LEVEL=${LOG_LEVEL:-INFO}
+LOG_FORMAT=${LOG_FORMAT:-json}
 
 # parse options
 if [ "$ENV" = "devel" ]; then
     RELOAD=1
+    LOG_FORMAT=text
 fi
+export LOG_LEVEL LOG_FORMAT
 
 if [ "$RELOAD" = "1" ]; then
     RELOAD_ARG="--reload"
 fi
 
+if [ -n "$WORKERS" ]; then
+    WORKERS_ARG="--workers $WORKERS"
+fi
+
 # run the server
-exec uv run uvicorn serve:app --host $HOST --port $PORT $RELOAD_ARG
+exec uv run python serve.py --host $HOST --port $PORT $RELOAD_ARG $WORKERS_ARG
@@ -5,24 +5,68 @@ Serve the application.
 """
 
 import argparse
-import io
+import asyncio
+import contextlib
 import json
 import logging
 import mimetypes
+import os
 import sys
 import traceback
 import uuid
 from pathlib import Path
+from typing import Iterable, Literal
 
 import fastapi
-import uvicorn
+from am import metrics, server
+from am.archives import (
+    ARCHIVE_MEDIA_TYPES,
+    ARCHIVE_WRITERS,
+    ArchiveError,
+    archive_files,
+    ingest_tar,
+)
+from am.conditional import http_date, if_range_matches, is_not_modified, make_etag
 from am.config import config, load_config
-from am.storage.factory import get_storage
-from am.storage.types import NoSuchBucketError
+from am.executors import ExecutorBusyError, get_executor, shutdown_executors
+from am.hotcache import HotObjectCache, get_hot_cache
+from am.negotiation import negotiate_format, output_media_type
+from am.renditions import (
+    bucket_presets,
+    find_preset,
+    rendition_stat,
+    worker as rendition_worker,
+)
+from am.responses import (
+    JSONArrayResponse,
+    NDJSONResponse,
+    RangeNotSatisfiableError,
+    StorageFileResponse,
+    parse_range_header,
+    timed_chunks,
+)
+from am.storage.factory import get_storage, registry as storage_registry
+from am.storage.listing import InvalidTokenError, LimitedListing, decode_token
+from am.storage.types import (
+    FileData,
+    NoSuchBucketError,
+    Storage,
+    StorageError,
+    is_reserved_key,
+)
 from am.setup import setup_logging, trace_id_var
+from am.singleflight import SingleFlight, SingleFlightTimeoutError
+from am.transforms.cache import get_transform_cache
 from am.transforms.factory import factory as transforms_factory
+from am.transforms.types import (
+    InvalidTransformError,
+    Transform,
+    run_transform,
+    transform_source,
+)
 from amm.app import routes as amm_routes
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import StreamingResponse
 
 sys.path.append(str(Path(__file__).parent))
 
@@ -30,8 +74,52 @@ setup_logging()
 
 logger = logging.getLogger(__name__)
 
+# max number of keys in a listing page
+MAX_KEYS = 1000
+
+
+def load_args():
+    """
+    Load the arguments.
+    """
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--config", type=str, default="config.yaml")
+    parser.add_argument("--port", type=int, default=None)
+    parser.add_argument("--host", type=str, default=None)
+    parser.add_argument("--reload", action="store_true", default=None)
+    parser.add_argument(
+        "--workers", type=int, default=None, help="Server processes, 0 for one per CPU"
+    )
+    return parser.parse_args()
+
+
+# the arguments are only read when run as a script. Otherwise, as by uvicorn
+# or the reloader, the config path is taken from AM_CONFIG
+if __name__ == "__main__":
+    args = load_args()
+    os.environ["AM_CONFIG"] = args.config
+CONFIG_PATH = os.environ.get("AM_CONFIG", "config.yaml")
+
+try:
+    load_config(CONFIG_PATH)
+except Exception as e:
+    logger.error("Error loading config: %s", e)
+    sys.exit(1)
+
+
+@contextlib.asynccontextmanager
+async def lifespan(app: fastapi.FastAPI):
+    storage_registry.load()
+    rendition_worker.start(config.server.rendition_workers)
+    if config.server.config_reload_interval:
+        storage_registry.watch(CONFIG_PATH, config.server.config_reload_interval)
+    yield
+    storage_registry.stop()
+    rendition_worker.stop()
+    shutdown_executors()
 
-app = fastapi.FastAPI()
+
+app = fastapi.FastAPI(lifespan=lifespan)
 app.add_middleware(
     CORSMiddleware,
     allow_origins=config.server.allow_origins,
@@ -39,6 +127,16 @@ app.add_middleware(
     allow_methods=["*"],
     allow_headers=["*"],
 )
+if config.metrics.enabled:
+    # added before set_trace_id, so it runs within it and logs the trace_id
+    app.add_middleware(metrics.MetricsMiddleware)
+
+    @app.get(config.metrics.path, include_in_schema=False)
+    async def get_metrics():
+        return fastapi.Response(
+            content=metrics.registry.render(),
+            media_type="text/plain; version=0.0.4; charset=utf-8",
+        )
 
 
 @app.middleware("http")
@@ -51,10 +149,34 @@ async def set_trace_id(request: fastapi.Request, call_next):
     return response
 
 
+@app.exception_handler(ExecutorBusyError)
+async def executor_busy(request: fastapi.Request, exc: ExecutorBusyError):
+    logger.warning("Rejecting request, executor=%s is busy", exc.name)
+    return fastapi.Response(
+        status_code=503,
+        media_type="application/json",
+        content=json.dumps({"details": str(exc)}),
+        headers={"Retry-After": str(exc.retry_after)},
+    )
+
+
+@app.exception_handler(SingleFlightTimeoutError)
+async def transform_timeout(request: fastapi.Request, exc: SingleFlightTimeoutError):
+    logger.warning("Rejecting request, transform timed out after %ss", exc.timeout)
+    return fastapi.Response(
+        status_code=503,
+        media_type="application/json",
+        content=json.dumps({"details": "Transform timed out"}),
+        headers={"Retry-After": str(int(exc.timeout))},
+    )
+
+
 @app.get("/api/v1/")
-def list_buckets():
+async def list_buckets():
     storage = get_storage("default")
-    buckets = storage.list_buckets()
+    buckets = await get_executor("io").run(
+        metrics.timed("storage.list", storage.list_buckets)
+    )
     logger.debug("Buckets: %s", buckets)
     return {
         "owner": "test",
@@ -68,119 +190,548 @@ def list_buckets():
     }
 
 
+def file_data_to_dict(file: FileData) -> dict:
+    return {
+        "key": file.key,
+        "size": file.size,
+        "last_modified": file.last_modified.isoformat(),
+    }
+
+
 @app.get("/api/v1/{bucket}/")
-def list_files(bucket: str):
+async def list_files(
+    bucket: str,
+    prefix: str = "",
+    delimiter: str | None = None,
+    continuation_token: str | None = None,
+    max_keys: int | None = fastapi.Query(default=None, ge=1),
+    stream: bool = False,
+    format: Literal["json", "ndjson"] = "json",
+    archive: Literal["tar", "zip"] | None = None,
+):
+    """
+    List a page of files, of at most max_keys (1000) files and common prefixes.
+
+    With stream=true the listing is streamed as it is read, with no limit
+    unless max_keys is given, either as a JSON object or, with format=ndjson,
+    one entry per line. Common prefixes are streamed as {"prefix": ...}
+    entries, and the listing ends with the continuation token.
+
+    With archive=tar or archive=zip all the files under the prefix are
+    downloaded as an archive, streamed as they are read.
+    """
     try:
         storage = get_storage(bucket)
-        return {
-            "contents": [
-                {
-                    "key": file.key,
-                    "size": file.size,
-                    "last_modified": file.last_modified.isoformat(),
-                }
-                for file in storage.list_files(bucket)
-            ]
-        }
+        if archive is not None:
+            entries = await get_executor("io").run(
+                metrics.timed("storage.list", storage.iter_listing),
+                bucket,
+                prefix=prefix,
+            )
+            return archive_response(storage, bucket, archive_files(entries), archive)
+        if stream:
+            start_after = (
+                decode_token(continuation_token) if continuation_token else None
+            )
+            entries = await get_executor("io").run(
+                metrics.timed("storage.list", storage.iter_listing),
+                bucket,
+                prefix=prefix,
+                delimiter=delimiter or None,
+                start_after=start_after,
+            )
+            return listing_response(LimitedListing(entries, max_keys), format)
+
+        page = await get_executor("io").run(
+            metrics.timed("storage.list", storage.list_page),
+            bucket,
+            prefix=prefix,
+            delimiter=delimiter or None,
+            token=continuation_token,
+            max_keys=min(max_keys or MAX_KEYS, MAX_KEYS),
+        )
     except NoSuchBucketError:
         return fastapi.Response(
             status_code=404,
             media_type="application/json",
             content=json.dumps({"details": f"Bucket {bucket} not found"}),
         )
+    except InvalidTokenError as e:
+        return fastapi.Response(
+            status_code=400,
+            media_type="application/json",
+            content=json.dumps({"details": str(e)}),
+        )
+    return {
+        "contents": [file_data_to_dict(file) for file in page.files],
+        "common_prefixes": page.common_prefixes,
+        "is_truncated": page.next_token is not None,
+        "next_continuation_token": page.next_token,
+    }
+
+
+def listing_response(listing: LimitedListing, format: str) -> fastapi.Response:
+    """
+    Stream a listing, files and common prefixes, as JSON or NDJSON.
+    """
+
+    def entries():
+        for entry in listing:
+            if isinstance(entry, str):
+                yield {"prefix": entry}
+            else:
+                yield file_data_to_dict(entry)
+
+    def trailer():
+        return {
+            "is_truncated": listing.next_token is not None,
+            "next_continuation_token": listing.next_token,
+        }
+
+    if format == "ndjson":
+        return NDJSONResponse(entries(), trailer=trailer)
+    return JSONArrayResponse(entries(), trailer=trailer)
+
+
+def archive_response(
+    storage: Storage, bucket: str, files: Iterable[FileData], archive: str
+) -> fastapi.Response:
+    """
+    Stream an archive of the files, reading them one by one.
+    """
+    chunks = ARCHIVE_WRITERS[archive](storage, bucket, files)
+    return StreamingResponse(
+        get_executor("io").iterate(timed_chunks(chunks)),
+        media_type=ARCHIVE_MEDIA_TYPES[archive],
+        headers={"Content-Disposition": f'attachment; filename="{bucket}.{archive}"'},
+    )
 
 
 @app.put("/api/v1/{bucket}/")
-def create_bucket(bucket: str):
+async def create_bucket(bucket: str):
     storage = get_storage(bucket)
-    storage.create_bucket(bucket)
+    await get_executor("io").run(
+        metrics.timed("storage.create_bucket", storage.create_bucket), bucket
+    )
     return {"bucket": bucket}
 
 
+def file_headers(bucket: str, stat: FileData, variant: str | None = None) -> dict:
+    """
+    Get the validator and caching headers of a file, or of a variant of it.
+    """
+    headers = {
+        "Last-Modified": http_date(stat.last_modified),
+        "ETag": make_etag(stat, variant),
+    }
+    cache_control = config.bucket(bucket).cache_control
+    if cache_control:
+        headers["Cache-Control"] = cache_control
+    return headers
+
+
+def file_not_found(file: str) -> fastapi.Response:
+    return fastapi.Response(
+        status_code=404,
+        media_type="application/json",
+        content=json.dumps({"details": f"File {file} not found"}),
+    )
+
+
 @app.head("/api/v1/{bucket}/{file:path}")
-def head_file(bucket: str, file: str):
+async def head_file(request: fastapi.Request, bucket: str, file: str):
+    if is_reserved_key(file):
+        return file_not_found(file)
     storage = get_storage(bucket)
-    stat = storage.stat(bucket, file)
+    try:
+        stat = await get_executor("io").run(
+            metrics.timed("storage.stat", storage.stat), bucket, file
+        )
+    except (StorageError, OSError) as e:
+        return fastapi.Response(
+            status_code=404,
+            media_type="application/json",
+            content=json.dumps({"details": str(e)}),
+        )
+    headers = file_headers(bucket, stat)
+    if is_not_modified(request.headers, headers["ETag"], stat.last_modified):
+        return fastapi.Response(status_code=304, headers=headers)
     return fastapi.Response(
         status_code=200,
         media_type=mimetypes.guess_type(file)[0] or "application/octet-stream",
         headers={
-            "Last-Modified": stat.last_modified.isoformat(),
+            **headers,
+            "Content-Length": str(stat.size),
+            "Accept-Ranges": "bytes",
         },
     )
 
 
 @app.get("/api/v1/{bucket}/{file:path}")
-def get_file(
-    request: fastapi.Request, bucket: str, file: str, transform: str | None = None
+async def get_file(
+    request: fastapi.Request,
+    bucket: str,
+    file: str,
+    transform: str | None = None,
+    rendition: str | None = None,
 ):
-    if transform:
-        transform = transforms_factory.create_transform(transform, request.query_params)
+    # internal keys, as renditions, are only served through their file
+    if is_reserved_key(file):
+        return file_not_found(file)
+    mime_type = mimetypes.guess_type(file)[0] or "application/octet-stream"
+    # whether the output format was chosen from Accept
+    negotiated = False
+    if rendition:
+        transform = bucket_presets(bucket).get(rendition)
+        if transform is None:
+            return fastapi.Response(
+                status_code=404,
+                media_type="application/json",
+                content=json.dumps({"details": f"Rendition {rendition} not found"}),
+            )
+    elif transform:
+        params = dict(request.query_params)
+        if mime_type.startswith("image/") and params.get("format", "auto") == "auto":
+            params["format"] = negotiate_format(
+                request.headers.get("Accept"),
+                mime_type,
+                config.server.negotiated_formats,
+            )
+            negotiated = True
+        try:
+            transform = transforms_factory.create_transform(transform, params)
+        except InvalidTransformError as e:
+            return fastapi.Response(
+                status_code=400,
+                media_type="application/json",
+                content=json.dumps({"details": str(e)}),
+            )
     else:
         transform = None
 
     storage = get_storage(bucket)
-    mime_type = mimetypes.guess_type(file)[0] or "application/octet-stream"
+    hot_cache = get_hot_cache() if transform is None else None
+    if hot_cache is not None:
+        response = await hot_response(request, hot_cache, storage, bucket, file)
+        if response is not None:
+            return response
+
     try:
-        stat = storage.stat(bucket, file)
-        with storage.open_read(bucket, file) as f:
-            if transform:
-                content = io.BytesIO()
-                transform.apply(f, content)
-                content = content.getvalue()
-            else:
-                content = f.read()
-    except Exception as e:
-        traceback.print_exc()
+        stat = await get_executor("io").run(
+            metrics.timed("storage.stat", storage.stat), bucket, file
+        )
+    except (StorageError, OSError) as e:
         return fastapi.Response(
             status_code=404,
             media_type="application/json",
             content=json.dumps({"details": str(e)}),
         )
 
-    if request.headers.get("If-Modified-Since") == stat.last_modified.isoformat():
-        return fastapi.Response(
-            status_code=304,
-            headers={
-                "Last-Modified": stat.last_modified.isoformat(),
-            },
-        )
-    return fastapi.Response(
-        content=content,
+    # decide on 304 before opening the file
+    headers = file_headers(bucket, stat, transform and transform.cache_key())
+    if negotiated:
+        headers["Vary"] = "Accept"
+    if is_not_modified(request.headers, headers["ETag"], stat.last_modified):
+        return fastapi.Response(status_code=304, headers=headers)
+
+    if transform:
+        mime_type = output_media_type(transform.encode_options(), mime_type)
+        preset = rendition or find_preset(bucket, transform)
+        if preset:
+            rendered = await get_executor("io").run(
+                metrics.timed("storage.stat", rendition_stat),
+                storage,
+                bucket,
+                stat,
+                preset,
+            )
+            if rendered is not None:
+                return StorageFileResponse(
+                    storage, bucket, rendered, media_type=mime_type, headers=headers
+                )
+        try:
+            content = await apply_transform(storage, bucket, stat, transform)
+        except (ExecutorBusyError, SingleFlightTimeoutError):
+            raise
+        except Exception as e:
+            traceback.print_exc()
+            return fastapi.Response(
+                status_code=404,
+                media_type="application/json",
+                content=json.dumps({"details": str(e)}),
+            )
+        return fastapi.Response(content=content, media_type=mime_type, headers=headers)
+
+    range_header = request.headers.get("Range")
+    if hot_cache is not None and not range_header and hot_cache.accepts(stat):
+        try:
+            content = await get_executor("io").run(
+                metrics.timed("storage.read", read_small_file), storage, bucket, stat
+            )
+        except (StorageError, OSError):
+            return file_not_found(file)
+        if content is not None:
+            headers = hot_headers(bucket, stat, mime_type)
+            hot_cache.put(storage.name, bucket, stat, content, headers)
+            return fastapi.Response(content=content, headers=headers)
+
+    ranges = None
+    if range_header and if_range_matches(
+        request.headers, headers["ETag"], stat.last_modified
+    ):
+        try:
+            ranges = parse_range_header(range_header, stat.size)
+        except RangeNotSatisfiableError:
+            return fastapi.Response(
+                status_code=416,
+                headers={"Content-Range": f"bytes */{stat.size}", **headers},
+            )
+    return StorageFileResponse(
+        storage,
+        bucket,
+        stat,
         media_type=mime_type,
-        headers={
-            "Last-Modified": stat.last_modified.isoformat(),
-        },
+        headers=headers,
+        ranges=ranges,
+    )
+
+
+def hot_headers(bucket: str, stat: FileData, mime_type: str) -> dict:
+    return {
+        **file_headers(bucket, stat),
+        "Content-Type": mime_type,
+        "Accept-Ranges": "bytes",
+    }
+
+
+def read_small_file(storage: Storage, bucket: str, stat: FileData) -> bytes | None:
+    """
+    Read a whole file, or None if it is no longer the one of the stat.
+    """
+    with storage.open_read(bucket, stat.key) as f:
+        content = f.read()
+    if storage.stat(bucket, stat.key) != stat:
+        return None
+    return content
+
+
+async def hot_response(
+    request: fastapi.Request,
+    hot_cache: HotObjectCache,
+    storage: Storage,
+    bucket: str,
+    file: str,
+) -> fastapi.Response | None:
+    """
+    Serve a file from the hot object cache, or None if it is not there.
+
+    Past its ttl, the cached file is checked against a new stat first.
+    """
+    hot = hot_cache.get(storage.name, bucket, file)
+    if hot is None:
+        return None
+    if not hot_cache.is_fresh(hot):
+        try:
+            stat = await get_executor("io").run(
+                metrics.timed("storage.stat", storage.stat), bucket, file
+            )
+        except StorageError:
+            stat = None
+        if stat != hot.stat:
+            hot_cache.invalidate(storage.name, bucket, file)
+            return None
+        hot_cache.refresh(hot, hot_headers(bucket, stat, hot.headers["Content-Type"]))
+    if is_not_modified(request.headers, hot.headers["ETag"], hot.stat.last_modified):
+        headers = {k: v for k, v in hot.headers.items() if k != "Content-Type"}
+        return fastapi.Response(status_code=304, headers=headers)
+    if request.headers.get("Range"):
+        # ranges are rare for small files, left to the storage path
+        return None
+    return fastapi.Response(content=hot.content, headers=hot.headers)
+
+
+# identical transforms requested at once are computed only once
+transforms_flight = SingleFlight()
+
+# seconds between checks while another process computes the same transform
+TRANSFORM_LOCK_POLL_INTERVAL = 0.05
+
+
+async def apply_transform(
+    storage: Storage, bucket: str, stat: FileData, transform: Transform
+) -> bytes:
+    """
+    Apply the transform to the file, using the transform cache if enabled.
+
+    Concurrent requests for the same file version and transform share a
+    single computation.
+    """
+    cache = get_transform_cache(storage.config)
+    variant = transform.cache_key()
+    if cache is not None:
+        content = await get_executor("io").run(
+            metrics.timed("transform_cache.get", cache.get), bucket, stat, variant
+        )
+        if content is not None:
+            return content
+
+    key = (storage.name, bucket, stat.key, stat.size, stat.last_modified, variant)
+    return await transforms_flight.do(
+        key,
+        lambda: compute_transform(storage, bucket, stat, transform),
+        timeout=config.server.transform_timeout,
     )
 
 
+async def compute_transform(
+    storage: Storage, bucket: str, stat: FileData, transform: Transform
+) -> bytes:
+    """
+    Compute the transform and store it at the cache if enabled.
+
+    Storage and cache access run in the io executor, the transform itself in
+    the transform executor. With a cache, a file lock makes other server
+    processes wait for the output instead of computing it too.
+    """
+    io_executor = get_executor("io")
+    cache = get_transform_cache(storage.config)
+    variant = transform.cache_key()
+    lock = None
+    if cache is not None:
+        while True:
+            lock = await io_executor.run(
+                cache.try_lock, bucket, stat, variant, admitted=True
+            )
+            # it could be stored by the holder of the lock meanwhile
+            content = await io_executor.run(
+                metrics.timed("transform_cache.get", cache.get),
+                bucket,
+                stat,
+                variant,
+                admitted=True,
+            )
+            if content is not None:
+                if lock is not None:
+                    await io_executor.run(cache.unlock, lock, admitted=True)
+                return content
+            if lock is not None:
+                break
+            await asyncio.sleep(TRANSFORM_LOCK_POLL_INTERVAL)
+
+    try:
+        source = await io_executor.run(
+            metrics.timed("storage.read", transform_source), storage, bucket, stat.key
+        )
+        # the stages of the transform are timed in its process and recorded here
+        content, spans = await get_executor("transform").run(
+            metrics.collect_stages, run_transform, transform, source
+        )
+        metrics.record_stages(spans)
+
+        if cache is not None:
+            try:
+                await io_executor.run(
+                    metrics.timed("transform_cache.put", cache.put),
+                    bucket,
+                    stat,
+                    variant,
+                    content,
+                    admitted=True,
+                )
+            except OSError:
+                logger.exception("Error storing transform output: file=%s", stat.key)
+        return content
+    finally:
+        if lock is not None:
+            await io_executor.run(cache.unlock, lock, admitted=True)
+
+
 @app.put("/api/v1/{bucket}/{file:path}")
 async def create_file(request: fastapi.Request, bucket: str, file: str):
+    if is_reserved_key(file):
+        return fastapi.Response(
+            status_code=400,
+            media_type="application/json",
+            content=json.dumps({"details": f"Invalid file name {file}"}),
+        )
+    max_size = config.server.max_upload_size
+    try:
+        content_length = int(request.headers.get("Content-Length") or 0)
+    except ValueError:
+        return fastapi.Response(
+            status_code=400,
+            media_type="application/json",
+            content=json.dumps({"details": "Invalid Content-Length"}),
+        )
+    if max_size is not None and content_length > max_size:
+        return upload_too_large(max_size)
+
     storage = get_storage(bucket)
-    with storage.open_write(bucket, file) as f:
-        f.write(await request.body())
+    io_executor = get_executor("io")
+    # the write is opened, written and committed in the io executor, so it
+    # never blocks the event loop
+    writer = contextlib.ExitStack()
+    f = await io_executor.run(writer.enter_context, storage.open_write(bucket, file))
+    write = metrics.timed("storage.write", f.write)
+    try:
+        size = 0
+        async for chunk in request.stream():
+            size += len(chunk)
+            if max_size is not None and size > max_size:
+                # aborts the write, the previous file is kept
+                raise UploadTooLargeError()
+            await io_executor.run(write, chunk, admitted=True)
+    except BaseException as e:
+        await io_executor.run(
+            writer.__exit__, type(e), e, e.__traceback__, admitted=True
+        )
+        if isinstance(e, UploadTooLargeError):
+            return upload_too_large(max_size)
+        raise
+    await io_executor.run(metrics.timed("storage.commit", writer.close), admitted=True)
     return {"file": file}
 
 
-def load_args():
+@app.post("/api/v1/{bucket}/")
+async def upload_archive(request: fastapi.Request, bucket: str, prefix: str = ""):
     """
-    Load the arguments.
+    Upload the files of a tar, optionally gzip, bzip2 or xz compressed, under
+    the prefix. Files are written as they are received, so the archive size is
+    not limited, each file is limited to max_upload_size.
     """
-    parser = argparse.ArgumentParser()
-    parser.add_argument("other", nargs="*", help="Other arguments are ignored")
-    parser.add_argument("--config", type=str, default="config.yaml")
-    parser.add_argument("--port", type=int, default=None)
-    parser.add_argument("--host", type=str, default=None)
-    parser.add_argument("--reload", action="store_true", default=None)
-    return parser.parse_args()
+    storage = get_storage(bucket)
+    try:
+        result = await ingest_tar(
+            storage, bucket, request.stream(), prefix, config.server.max_upload_size
+        )
+    except NoSuchBucketError:
+        return fastapi.Response(
+            status_code=404,
+            media_type="application/json",
+            content=json.dumps({"details": f"Bucket {bucket} not found"}),
+        )
+    except ArchiveError as e:
+        return fastapi.Response(
+            status_code=400,
+            media_type="application/json",
+            content=json.dumps({"details": str(e), **e.result}),
+        )
+    return result
 
 
-try:
-    args = load_args()
-    load_config(args.config)
-except Exception as e:
-    logger.error("Error loading config: %s", e)
-    sys.exit(1)
+class UploadTooLargeError(Exception):
+    """
+    UploadTooLargeError is raised when an upload goes over max_upload_size.
+    """
+
+
+def upload_too_large(max_size: int) -> fastapi.Response:
+    return fastapi.Response(
+        status_code=413,
+        media_type="application/json",
+        content=json.dumps({"details": f"Upload larger than {max_size} bytes"}),
+    )
+
 
 if config.server.enable_web_ui:
     app.include_router(amm_routes)
@@ -189,9 +740,11 @@ else:
 
 
 if __name__ == "__main__":
-    uvicorn.run(
+    server.run(
+        app,
         "serve:app",
         host=args.host or config.server.host,
         port=args.port or config.server.port,
+        workers=config.server.workers if args.workers is None else args.workers,
         reload=args.reload or config.server.reload,
     )
@@ -0,0 +1,203 @@
+#!/usr/bin/env -S uv run --script
+
+import asyncio
+import io
+import os
+import shutil
+import sys
+import tarfile
+import zipfile
+from pathlib import Path
+from unittest import TestCase
+import unittest
+
+sys.path.append(str(Path(__file__).parent.parent))
+
+from am.archives import (
+    ArchiveError,
+    archive_files,
+    entry_key,
+    ingest_tar,
+    iter_tar,
+    iter_zip,
+)
+from am.config import StorageConfig
+from am.storage.factory import create_storage
+
+
+def make_tar(
+    files: dict[str, bytes], mode: str = "w", format: int = tarfile.PAX_FORMAT
+) -> bytes:
+    buffer = io.BytesIO()
+    with tarfile.open(fileobj=buffer, mode=mode, format=format) as tar:
+        for name, data in files.items():
+            info = tarfile.TarInfo(name)
+            info.size = len(data)
+            tar.addfile(info, io.BytesIO(data))
+    return buffer.getvalue()
+
+
+async def chunked(data: bytes, size: int):
+    for start in range(0, len(data), size):
+        yield data[start : start + size]
+
+
+def ingest(storage, data: bytes, chunk_size: int = 1000, **kwargs) -> dict:
+    """
+    Ingest the archive as a request body of chunks of chunk_size bytes.
+    """
+    return asyncio.run(
+        ingest_tar(storage, "assets", chunked(data, chunk_size), **kwargs)
+    )
+
+
+class TestArchives(TestCase):
+    """
+    TestArchives is a test case for the bulk upload and download archives.
+    """
+
+    def setUp(self):
+        """
+        Set up the test environment.
+        """
+        if os.path.exists("./data/test-archives/"):
+            shutil.rmtree("./data/test-archives/")
+        self.storage = create_storage(
+            StorageConfig(
+                name="test-archives",
+                type="disk",
+                config={"path": "./data/test-archives/"},
+            )
+        )
+        self.storage.create_bucket("assets")
+
+    def tearDown(self):
+        self.storage.close()
+
+    def read(self, key: str) -> bytes:
+        with self.storage.open_read("assets", key) as f:
+            return f.read()
+
+    def files(self):
+        return archive_files(self.storage.iter_listing("assets", prefix=""))
+
+    def test_entry_key(self):
+        assert entry_key("", "css/site.css") == "css/site.css"
+        assert entry_key("v2/", "./css//site.css") == "v2/css/site.css"
+        assert entry_key("", "/etc/passwd") is None
+        assert entry_key("", "../outside") is None
+        assert entry_key("", "css/../../outside") is None
+        assert entry_key("", ".am-meta/x") is None
+        assert entry_key("", "./") is None
+
+    def test_ingest_tar(self):
+        files = {
+            "index.html": b"<html></html>",
+            "css/site.css": b"body {}" * 1000,
+            "a/" + "long-name/" * 20 + "file.txt": bytes(range(256)) * 2800,
+        }
+        cases = [
+            (mode, format, chunk_size)
+            for mode in ("w", "w:gz", "w:bz2", "w:xz")
+            for format in (tarfile.PAX_FORMAT, tarfile.GNU_FORMAT)
+            for chunk_size in (3, 65536)
+        ]
+        for mode, format, chunk_size in cases:
+            if chunk_size == 3 and mode != "w:gz":
+                continue
+            with self.subTest(mode=mode, format=format, chunk_size=chunk_size):
+                data = make_tar(files, mode, format)
+                result = ingest(self.storage, data, chunk_size, prefix="site/")
+                assert result["files"] == len(files)
+                assert result["size"] == sum(len(data) for data in files.values())
+                assert result["skipped_count"] == 0
+                for name, data in files.items():
+                    assert self.read(f"site/{name}") == data
+
+    def test_ingest_tar_skips(self):
+        buffer = io.BytesIO()
+        with tarfile.open(fileobj=buffer, mode="w") as tar:
+            for name, data in [
+                ("ok.txt", b"ok"),
+                ("../up.txt", b"up"),
+                ("big", b"x" * 10),
+            ]:
+                info = tarfile.TarInfo(name)
+                info.size = len(data)
+                tar.addfile(info, io.BytesIO(data))
+            link = tarfile.TarInfo("link")
+            link.type = tarfile.SYMTYPE
+            link.linkname = "/etc/passwd"
+            tar.addfile(link)
+        result = ingest(self.storage, buffer.getvalue(), max_size=5)
+        assert result["files"] == 1
+        assert result["skipped_count"] == 3
+        assert {entry["name"] for entry in result["skipped"]} == {
+            "../up.txt",
+            "big",
+            "link",
+        }
+        assert [file.key for file in self.files()] == ["ok.txt"]
+
+    def test_ingest_tar_clashes(self):
+        """
+        Entries clashing with a file or a directory are skipped.
+        """
+        with self.storage.open_write("assets", "dir/file.txt") as f:
+            f.write(b"file")
+        data = make_tar({"a": b"a", "a/b": b"b", "dir": b"dir", "c": b"c"})
+        result = ingest(self.storage, data)
+        assert result["files"] == 2
+        assert result["skipped_count"] == 2
+        assert {entry["name"] for entry in result["skipped"]} == {"a/b", "dir"}
+        assert [file.key for file in self.files()] == ["a", "c", "dir/file.txt"]
+        assert self.read("c") == b"c"
+
+    def test_ingest_invalid_tar(self):
+        data = make_tar(
+            {"a.txt": b"a", "b.txt": b"b" * 2000}, format=tarfile.USTAR_FORMAT
+        )
+        with self.assertRaises(ArchiveError) as context:
+            # cut in the data of b.txt
+            ingest(self.storage, data[:2000])
+        # files read before the error are kept, the truncated one is not written
+        assert context.exception.result["files"] == 1
+        assert [file.key for file in self.files()] == ["a.txt"]
+
+        for body in [
+            b"garbage",
+            b"\x1f\x8bgarbage",
+            make_tar({"a": b"a"}, "w:gz")[:30],
+        ]:
+            with self.subTest(body=body):
+                with self.assertRaises(ArchiveError):
+                    ingest(self.storage, body)
+
+    def test_download(self):
+        files = {"a.txt": b"a" * 700, "dir/b.bin": os.urandom(300_000), "empty": b""}
+        for name, data in files.items():
+            with self.storage.open_write("assets", name) as f:
+                f.write(data)
+
+        data = b"".join(iter_tar(self.storage, "assets", self.files()))
+        with tarfile.open(fileobj=io.BytesIO(data)) as tar:
+            assert sorted(tar.getnames()) == sorted(files)
+            for name, content in files.items():
+                assert tar.extractfile(name).read() == content
+
+        data = b"".join(iter_zip(self.storage, "assets", self.files()))
+        with zipfile.ZipFile(io.BytesIO(data)) as archive:
+            assert archive.testzip() is None
+            for name, content in files.items():
+                assert archive.read(name) == content
+
+    def test_round_trip(self):
+        files = {f"img/{i}.png": os.urandom(i * 100) for i in range(20)}
+        ingest(self.storage, make_tar(files))
+        exported = b"".join(iter_tar(self.storage, "assets", self.files()))
+        with tarfile.open(fileobj=io.BytesIO(exported)) as tar:
+            assert {m.name: tar.extractfile(m).read() for m in tar} == files
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,159 @@
+#!/usr/bin/env -S uv run --script
+
+import hashlib
+import os
+import shutil
+import sqlite3
+import sys
+from pathlib import Path
+from unittest import TestCase
+import unittest
+
+sys.path.append(str(Path(__file__).parent.parent))
+
+from am.config import StorageConfig
+from am.storage.factory import create_storage
+from am.storage.types import NoSuchBucketError, NoSuchFileError
+
+
+class TestBlobStorage(TestCase):
+    """
+    TestBlobStorage is a test case for the content addressed BlobStorage.
+    """
+
+    def setUp(self):
+        """
+        Set up the test environment.
+        """
+        if os.path.exists("./data/test-blob/"):
+            shutil.rmtree("./data/test-blob/")
+        self.storage = create_storage(
+            StorageConfig(
+                name="test-blob", type="blob", config={"path": "./data/test-blob/"}
+            )
+        )
+
+    def tearDown(self):
+        self.storage.close()
+
+    def blobs(self) -> list[str]:
+        return sorted(
+            name for _, _, names in os.walk(self.storage.blobs_path) for name in names
+        )
+
+    def test_dedup(self):
+        """
+        Identical contents share one blob, removed with the last key.
+        """
+        storage = self.storage
+        logo = hashlib.sha256(b"logo").hexdigest()
+        for bucket in ["a", "b"]:
+            storage.create_bucket(bucket)
+            with storage.open_write(bucket, "logo.png") as f:
+                f.write(b"lo")
+                f.write(b"go")
+        with storage.open_write("a", "other.txt") as f:
+            f.write(b"other")
+
+        assert self.blobs() == sorted([logo, hashlib.sha256(b"other").hexdigest()])
+        stat = storage.stat("b", "logo.png")
+        assert (stat.size, stat.etag) == (4, logo)
+        with storage.open_read("b", "logo.png") as f:
+            assert f.read() == b"logo"
+        assert b"".join(storage.read_range("a", "logo.png", 1, 3)) == b"og"
+        assert [f.key for f in storage.list_files("a")] == ["logo.png", "other.txt"]
+
+        # overwriting releases the old blob
+        with storage.open_write("a", "other.txt") as f:
+            f.write(b"logo")
+        assert self.blobs() == [logo]
+
+        storage.delete_file("a", "logo.png")
+        storage.delete_bucket("a")
+        assert self.blobs() == [logo]
+        storage.delete_file("b", "logo.png")
+        assert self.blobs() == []
+        with self.assertRaises(NoSuchFileError):
+            storage.stat("b", "logo.png")
+        with self.assertRaises(NoSuchBucketError):
+            storage.list_files("a")
+
+    def test_failed_write(self):
+        """
+        A failed write keeps the previous content and leaves no blob behind.
+        """
+        storage = self.storage
+        storage.create_bucket("a")
+        with storage.open_write("a", "file.txt") as f:
+            f.write(b"old")
+        with self.assertRaises(RuntimeError):
+            with storage.open_write("a", "file.txt") as f:
+                f.write(b"new")
+                raise RuntimeError("client went away")
+        with storage.open_read("a", "file.txt") as f:
+            assert f.read() == b"old"
+        assert self.blobs() == [hashlib.sha256(b"old").hexdigest()]
+        assert os.listdir(storage.tmp_path) == []
+
+    def test_failed_transaction(self):
+        """
+        A new blob is removed when the transaction referencing it fails.
+        """
+        storage = self.storage
+        with storage.open_write("a", "file.txt") as f:
+            f.write(b"old")
+
+        def fail(conn, hash):
+            raise sqlite3.OperationalError("disk I/O error")
+
+        storage.release_blob = fail
+        with self.assertRaises(sqlite3.OperationalError):
+            with storage.open_write("a", "file.txt") as f:
+                f.write(b"new")
+        del storage.release_blob
+        with storage.open_read("a", "file.txt") as f:
+            assert f.read() == b"old"
+        assert self.blobs() == [hashlib.sha256(b"old").hexdigest()]
+
+    def test_failed_release(self):
+        """
+        A blob released by a transaction that fails keeps its file.
+        """
+        storage = self.storage
+        with storage.open_write("a", "file.txt") as f:
+            f.write(b"data")
+        release_blob = storage.release_blob
+
+        def fail(conn, hash):
+            release_blob(conn, hash)
+            raise sqlite3.OperationalError("disk I/O error")
+
+        storage.release_blob = fail
+        with self.assertRaises(sqlite3.OperationalError):
+            storage.delete_file("a", "file.txt")
+        del storage.release_blob
+        with storage.open_read("a", "file.txt") as f:
+            assert f.read() == b"data"
+        assert self.blobs() == [hashlib.sha256(b"data").hexdigest()]
+
+        storage.delete_file("a", "file.txt")
+        assert self.blobs() == []
+
+    def test_local_path(self):
+        """
+        The local path is built from the stat, with no lookup.
+        """
+        storage = self.storage
+        with storage.open_write("a", "file.txt") as f:
+            f.write(b"data")
+        stat = storage.stat("a", "file.txt")
+        assert storage.local_path("a", "file.txt") == os.path.abspath(
+            storage.blob_path(stat.etag)
+        )
+        storage.delete_file("a", "file.txt")
+        # deleted meanwhile, the path is still given, as for a disk storage
+        assert storage.local_path("a", "file.txt", stat).endswith(stat.etag)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,74 @@
+#!/usr/bin/env -S uv run --script
+
+import sys
+from datetime import datetime, timezone
+from pathlib import Path
+from unittest import TestCase
+import unittest
+
+
+sys.path.append(str(Path(__file__).parent.parent))
+
+from am.conditional import http_date, if_range_matches, is_not_modified, make_etag
+from am.storage.types import FileData
+
+
+class TestConditional(TestCase):
+    """
+    TestConditional is a test case for the conditional request helpers.
+    """
+
+    stat = FileData(
+        key="test.txt",
+        size=4,
+        last_modified=datetime(2025, 1, 2, 3, 4, 5, 600000, tzinfo=timezone.utc),
+    )
+
+    def test_etag(self):
+        """
+        Stat based and variant ETags are weak, content hashes strong.
+        """
+        assert make_etag(self.stat).startswith('W/"')
+        assert make_etag(self.stat, "resize?width=1") != make_etag(self.stat)
+        hashed = FileData(**{**self.stat.__dict__, "etag": "abc"})
+        assert make_etag(hashed) == '"abc"'
+        assert make_etag(hashed, "resize?width=1").startswith('W/"abc-')
+
+    def test_is_not_modified(self):
+        """
+        Test If-None-Match and If-Modified-Since handling.
+        """
+        etag = make_etag(self.stat)
+        modified = self.stat.last_modified
+        assert http_date(modified) == "Thu, 02 Jan 2025 03:04:05 GMT"
+
+        assert is_not_modified({"if-none-match": etag}, etag, modified)
+        assert is_not_modified({"if-none-match": f'"x", {etag}'}, etag, modified)
+        assert is_not_modified({"if-none-match": "*"}, etag, modified)
+        assert not is_not_modified({"if-none-match": '"x"'}, etag, modified)
+
+        since = "Thu, 02 Jan 2025 03:04:05 GMT"
+        assert is_not_modified({"if-modified-since": since}, etag, modified)
+        earlier = "Thu, 02 Jan 2025 03:04:04 GMT"
+        assert not is_not_modified({"if-modified-since": earlier}, etag, modified)
+        assert not is_not_modified({"if-modified-since": "garbage"}, etag, modified)
+        # If-None-Match takes precedence over If-Modified-Since
+        assert not is_not_modified(
+            {"if-none-match": '"x"', "if-modified-since": since}, etag, modified
+        )
+
+    def test_if_range(self):
+        """
+        If-Range needs a strong ETag or an exact date.
+        """
+        modified = self.stat.last_modified
+        assert if_range_matches({}, '"abc"', modified)
+        assert if_range_matches({"if-range": '"abc"'}, '"abc"', modified)
+        assert not if_range_matches({"if-range": 'W/"abc"'}, 'W/"abc"', modified)
+        assert if_range_matches(
+            {"if-range": "Thu, 02 Jan 2025 03:04:05 GMT"}, '"abc"', modified
+        )
+
+
+if __name__ == "__main__":
+    unittest.main()
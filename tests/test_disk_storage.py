@@ -16,7 +16,7 @@ logging.basicConfig(level=logging.DEBUG)
 
 sys.path.append(str(Path(__file__).parent.parent))
 
-from am.storage.types import NoSuchBucketError
+from am.storage.types import NoSuchBucketError, NoSuchFileError
 from am.storage.factory import create_storage
 from am.config import StorageConfig
 
@@ -72,6 +72,49 @@ class TestDiskStorage(TestCase):
         storage.create_bucket("test")
         assert storage.list_buckets() == ["test"]
 
+    def test_open_write_is_atomic(self):
+        """
+        A failed write keeps the previous file and leaves no partial files.
+        """
+        storage = create_storage(
+            StorageConfig(name="default", type="disk", config={"path": "./data/test/"})
+        )
+        storage.create_bucket("test")
+        with storage.open_write("test", "test.txt") as f:
+            f.write(b"test")
+
+        with self.assertRaises(RuntimeError):
+            with storage.open_write("test", "test.txt") as f:
+                f.write(b"partial")
+                with storage.open_read("test", "test.txt") as reader:
+                    assert reader.read() == b"test"
+                raise RuntimeError("client went away")
+
+        with storage.open_read("test", "test.txt") as f:
+            assert f.read() == b"test"
+        assert os.listdir("./data/test/test") == ["test.txt"]
+
+    def test_directory_is_not_a_file(self):
+        """
+        Keys of directories, or under a file, do not exist.
+        """
+        storage = create_storage(
+            StorageConfig(name="default", type="disk", config={"path": "./data/test/"})
+        )
+        storage.create_bucket("test")
+        with storage.open_write("test", "dir/test.txt") as f:
+            f.write(b"test")
+
+        for key in ["dir", "dir/", "dir/test.txt/x"]:
+            with self.subTest(key=key):
+                with self.assertRaises(NoSuchFileError):
+                    storage.stat("test", key)
+                with self.assertRaises(NoSuchFileError):
+                    with storage.open_read("test", key):
+                        pass
+                with self.assertRaises(NoSuchFileError):
+                    list(storage.read_range("test", key, 0, 1))
+
 
 if __name__ == "__main__":
     unittest.main()
@@ -0,0 +1,50 @@
+#!/usr/bin/env -S uv run --script
+
+import sys
+import time
+from datetime import datetime, timezone
+from pathlib import Path
+from unittest import TestCase
+import unittest
+
+sys.path.append(str(Path(__file__).parent.parent))
+
+from am.hotcache import HotObjectCache
+from am.storage.types import FileData
+
+
+def stat(key: str, size: int) -> FileData:
+    return FileData(key=key, size=size, last_modified=datetime.now(timezone.utc))
+
+
+class TestHotObjectCache(TestCase):
+    """
+    TestHotObjectCache is a test case for the cache of small files.
+    """
+
+    def test_cache(self):
+        cache = HotObjectCache(max_size=10, max_object_size=6, ttl=0.05)
+        assert cache.accepts(stat("a", 6)) and not cache.accepts(stat("a", 7))
+
+        cache.put("default", "b", stat("a", 6), b"aaaaaa", {})
+        cache.put("default", "b", stat("c", 3), b"ccc", {})
+        hot = cache.get("default", "b", "a")
+        assert hot.content == b"aaaaaa" and cache.is_fresh(hot)
+        time.sleep(0.06)
+        assert not cache.is_fresh(hot)
+        cache.refresh(hot, {"ETag": "x"})
+        assert cache.is_fresh(hot) and hot.headers == {"ETag": "x"}
+
+        # bounded by bytes, least recently used first
+        cache.put("default", "b", stat("d", 4), b"dddd", {})
+        assert cache.get("default", "b", "c") is None
+        assert cache.get("default", "b", "a") is not None
+
+        cache.invalidate("default", "b", "a")
+        assert cache.get("default", "b", "a") is None
+        cache.invalidate("default", "b")
+        assert cache.get("default", "b", "d") is None
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,157 @@
+#!/usr/bin/env -S uv run --script
+
+import os
+import shutil
+import sys
+from pathlib import Path
+from unittest import TestCase, mock
+import unittest
+
+sys.path.append(str(Path(__file__).parent.parent))
+
+from am.config import StorageConfig, config
+from am.storage.factory import create_storage
+from am.storage.listing import (
+    MAX_CHAR,
+    InvalidTokenError,
+    LimitedListing,
+    decode_token,
+)
+
+KEYS = ["a-b.txt", "a.txt", "a/1.txt", "a/2.txt", "b/x/1.txt", "c.txt"]
+
+
+class TestListing(TestCase):
+    """
+    TestListing is a test case for paginated listings, walking the disk and
+    using the metadata index.
+    """
+
+    def setUp(self):
+        """
+        Set up the test environment.
+        """
+        if os.path.exists("./data/test-listing/"):
+            shutil.rmtree("./data/test-listing/")
+        config.database.url = "sqlite://data/test-listing/database.db"
+
+    def create_storage(self, index: bool):
+        storage = create_storage(
+            StorageConfig(
+                name="test-listing",
+                type="disk",
+                config={"path": "./data/test-listing/data/", "index": index},
+            )
+        )
+        storage.create_bucket("test")
+        for key in reversed(KEYS):
+            with storage.open_write("test", key) as f:
+                f.write(b"test")
+        return storage
+
+    def check_listing(self, storage):
+        page = storage.list_page("test")
+        assert [file.key for file in page.files] == KEYS
+        assert page.next_token is None
+
+        page = storage.list_page("test", delimiter="/")
+        assert [file.key for file in page.files] == ["a-b.txt", "a.txt", "c.txt"]
+        assert page.common_prefixes == ["a/", "b/"]
+
+        page = storage.list_page("test", prefix="a/")
+        assert [file.key for file in page.files] == ["a/1.txt", "a/2.txt"]
+
+        keys = []
+        token = None
+        while True:
+            page = storage.list_page("test", delimiter="/", token=token, max_keys=2)
+            keys.extend(file.key for file in page.files)
+            keys.extend(page.common_prefixes)
+            token = page.next_token
+            if token is None:
+                break
+        assert keys == ["a-b.txt", "a.txt", "a/", "b/", "c.txt"]
+
+        assert [file.key for file in storage.list_files("test", start=1, limit=2)] == [
+            "a.txt",
+            "a/1.txt",
+        ]
+        with self.assertRaises(InvalidTokenError):
+            storage.list_page("test", token="@@")
+
+    def test_iter_listing(self):
+        """
+        Test the lazy listing with common prefixes and a max_keys limit.
+        """
+        storage = self.create_storage(index=False)
+        entries = storage.iter_listing("test", delimiter="/")
+        listing = LimitedListing(entries, max_keys=3)
+        assert [getattr(e, "key", e) for e in listing] == ["a-b.txt", "a.txt", "a/"]
+        assert listing.next_token is not None
+
+        entries = storage.iter_listing(
+            "test", delimiter="/", start_after=decode_token(listing.next_token)
+        )
+        assert [getattr(e, "key", e) for e in entries] == ["b/", "c.txt"]
+
+    def test_walk(self):
+        """
+        Test listing by walking the bucket directory.
+        """
+        self.check_listing(self.create_storage(index=False))
+
+    def test_walk_skips_common_prefixes(self):
+        """
+        A delimiter listing restarting after a common prefix does not read the
+        directory of that prefix.
+        """
+        storage = self.create_storage(index=False)
+        with mock.patch("am.storage.disk.os.scandir", wraps=os.scandir) as scandir:
+            files = storage.walk_files("test", start_after="a/" + MAX_CHAR)
+            assert [file.key for file in files] == ["b/x/1.txt", "c.txt"]
+        paths = [os.path.basename(call.args[0]) for call in scandir.call_args_list]
+        assert "a" not in paths
+
+    def test_index(self):
+        """
+        Test listing from the index, kept in sync by writes and deletes.
+        """
+        storage = self.create_storage(index=True)
+        self.check_listing(storage)
+
+        storage.delete_file("test", "c.txt")
+        assert [file.key for file in storage.list_page("test").files] == KEYS[:-1]
+
+        # files written behind the index back are found after a reconcile
+        with open("./data/test-listing/data/test/d.txt", "wb") as f:
+            f.write(b"test")
+        storage.index.reconcile(storage.name, "test", storage.walk_files("test"))
+        assert [file.key for file in storage.list_page("test").files] == (
+            KEYS[:-1] + ["d.txt"]
+        )
+
+    def test_index_existing_files(self):
+        """
+        Files stored before the index was turned on are indexed on the first
+        listing of their bucket.
+        """
+        self.create_storage(index=False)
+        # a new database, as the one of setUp may be open from another test
+        config.database.url = "sqlite://data/test-listing/existing.db"
+        storage = create_storage(
+            StorageConfig(
+                name="test-listing",
+                type="disk",
+                config={"path": "./data/test-listing/data/", "index": True},
+            )
+        )
+        assert not storage.index.is_indexed(storage.name, "test")
+        self.check_listing(storage)
+        assert storage.index.is_indexed(storage.name, "test")
+
+        storage.delete_bucket("test")
+        assert not storage.index.is_indexed(storage.name, "test")
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,54 @@
+#!/usr/bin/env -S uv run --script
+
+import json
+import logging
+import sys
+from pathlib import Path
+from unittest import TestCase
+import unittest
+
+sys.path.append(str(Path(__file__).parent.parent))
+
+from am.setup import DebugSampleFilter, JsonFormatter, LogQueueHandler
+
+
+def make_record(level: int, trace_id: str | None = None) -> logging.LogRecord:
+    record = logging.LogRecord("am.test", level, __file__, 1, "file=%s", ("a",), None)
+    record.trace_id = trace_id
+    return record
+
+
+class TestLogging(TestCase):
+    """
+    TestLogging is a test case for the production logging helpers.
+    """
+
+    def test_json(self):
+        try:
+            raise ValueError("boom")
+        except ValueError:
+            record = make_record(logging.ERROR, "abc")
+            record.exc_info = sys.exc_info()
+        prepared = LogQueueHandler(None).prepare(record)
+        entry = json.loads(JsonFormatter().format(prepared))
+        assert entry["message"] == "file=a"
+        assert entry["level"] == "ERROR"
+        assert entry["trace_id"] == "abc"
+        assert "ValueError: boom" in entry["exception"]
+
+    def test_sampling(self):
+        """
+        Debug records are kept or dropped by request, other levels always kept.
+        """
+        sampler = DebugSampleFilter(0.5)
+        trace_ids = [f"trace-{i}" for i in range(200)]
+        kept = [t for t in trace_ids if sampler.filter(make_record(logging.DEBUG, t))]
+        assert 50 < len(kept) < 150
+        for trace_id in kept:
+            assert sampler.filter(make_record(logging.DEBUG, trace_id))
+        assert all(sampler.filter(make_record(logging.INFO, t)) for t in trace_ids)
+        assert not DebugSampleFilter(0).filter(make_record(logging.DEBUG))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,77 @@
+#!/usr/bin/env -S uv run --script
+
+import sys
+from pathlib import Path
+from unittest import TestCase
+import unittest
+
+sys.path.append(str(Path(__file__).parent.parent))
+
+from am import metrics
+
+
+def double(value):
+    with metrics.stage("test.double"):
+        return value * 2
+
+
+class TestMetrics(TestCase):
+    """
+    TestMetrics is a test case for the metrics and the stages of requests.
+    """
+
+    def test_render(self):
+        registry = metrics.Registry()
+        counter = registry.register(
+            metrics.Counter("test_total", "Test counter.", ["kind"])
+        )
+        histogram = registry.register(
+            metrics.Histogram("test_seconds", "Test histogram.", buckets=[0.1, 1])
+        )
+        counter.inc(kind='a"b')
+        counter.inc(2, kind='a"b')
+        histogram.observe(0.05)
+        histogram.observe(0.5)
+        histogram.observe(5)
+
+        text = registry.render()
+        assert "# TYPE test_total counter" in text
+        assert 'test_total{kind="a\\"b"} 3' in text
+        assert 'test_seconds_bucket{le="0.1"} 1' in text
+        assert 'test_seconds_bucket{le="1"} 2' in text
+        assert 'test_seconds_bucket{le="+Inf"} 3' in text
+        assert "test_seconds_sum 5.55" in text
+        assert "test_seconds_count 3" in text
+
+        with self.assertRaises(ValueError):
+            counter.inc(other="x")
+        with self.assertRaises(ValueError):
+            registry.register(metrics.Counter("test_total", "Again."))
+
+    def test_stages(self):
+        """
+        Stages are kept by the trace of the request, and the ones collected
+        for other processes are observed only once recorded back.
+        """
+        before = metrics.STAGE_SECONDS.count(stage="test.double")
+        trace = metrics.Trace()
+        token = metrics.trace_var.set(trace)
+        try:
+            result, spans = metrics.collect_stages(double, 21)
+            assert result == 42
+            assert [name for name, _ in spans] == ["test.double"]
+            assert trace.spans == []
+            assert metrics.STAGE_SECONDS.count(stage="test.double") == before
+
+            metrics.record_stages(spans)
+            metrics.timed("test.double", double)(1)
+        finally:
+            metrics.trace_var.reset(token)
+
+        assert [name for name, _ in trace.spans] == ["test.double"] * 3
+        assert "(x3)" in trace.summary()
+        assert metrics.STAGE_SECONDS.count(stage="test.double") == before + 3
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,52 @@
+#!/usr/bin/env -S uv run --script
+
+import sys
+from pathlib import Path
+from unittest import TestCase
+import unittest
+
+sys.path.append(str(Path(__file__).parent.parent))
+
+from am.negotiation import (
+    negotiate_format,
+    output_media_type,
+    parse_accept,
+    supported_formats,
+)
+
+
+class TestNegotiation(TestCase):
+    """
+    TestNegotiation is a test case for the output format negotiation.
+    """
+
+    def test_parse_accept(self):
+        assert parse_accept("image/avif,image/webp;q=0.9, */*;q=0.8") == {
+            "image/avif": 1.0,
+            "image/webp": 0.9,
+            "*/*": 0.8,
+        }
+        assert parse_accept(None) == {}
+
+    def test_negotiate(self):
+        formats = ["avif", "webp"]
+        best = supported_formats(formats)[0]
+        assert negotiate_format("image/avif,image/webp,*/*", "image/jpeg", formats) == (
+            best
+        )
+        assert negotiate_format("image/webp,*/*", "image/jpeg", formats) == "webp"
+        assert negotiate_format("image/webp", "image/jpeg", ["avif"]) == "jpeg"
+        # wildcards do not count, and q=0 refuses a format
+        assert negotiate_format("*/*", "image/png", formats) == "png"
+        assert negotiate_format("image/webp;q=0", "image/jpeg", formats) == "jpeg"
+        assert negotiate_format(None, "image/gif", formats) == "png"
+
+    def test_output_media_type(self):
+        assert output_media_type({"format": "webp"}, "image/jpeg") == "image/webp"
+        assert output_media_type({"format": "jpg"}, "image/png") == "image/jpeg"
+        assert output_media_type({"format": "auto"}, "image/gif") == "image/gif"
+        assert output_media_type({}, "image/png") == "image/png"
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,106 @@
+#!/usr/bin/env -S uv run --script
+
+import io
+import sys
+from pathlib import Path
+from unittest import TestCase, mock
+import unittest
+
+from PIL import Image
+
+sys.path.append(str(Path(__file__).parent.parent))
+
+from am.transforms.factory import factory
+from am.transforms.pipeline import PipelineTransform
+from am.transforms.types import InvalidTransformError, Transform, run_transform
+
+
+class TestPipeline(TestCase):
+    """
+    TestPipeline is a test case for chained transforms.
+    """
+
+    def test_create(self):
+        """
+        Comma separated names create a pipeline, with per step params.
+        """
+        transform = factory.create_transform(
+            "resize,sharpen,format",
+            {"width": "100", "height": "50", "format": "png", "sharpen.radius": "1"},
+        )
+        assert isinstance(transform, PipelineTransform)
+        assert [step.name for step in transform.steps] == [
+            "resize",
+            "sharpen",
+            "format",
+        ]
+        assert transform.steps[1].radius == 1
+        assert transform.cache_key() == (
+            "resize?width=100&height=50&fit=cover&quality=80&format=png"
+            "|sharpen?radius=1.0&percent=150&threshold=3"
+            "|format?quality=80&format=png"
+        )
+
+    def test_single_decode(self):
+        """
+        The steps share the decoded image and it is encoded once.
+        """
+        source = io.BytesIO()
+        Image.new("RGB", (800, 600), "blue").save(source, format="JPEG")
+        transform = factory.create_transform(
+            "resize,sharpen,format",
+            {"width": "100", "height": "50", "format": "png"},
+        )
+        with (
+            mock.patch.object(Image, "open", wraps=Image.open) as image_open,
+            mock.patch.object(
+                Image.Image, "save", autospec=True, side_effect=Image.Image.save
+            ) as image_save,
+        ):
+            output = run_transform(transform, source.getvalue())
+        assert image_open.call_count == 1
+        assert image_save.call_count == 1
+        image = Image.open(io.BytesIO(output))
+        assert image.format == "PNG"
+        assert image.size == (100, 50)
+
+    def test_not_chainable(self):
+        """
+        Transforms without apply_image can not be chained.
+        """
+
+        class StreamTransform(Transform):
+            def apply(self, input, output):
+                output.write(input.read())
+
+        factory.register_transform("stream", StreamTransform)
+        try:
+            with self.assertRaises(ValueError):
+                factory.create_transform("resize,stream", {"width": 1, "height": 1})
+        finally:
+            del factory.transforms["stream"]
+
+    def test_invalid(self):
+        """
+        Unknown steps and invalid params are reported by name.
+        """
+        cases = [
+            ("resize,blur", {"width": "1", "height": "1"}, "Unknown transform blur"),
+            ("resize", {"width": "1"}, "Missing height for transform resize"),
+            ("resize", {"width": "a", "height": "1"}, "Invalid width=a"),
+            ("resize", {"width": "0", "height": "1"}, "Invalid width=0"),
+            (
+                "resize,sharpen",
+                {"width": "1", "height": "1", "sharpen.radius": "x"},
+                "Invalid radius=x for transform sharpen",
+            ),
+        ]
+        for name, params, message in cases:
+            with self.subTest(name=name, params=params):
+                with self.assertRaises(InvalidTransformError) as context:
+                    factory.create_transform(name, params)
+                assert message in str(context.exception)
+
+
+if __name__ == "__main__":
+    unittest.main()
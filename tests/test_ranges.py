@@ -0,0 +1,137 @@
+#!/usr/bin/env -S uv run --script
+
+import asyncio
+import os
+import shutil
+import sys
+import threading
+from pathlib import Path
+from unittest import TestCase
+import unittest
+
+
+sys.path.append(str(Path(__file__).parent.parent))
+
+from am.config import StorageConfig
+from am.executors import get_executor
+from am.responses import (
+    RangeNotSatisfiableError,
+    StorageFileResponse,
+    parse_range_header,
+)
+from am.storage.factory import create_storage
+
+
+class TestRanges(TestCase):
+    """
+    TestRanges is a test case for HTTP range parsing and ranged reads.
+    """
+
+    def test_parse_range_header(self):
+        """
+        Test parsing of the Range header.
+        """
+        assert parse_range_header("bytes=0-99", 1000) == [(0, 100)]
+        assert parse_range_header("bytes=900-", 1000) == [(900, 1000)]
+        assert parse_range_header("bytes=-100", 1000) == [(900, 1000)]
+        assert parse_range_header("bytes=990-2000", 1000) == [(990, 1000)]
+        assert parse_range_header("bytes=0-1, 10-19", 1000) == [(0, 2), (10, 20)]
+        # overlapping ranges are merged
+        assert parse_range_header("bytes=10-19,0-14", 1000) == [(0, 20)]
+        # malformed ranges are ignored
+        assert parse_range_header("bytes=20-10", 1000) is None
+        assert parse_range_header("bytes=a-b", 1000) is None
+        assert parse_range_header("items=0-1", 1000) is None
+        with self.assertRaises(RangeNotSatisfiableError):
+            parse_range_header("bytes=1000-", 1000)
+
+    def test_read_range(self):
+        """
+        Test DiskStorage.read_range only reads the requested bytes.
+        """
+        if os.path.exists("./data/test-ranges/"):
+            shutil.rmtree("./data/test-ranges/")
+        storage = create_storage(
+            StorageConfig(
+                name="test-ranges", type="disk", config={"path": "./data/test-ranges/"}
+            )
+        )
+        storage.create_bucket("test")
+        data = bytes(range(256)) * 10
+        with storage.open_write("test", "data.bin") as f:
+            f.write(data)
+
+        chunks = list(storage.read_range("test", "data.bin", 100, 350, chunk_size=100))
+        assert [len(chunk) for chunk in chunks] == [100, 100, 50]
+        assert b"".join(chunks) == data[100:350]
+        tail = b"".join(storage.read_range("test", "data.bin", 2500, 3000))
+        assert tail == data[2500:]
+
+    def test_reads_in_io_executor(self):
+        """
+        Streamed reads run in the io executor, and a cancelled stream closes
+        its generator there.
+        """
+        threads = []
+        closed = threading.Event()
+
+        def chunks():
+            try:
+                for chunk in [b"a", b"b", b"c"]:
+                    threads.append(threading.current_thread().name)
+                    yield chunk
+            finally:
+                closed.set()
+
+        async def read(count: int) -> list[bytes]:
+            iterator = get_executor("io").iterate(chunks())
+            items = [await anext(iterator) for _ in range(count)]
+            await iterator.aclose()
+            return items
+
+        assert asyncio.run(read(2)) == [b"a", b"b"]
+        assert all(name.startswith("io") for name in threads)
+        assert closed.wait(5)
+
+    def test_file_gone_after_stat(self):
+        """
+        A file removed between its stat and its read is not found.
+        """
+        if os.path.exists("./data/test-ranges/"):
+            shutil.rmtree("./data/test-ranges/")
+        storage = create_storage(
+            StorageConfig(
+                name="test-ranges", type="disk", config={"path": "./data/test-ranges/"}
+            )
+        )
+        storage.create_bucket("test")
+        with storage.open_write("test", "data.bin") as f:
+            f.write(b"data")
+        stat = storage.stat("test", "data.bin")
+
+        async def respond(ranges) -> list[dict]:
+            messages = []
+
+            async def receive():
+                return {"type": "http.disconnect"}
+
+            async def send(message):
+                messages.append(message)
+
+            response = StorageFileResponse(storage, "test", stat, ranges=ranges)
+            await response({"type": "http"}, receive, send)
+            return messages
+
+        messages = asyncio.run(respond(None))
+        assert messages[0]["status"] == 200
+        assert b"".join(m.get("body", b"") for m in messages) == b"data"
+
+        storage.delete_file("test", "data.bin")
+        for ranges in [None, [(0, 2)]]:
+            with self.subTest(ranges=ranges):
+                messages = asyncio.run(respond(ranges))
+                assert messages[0]["status"] == 404
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,168 @@
+#!/usr/bin/env -S uv run --script
+
+import io
+import os
+import shutil
+import sys
+from pathlib import Path
+from unittest import TestCase
+import unittest
+
+from PIL import Image
+
+sys.path.append(str(Path(__file__).parent.parent))
+
+from am.config import BucketConfig, StorageConfig, config
+from am.renditions import (
+    bucket_presets,
+    parse_spec,
+    rendition_key,
+    rendition_stat,
+    worker,
+)
+from am.storage import events
+from am.storage.factory import registry
+from am.transforms.factory import factory as transforms_factory
+
+
+class TestRenditions(TestCase):
+    """
+    TestRenditions is a test case for the renditions generated on upload.
+    """
+
+    def setUp(self):
+        """
+        Set up the test environment.
+        """
+        if os.path.exists("./data/test-renditions/"):
+            shutil.rmtree("./data/test-renditions/")
+        config.storage["test-renditions"] = StorageConfig(
+            name="test-renditions",
+            type="disk",
+            config={"path": "./data/test-renditions/"},
+        )
+        config.buckets["test-renditions"] = BucketConfig(
+            name="test-renditions",
+            storage="test-renditions",
+            renditions={"thumb": "resize width=20 height=10 format=png"},
+        )
+        config.executors["transform"].type = "thread"
+        registry.load()
+
+    def tearDown(self):
+        """
+        Remove the test config.
+        """
+        del config.storage["test-renditions"]
+        del config.buckets["test-renditions"]
+        registry.load()
+
+    def test_parse_spec(self):
+        """
+        Test parsing of the preset specs.
+        """
+        assert parse_spec("resize width=200 height=100") == (
+            "resize",
+            {"width": "200", "height": "100"},
+        )
+        assert parse_spec({"transform": "resize", "width": 200}) == (
+            "resize",
+            {"width": "200"},
+        )
+
+    def test_generate(self):
+        """
+        Renditions are generated for matching files and removed with them.
+        """
+        storage = registry.for_bucket("test-renditions")
+        storage.create_bucket("test-renditions")
+        image = io.BytesIO()
+        Image.new("RGB", (400, 300), "red").save(image, format="JPEG")
+        with storage.open_write("test-renditions", "image.jpg") as f:
+            f.write(image.getvalue())
+        with storage.open_write("test-renditions", "text.txt") as f:
+            f.write(b"test")
+
+        # the upload queued the jobs, run them here
+        while not worker.queue.empty():
+            worker.process(*worker.queue.get())
+
+        stat = storage.stat("test-renditions", "image.jpg")
+        rendered = rendition_stat(storage, "test-renditions", stat, "thumb")
+        assert rendered is not None
+        with storage.open_read("test-renditions", rendered.key) as f:
+            assert Image.open(f).size == (20, 10)
+        assert not os.path.exists(
+            f"./data/test-renditions/test-renditions/{rendition_key('thumb', 'text.txt')}"
+        )
+        assert [f.key for f in storage.list_files("test-renditions")] == [
+            "image.jpg",
+            "text.txt",
+        ]
+
+        # requesting the same transform finds the preset
+        transform = transforms_factory.create_transform(
+            "resize", {"width": "20", "height": "10", "format": "png"}
+        )
+        presets = bucket_presets("test-renditions")
+        assert presets["thumb"].cache_key() == transform.cache_key()
+
+        storage.delete_file("test-renditions", "image.jpg")
+        while not worker.queue.empty():
+            worker.process(*worker.queue.get())
+        assert rendition_stat(storage, "test-renditions", stat, "thumb") is None
+
+    def test_other_storage_events(self):
+        """
+        Only the changes of the storage of the bucket queue renditions, not the
+        ones of a storage it wraps.
+        """
+        events.notify_change("other", "test-renditions", "image.jpg")
+        assert worker.queue.empty()
+        events.notify_change("test-renditions", "test-renditions", "image.jpg")
+        assert worker.queue.get() == ("test-renditions", "test-renditions", "image.jpg")
+
+    def test_internal_keys_rejected(self):
+        """
+        Renditions cannot be written or read directly through the API.
+        """
+        from fastapi.testclient import TestClient
+
+        from serve import app
+
+        storage = registry.for_bucket("test-renditions")
+        storage.create_bucket("test-renditions")
+        client = TestClient(app)
+        key = rendition_key("thumb", "image.jpg")
+        for path in [key, f"dir/{key}"]:
+            url = f"/api/v1/test-renditions/{path}"
+            assert client.put(url, content=b"evil").status_code == 400
+            assert client.get(url).status_code == 404
+            assert client.head(url).status_code == 404
+        assert not os.path.exists(f"./data/test-renditions/test-renditions/{key}")
+
+    def test_not_found(self):
+        """
+        Missing keys and directories are not found.
+        """
+        from fastapi.testclient import TestClient
+
+        from serve import app
+
+        storage = registry.for_bucket("test-renditions")
+        storage.create_bucket("test-renditions")
+        with storage.open_write("test-renditions", "dir/text.txt") as f:
+            f.write(b"test")
+        while not worker.queue.empty():
+            worker.process(*worker.queue.get())
+        client = TestClient(app)
+        for path in ["missing.jpg", "dir", "dir/text.txt/x"]:
+            with self.subTest(path=path):
+                response = client.get(f"/api/v1/test-renditions/{path}")
+                assert response.status_code == 404
+                response = client.head(f"/api/v1/test-renditions/{path}")
+                assert response.status_code == 404
+
+
+if __name__ == "__main__":
+    unittest.main()
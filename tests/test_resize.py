@@ -0,0 +1,64 @@
+#!/usr/bin/env -S uv run --script
+
+import io
+import sys
+from pathlib import Path
+from unittest import TestCase
+import unittest
+
+from PIL import Image
+
+sys.path.append(str(Path(__file__).parent.parent))
+
+from am.transforms.resize import ResizeTransform
+
+
+class TestResize(TestCase):
+    """
+    TestResize is a test case for the resize transform.
+    """
+
+    def image(self, format: str) -> bytes:
+        image = Image.new("RGB", (3000, 2000), "white")
+        # a red band at the left third, cut out by a square cover
+        image.paste("red", (0, 0, 400, 2000))
+        data = io.BytesIO()
+        image.save(data, format=format)
+        return data.getvalue()
+
+    def resize(self, data: bytes, **config) -> Image.Image:
+        transform = ResizeTransform("resize", {"format": "png", **config})
+        output = io.BytesIO()
+        transform.apply(io.BytesIO(data), output)
+        return Image.open(output)
+
+    def test_fits(self):
+        """
+        Test the output size of each fit, for JPEG (draft decoding) and PNG.
+        """
+        for format in ["JPEG", "PNG"]:
+            data = self.image(format)
+            cover = self.resize(data, width=200, height=200, fit="cover")
+            assert cover.size == (200, 200)
+            # the crop is centered, so the red band is cut out
+            r, g, b = cover.getpixel((0, 100))
+            assert g > 200, (format, cover.getpixel((0, 100)))
+            assert self.resize(data, width=200, height=200, fit="contain").size == (
+                200,
+                133,
+            )
+            fill = self.resize(data, width=200, height=50, fit="fill")
+            assert fill.size == (200, 50)
+            r, g, b = fill.getpixel((0, 25))
+            assert g < 50, (format, fill.getpixel((0, 25)))
+
+    def test_upscale(self):
+        """
+        Images smaller than the requested size are upscaled.
+        """
+        data = self.image("JPEG")
+        assert self.resize(data, width=6000, height=6000).size == (6000, 6000)
+
+
+if __name__ == "__main__":
+    unittest.main()
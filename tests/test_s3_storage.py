@@ -0,0 +1,137 @@
+#!/usr/bin/env -S uv run --script
+
+import os
+import sys
+import urllib.request
+from pathlib import Path
+from unittest import TestCase
+import unittest
+
+sys.path.append(str(Path(__file__).parent.parent))
+
+from am.config import StorageConfig
+from am.storage.factory import create_storage
+from am.storage.types import NoSuchBucketError, NoSuchFileError
+
+try:
+    import boto3
+    from moto.server import ThreadedMotoServer
+except ImportError:
+    boto3 = None
+
+
+@unittest.skipIf(boto3 is None, "needs the s3 extra and moto[server]")
+class TestS3Storage(TestCase):
+    """
+    TestS3Storage is a test case for the S3Storage class, against a local moto
+    server.
+    """
+
+    @classmethod
+    def setUpClass(cls):
+        os.environ.setdefault("AWS_ACCESS_KEY_ID", "test")
+        os.environ.setdefault("AWS_SECRET_ACCESS_KEY", "test")
+        cls.server = ThreadedMotoServer(port=0, verbose=False)
+        cls.server.start()
+        host, port = cls.server.get_host_and_port()
+        cls.endpoint_url = f"http://{host}:{port}"
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.server.stop()
+
+    def setUp(self):
+        """
+        Set up the test environment.
+        """
+        # drop what previous tests stored
+        urllib.request.urlopen(
+            urllib.request.Request(f"{self.endpoint_url}/moto-api/reset", method="POST")
+        )
+        boto3.client(
+            "s3", endpoint_url=self.endpoint_url, region_name="us-east-1"
+        ).create_bucket(Bucket="assets")
+        self.storage = create_storage(
+            StorageConfig(
+                name="test-s3",
+                type="s3",
+                config={
+                    "endpoint_url": self.endpoint_url,
+                    "region": "us-east-1",
+                    "bucket": "assets",
+                    "prefix": "am/",
+                    "part_size": 5 * 1024 * 1024,
+                    "max_concurrency": 2,
+                },
+            )
+        )
+
+    def tearDown(self):
+        self.storage.close()
+
+    def test_s3_storage(self):
+        """
+        Test writing, reading, listing and deleting.
+        """
+        storage = self.storage
+        storage.create_bucket("test")
+        for key in ["b/c.txt", "a.txt", "b/d.txt"]:
+            with storage.open_write("test", key) as f:
+                f.write(key.encode("utf-8"))
+
+        assert [bucket.name for bucket in storage.list_buckets()] == ["test"]
+        assert [f.key for f in storage.list_files("test")] == [
+            "a.txt",
+            "b/c.txt",
+            "b/d.txt",
+        ]
+        page = storage.list_page("test", delimiter="/")
+        assert [f.key for f in page.files] == ["a.txt"]
+        assert page.common_prefixes == ["b/"]
+
+        with storage.open_read("test", "b/c.txt") as f:
+            assert f.read() == b"b/c.txt"
+            f.seek(2)
+            assert f.read(3) == b"c.t"
+        assert b"".join(storage.read_range("test", "b/c.txt", 2, 5)) == b"c.t"
+        stat = storage.stat("test", "a.txt")
+        assert stat.size == 5 and stat.etag
+
+        storage.delete_file("test", "a.txt")
+        with self.assertRaises(NoSuchFileError):
+            storage.stat("test", "a.txt")
+        storage.delete_bucket("test")
+        with self.assertRaises(NoSuchBucketError):
+            storage.list_files("test")
+
+    def test_multipart(self):
+        """
+        Large files are sent in parts, and failed writes keep the old file.
+        """
+        storage = self.storage
+        storage.create_bucket("test")
+        chunk = os.urandom(1024 * 1024)
+        with storage.open_write("test", "large.bin") as f:
+            for _ in range(12):
+                f.write(chunk)
+        stat = storage.stat("test", "large.bin")
+        assert stat.size == 12 * len(chunk)
+        # multipart ETags end with the count of parts
+        assert stat.etag.endswith("-3")
+        assert (
+            b"".join(
+                storage.read_range("test", "large.bin", 11 * len(chunk), stat.size)
+            )
+            == chunk
+        )
+
+        with self.assertRaises(RuntimeError):
+            with storage.open_write("test", "large.bin") as f:
+                for _ in range(6):
+                    f.write(b"x" * len(chunk))
+                raise RuntimeError("client went away")
+        assert storage.stat("test", "large.bin").etag == stat.etag
+
+
+if __name__ == "__main__":
+    unittest.main()
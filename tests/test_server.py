@@ -0,0 +1,48 @@
+#!/usr/bin/env -S uv run --script
+
+import socket
+import sys
+from pathlib import Path
+from unittest import TestCase
+import unittest
+
+sys.path.append(str(Path(__file__).parent.parent))
+
+from am.server import bind_socket, current_rss
+
+
+class TestServer(TestCase):
+    """
+    TestServer is a test case for the helpers of the multi-worker server.
+    """
+
+    def test_reuse_port(self):
+        """
+        Workers binding with SO_REUSEPORT can listen on the same port.
+        """
+        if not hasattr(socket, "SO_REUSEPORT"):
+            self.skipTest("SO_REUSEPORT not available")
+        first = bind_socket("127.0.0.1", 0, reuse_port=True)
+        try:
+            port = first.getsockname()[1]
+            second = bind_socket("127.0.0.1", port, reuse_port=True)
+            second.close()
+        finally:
+            first.close()
+
+        first = bind_socket("127.0.0.1", 0, reuse_port=False)
+        try:
+            with self.assertRaises(OSError):
+                bind_socket("127.0.0.1", first.getsockname()[1], reuse_port=False)
+        finally:
+            first.close()
+
+    def test_current_rss(self):
+        rss = current_rss()
+        if rss is None:
+            self.skipTest("RSS not available")
+        assert rss > 1024 * 1024
+
+
+if __name__ == "__main__":
+    unittest.main()
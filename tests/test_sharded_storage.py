@@ -0,0 +1,89 @@
+#!/usr/bin/env -S uv run --script
+
+import os
+import shutil
+import sys
+from pathlib import Path
+from unittest import TestCase
+import unittest
+
+sys.path.append(str(Path(__file__).parent.parent))
+
+from am.config import StorageConfig
+from am.storage.disk import SHARDS_DIR, DiskStorage
+from am.storage.migrate import migrate_bucket
+
+KEYS = ["a.txt", "b/c.txt", "b/d.txt", "e.txt", ".am-renditions/thumb/a.txt"]
+
+
+class TestShardedStorage(TestCase):
+    """
+    TestShardedStorage is a test case for the sharded disk layout.
+    """
+
+    def setUp(self):
+        """
+        Set up the test environment.
+        """
+        if os.path.exists("./data/test-sharded/"):
+            shutil.rmtree("./data/test-sharded/")
+
+    def create(self, layout: str) -> DiskStorage:
+        return DiskStorage(
+            StorageConfig(
+                name="test-sharded",
+                type="disk",
+                config={"path": "./data/test-sharded/", "layout": layout},
+            )
+        )
+
+    def test_sharded(self):
+        """
+        Keys are stored under their shard and listed in key order.
+        """
+        storage = self.create("sharded")
+        storage.create_bucket("test")
+        for key in KEYS:
+            with storage.open_write("test", key) as f:
+                f.write(key.encode("utf-8"))
+
+        path = storage.file_path("test", "b/c.txt")
+        assert path.parts[-5] == SHARDS_DIR
+        assert path.exists()
+        with storage.open_read("test", "b/c.txt") as f:
+            assert f.read() == b"b/c.txt"
+        assert [f.key for f in storage.list_files("test")] == KEYS[:4]
+        page = storage.list_page("test", delimiter="/", max_keys=2)
+        assert [f.key for f in page.files] == ["a.txt"]
+        assert page.common_prefixes == ["b/"]
+
+    def test_migrate(self):
+        """
+        Files move between layouts keeping their keys.
+        """
+        direct = self.create("direct")
+        direct.create_bucket("test")
+        for key in KEYS:
+            with direct.open_write("test", key) as f:
+                f.write(key.encode("utf-8"))
+        mtime = direct.stat("test", "a.txt").last_modified
+
+        sharded = self.create("sharded")
+        assert migrate_bucket(direct, sharded, "test") == len(KEYS)
+        assert os.listdir("./data/test-sharded/test") == [SHARDS_DIR]
+        assert [f.key for f in sharded.list_files("test")] == KEYS[:4]
+        assert sharded.stat("test", "a.txt").last_modified == mtime
+        assert sharded.file_path("test", KEYS[-1]).exists()
+
+        assert migrate_bucket(sharded, direct, "test") == len(KEYS)
+        assert sorted(os.listdir("./data/test-sharded/test")) == [
+            ".am-renditions",
+            "a.txt",
+            "b",
+            "e.txt",
+        ]
+        assert [f.key for f in direct.list_files("test")] == KEYS[:4]
+
+
+if __name__ == "__main__":
+    unittest.main()
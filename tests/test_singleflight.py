@@ -0,0 +1,74 @@
+#!/usr/bin/env -S uv run --script
+
+import asyncio
+import sys
+from pathlib import Path
+from unittest import TestCase
+import unittest
+
+sys.path.append(str(Path(__file__).parent.parent))
+
+from am.singleflight import SingleFlight, SingleFlightTimeoutError
+
+
+class TestSingleFlight(TestCase):
+    """
+    TestSingleFlight is a test case for the deduplication of concurrent calls.
+    """
+
+    def test_shared(self):
+        """
+        Concurrent calls with the same key run once and share the result.
+        """
+        flight = SingleFlight()
+        calls = []
+
+        async def compute(value):
+            calls.append(value)
+            await asyncio.sleep(0.01)
+            return value
+
+        async def main():
+            results = await asyncio.gather(
+                *[flight.do("a", lambda: compute(1)) for _ in range(10)],
+                flight.do("b", lambda: compute(2)),
+            )
+            # once done, the next call computes again
+            results.append(await flight.do("a", lambda: compute(3)))
+            return results
+
+        assert asyncio.run(main()) == [1] * 10 + [2, 3]
+        assert calls == [1, 2, 3]
+        assert flight.shared == 9
+        assert flight.calls == {}
+
+    def test_errors(self):
+        """
+        Errors are shared too, and timed out callers leave the call running.
+        """
+        flight = SingleFlight()
+
+        async def fail():
+            await asyncio.sleep(0.01)
+            raise ValueError("failed")
+
+        async def slow():
+            await asyncio.sleep(0.05)
+            return "done"
+
+        async def main():
+            results = await asyncio.gather(
+                flight.do("a", fail), flight.do("a", fail), return_exceptions=True
+            )
+            assert [type(result) for result in results] == [ValueError, ValueError]
+
+            with self.assertRaises(SingleFlightTimeoutError):
+                await flight.do("b", slow, timeout=0.01)
+            assert "b" in flight.calls
+            assert await flight.do("b", slow) == "done"
+
+        asyncio.run(main())
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,167 @@
+#!/usr/bin/env -S uv run --script
+
+import os
+import shutil
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from unittest import TestCase
+import unittest
+
+sys.path.append(str(Path(__file__).parent.parent))
+
+from am.config import StorageConfig, config
+from am.storage.factory import registry
+from am.storage.types import NoSuchFileError
+
+
+class TestTieredStorage(TestCase):
+    """
+    TestTieredStorage is a test case for the tiered read-through cache.
+    """
+
+    def setUp(self):
+        """
+        Set up a tiered storage over a disk one.
+        """
+        if os.path.exists("./data/test-tiered/"):
+            shutil.rmtree("./data/test-tiered/")
+        config.storage["test-tiered-backend"] = StorageConfig(
+            name="test-tiered-backend",
+            type="disk",
+            config={"path": "./data/test-tiered/backend/"},
+        )
+        registry.load()
+        self.backend = registry.get("test-tiered-backend")
+        self.backend.create_bucket("test")
+
+    def tearDown(self):
+        for name in ["test-tiered", "test-tiered-backend"]:
+            config.storage.pop(name, None)
+        registry.load()
+
+    def tiered(self, **options):
+        config.storage["test-tiered"] = StorageConfig(
+            name="test-tiered",
+            type="tiered",
+            config={
+                "backend": "test-tiered-backend",
+                "path": "./data/test-tiered/tier/",
+                **options,
+            },
+        )
+        registry.load()
+        return registry.get("test-tiered")
+
+    def read(self, storage, key: str) -> bytes:
+        with storage.open_read("test", key) as f:
+            return f.read()
+
+    def test_read_through(self):
+        """
+        Reads are cached, and invalidated by changes at the backend.
+        """
+        storage = self.tiered(memory_max_object_size=4)
+        with self.backend.open_write("test", "small.txt") as f:
+            f.write(b"abc")
+        with self.backend.open_write("test", "large.txt") as f:
+            f.write(b"abcdefgh")
+
+        assert self.read(storage, "small.txt") == b"abc"
+        assert self.read(storage, "large.txt") == b"abcdefgh"
+        assert (storage.hits, storage.misses) == (0, 2)
+        assert self.read(storage, "small.txt") == b"abc"
+        assert b"".join(storage.read_range("test", "large.txt", 2, 4)) == b"cd"
+        assert (storage.memory.hits, storage.disk_hits) == (1, 1)
+        assert storage.local_path("test", "large.txt") is not None
+
+        # written through another storage, seen from the change event
+        with self.backend.open_write("test", "large.txt") as f:
+            f.write(b"changed")
+        assert storage.local_path("test", "large.txt") is None
+        assert self.read(storage, "large.txt") == b"changed"
+
+        self.backend.delete_file("test", "small.txt")
+        with self.assertRaises(NoSuchFileError):
+            self.read(storage, "small.txt")
+
+    def test_concurrent_misses(self):
+        """
+        Concurrent reads of a missing object download it once.
+        """
+        storage = self.tiered(memory_max_object_size=0)
+        with self.backend.open_write("test", "a.txt") as f:
+            f.write(b"abc")
+        downloads = []
+        started = threading.Event()
+        release = threading.Event()
+        read_range = self.backend.read_range
+
+        def slow_read_range(*args, **kwargs):
+            downloads.append(args)
+            started.set()
+            release.wait(5)
+            return read_range(*args, **kwargs)
+
+        self.backend.read_range = slow_read_range
+        try:
+            with ThreadPoolExecutor(4) as pool:
+                results = [pool.submit(self.read, storage, "a.txt")]
+                assert started.wait(5)
+                results += [pool.submit(self.read, storage, "a.txt") for _ in range(3)]
+                # the others wait for the running download
+                while storage.misses < 4:
+                    time.sleep(0.01)
+                release.set()
+                assert [result.result() for result in results] == [b"abc"] * 4
+        finally:
+            del self.backend.read_range
+        assert len(downloads) == 1
+        assert (storage.disk_hits, storage.misses) == (0, 4)
+        assert storage.fetching == {}
+
+    def test_write_through(self):
+        """
+        Writes go to the backend and are kept in the cache.
+        """
+        storage = self.tiered()
+        with storage.open_write("test", "a.txt") as f:
+            f.write(b"abc")
+        assert self.read(self.backend, "a.txt") == b"abc"
+        assert self.read(storage, "a.txt") == b"abc"
+        assert storage.misses == 0
+        assert [f.key for f in storage.list_files("test")] == ["a.txt"]
+
+        storage.delete_file("test", "a.txt")
+        with self.assertRaises(NoSuchFileError):
+            self.backend.stat("test", "a.txt")
+        assert storage.entries == {}
+
+    def test_write_back(self):
+        """
+        Writes are uploaded in the background, and survive restarts.
+        """
+        storage = self.tiered(write="back")
+        # hold the uploads until the storage is built again
+        storage.flush_queue.put(None)
+        storage.flusher.join()
+        with storage.open_write("test", "a.txt") as f:
+            f.write(b"abc")
+        assert self.read(storage, "a.txt") == b"abc"
+        with self.assertRaises(NoSuchFileError):
+            self.backend.stat("test", "a.txt")
+
+        # a new instance uploads the pending entries, and close waits for them
+        config.storage.pop("test-tiered")
+        registry.load()
+        storage = self.tiered(write="back", stat_ttl=0)
+        storage.close()
+        assert self.read(self.backend, "a.txt") == b"abc"
+        assert storage.dirty == set()
+        assert storage.stat("test", "a.txt") == self.backend.stat("test", "a.txt")
+
+
+if __name__ == "__main__":
+    unittest.main()
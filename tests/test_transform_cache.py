@@ -0,0 +1,132 @@
+#!/usr/bin/env -S uv run --script
+
+import logging
+import os
+import shutil
+import sys
+from pathlib import Path
+from unittest import TestCase
+import unittest
+
+
+logger = logging.getLogger(__name__)
+
+logging.basicConfig(level=logging.DEBUG)
+
+
+sys.path.append(str(Path(__file__).parent.parent))
+
+from am.config import StorageConfig
+from am.storage.factory import create_storage
+from am.transforms.cache import TransformCache, get_transform_cache
+
+
+class TestTransformCache(TestCase):
+    """
+    TestTransformCache is a test case for the TransformCache class.
+    """
+
+    def setUp(self):
+        """
+        Set up the test environment.
+        """
+        for path in ["./data/test-cache/", "./data/test-cache.cache/"]:
+            if os.path.exists(path):
+                shutil.rmtree(path)
+
+    def test_eviction(self):
+        """
+        Least recently used entries are evicted when over max_size.
+        """
+        storage = create_storage(
+            StorageConfig(
+                name="test-cache", type="disk", config={"path": "./data/test-cache/"}
+            )
+        )
+        storage.create_bucket("test")
+        for name in ["a", "b", "c"]:
+            with storage.open_write("test", name) as f:
+                f.write(b"source")
+
+        cache = TransformCache("./data/test-cache.cache/", max_size=10)
+        a, b, c = (storage.stat("test", name) for name in ["a", "b", "c"])
+        cache.put("test", a, "resize?width=1", b"aaaa")
+        cache.put("test", b, "resize?width=1", b"bbbb")
+        assert cache.get("test", a, "resize?width=1") == b"aaaa"
+        cache.put("test", c, "resize?width=1", b"cccc")
+
+        assert cache.get("test", b, "resize?width=1") is None
+        assert cache.get("test", a, "resize?width=1") == b"aaaa"
+        assert cache.get("test", c, "resize?width=1") == b"cccc"
+        assert cache.size == 8
+
+        # entries survive a restart
+        cache = TransformCache("./data/test-cache.cache/", max_size=10)
+        assert cache.get("test", c, "resize?width=1") == b"cccc"
+
+    def test_invalidation(self):
+        """
+        Writing or deleting the source drops its cached outputs.
+        """
+        storage = create_storage(
+            StorageConfig(
+                name="test-cache",
+                type="disk",
+                config={"path": "./data/test-cache/", "transform_cache": True},
+            )
+        )
+        cache = get_transform_cache(storage.config)
+        storage.create_bucket("test")
+        with storage.open_write("test", "image.jpg") as f:
+            f.write(b"source")
+
+        stat = storage.stat("test", "image.jpg")
+        cache.put("test", stat, "resize?width=1", b"thumb")
+        assert cache.get("test", stat, "resize?width=1") == b"thumb"
+        assert cache.get("test", stat, "resize?width=2") is None
+
+        with storage.open_write("test", "image.jpg") as f:
+            f.write(b"source")
+        assert cache.get("test", stat, "resize?width=1") is None
+        assert cache.size == 0
+
+        cache.put("test", stat, "resize?width=1", b"thumb")
+        storage.delete_file("test", "image.jpg")
+        assert cache.get("test", stat, "resize?width=1") is None
+
+    def test_config_change(self):
+        """
+        The cache of a storage is built again when its settings change, as on
+        a config reload.
+        """
+        storage_config = StorageConfig(
+            name="test-cache-reload",
+            type="disk",
+            config={"path": "./data/test-cache/", "transform_cache": True},
+        )
+        cache = get_transform_cache(storage_config)
+        assert cache is not None
+        assert get_transform_cache(storage_config) is cache
+
+        reloaded = StorageConfig(
+            name="test-cache-reload",
+            type="disk",
+            config={
+                "path": "./data/test-cache/",
+                "transform_cache": {"max_size": 100},
+            },
+        )
+        resized = get_transform_cache(reloaded)
+        assert resized is not cache
+        assert resized.max_size == 100
+
+        disabled = StorageConfig(
+            name="test-cache-reload",
+            type="disk",
+            config={"path": "./data/test-cache/"},
+        )
+        assert get_transform_cache(disabled) is None
+
+
+if __name__ == "__main__":
+    unittest.main()